@@ -0,0 +1,581 @@
+#!/usr/bin/python3
+'''
+   Copyright 2020 Ian Santopietro (ian@system76.com)
+
+   This file is part of Repoman.
+
+    Repoman is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Repoman is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Repoman.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Declarative bundles of software sources. A bundle describes the APT sources,
+# signing keys and Flatpak remotes a machine should have, and applying it only
+# touches what differs from the system. Nothing in here may load Gtk, since
+# it's used by the headless command line interface.
+
+import json
+import logging
+import os
+from pathlib import Path
+import re
+from urllib.parse import urlparse
+
+import repolib
+
+from . import openpgp
+from .cache import CACHE_DIR, write_cache_file
+from .keys import get_fingerprints, key_fetcher, normalize_fingerprint
+from .writer import content_hash
+
+log = logging.getLogger('repoman.Bundle')
+
+KEY_TYPES = ('fingerprint', 'url', 'ascii', 'path')
+
+# The key specification each bundle keyring was imported from, so keys
+# whose fingerprints the bundle doesn't give can be checked without
+# downloading them
+KEY_RECORDS = CACHE_DIR / 'bundle-keys.json'
+
+# The properties a bundle can set on a source
+SOURCE_PROPS = (
+    'name', 'enabled', 'sourcecode', 'uris', 'suites', 'components', 'signed_by'
+)
+
+# deb822 fields in a bundle and the properties they set. The X-Repoman
+# fields only exist in bundles and aren't written to the system.
+DEB822_FIELDS = {
+    'x-repoman-ident': 'ident',
+    'x-repoman-file': 'file',
+    'x-repolib-name': 'name',
+    'enabled': 'enabled',
+    'types': 'types',
+    'uris': 'uris',
+    'suites': 'suites',
+    'components': 'components',
+    'signed-by': 'signed_by',
+}
+
+def parse_deb822(text):
+    """ Split deb822 text into stanzas.
+
+    Arguments:
+        text (str): The text to parse.
+
+    Returns:
+        A list of dicts, one per stanza, with lower-case field names.
+    """
+    stanzas = []
+    stanza = {}
+    field = None
+    for line in text.splitlines():
+        if line.startswith('#'):
+            continue
+        if not line.strip():
+            if stanza:
+                stanzas.append(stanza)
+            stanza = {}
+            field = None
+        elif line[0].isspace():
+            if not field:
+                raise ValueError(f'Continuation line outside of a field: {line}')
+            value = line.strip()
+            # A lone '.' stands for an empty line, e.g. in an armored key
+            stanza[field] += '\n' + ('' if value == '.' else value)
+        else:
+            if ':' not in line:
+                raise ValueError(f'Not a deb822 field: {line}')
+            field, value = line.split(':', 1)
+            field = field.strip().lower()
+            stanza[field] = value.strip()
+    if stanza:
+        stanzas.append(stanza)
+    return stanzas
+
+def default_ident(uri):
+    """ Make an ident for a source from its URI. """
+    parsed = urlparse(uri)
+    ident = re.sub(r'[^a-z0-9]+', '-', f'{parsed.netloc}{parsed.path}'.lower())
+    return ident.strip('-') or 'source'
+
+def key_path(name):
+    """ Get the path of the keyring repolib stores the key `name` in. """
+    return Path(repolib.util.KEYS_DIR) / f'{name}-archive-keyring.gpg'
+
+def get_key_fingerprints(spec):
+    """ Get the fingerprints of the keys a key specification imports.
+
+    This never goes to the network, so URL keys which don't give their
+    fingerprint can't be worked out.
+
+    Returns:
+        A list of fingerprints (or key IDs, for fingerprint imports), or None
+        if they couldn't be worked out.
+    """
+    try:
+        if spec.get('fingerprint'):
+            return [normalize_fingerprint(spec['fingerprint'])]
+        if spec.get('ascii'):
+            return get_fingerprints(spec['ascii'])
+    except ValueError as err:
+        log.debug('Could not get the fingerprints of %s: %s', spec, err)
+    return None
+
+def get_spec_hash(spec):
+    """ Get a hash identifying a key specification. """
+    return content_hash(json.dumps(spec, sort_keys=True).encode())
+
+def load_key_records(path=None):
+    """ Read the records of imported bundle keys, see `KEY_RECORDS`.
+
+    Returns:
+        A dict of {'spec': spec hash, 'digest': keyring hash} by key name.
+    """
+    path = Path(path or KEY_RECORDS)
+    try:
+        with open(path) as records_file:
+            stat = os.fstat(records_file.fileno())
+            if stat.st_uid != os.getuid() or stat.st_mode & 0o022:
+                raise ValueError('Owned or writable by another user')
+            records = json.load(records_file)
+        if not isinstance(records, dict):
+            raise ValueError('Not a mapping')
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as err:
+        log.warning('Discarding bundle key records %s: %s', path, err)
+        return {}
+    return {
+        name: record for name, record in records.items()
+        if isinstance(record, dict)
+    }
+
+def save_key_records(records, path=None):
+    """ Write the records of imported bundle keys. """
+    path = Path(path or KEY_RECORDS)
+    try:
+        write_cache_file(path, json.dumps(records, indent=2).encode())
+    except OSError as err:
+        log.warning('Could not save bundle key records %s: %s', path, err)
+
+def key_is_current(name, spec, records=None):
+    """ Check whether the keyring for `name` holds exactly the keys in `spec`.
+
+    A keyring which exists but holds other keys (e.g. after the vendor
+    rotated their key) isn't current, so the key is imported again. Keys
+    whose fingerprints `spec` doesn't give are current if the keyring is
+    unchanged since it was imported from the same specification. Only local
+    files are read.
+
+    Arguments:
+        name (str): The name of the key.
+        spec (dict): The key specification.
+        records (dict): The records of imported keys, see `load_key_records`.
+    """
+    path = key_path(name)
+    try:
+        data = path.read_bytes()
+    except OSError:
+        return False
+    wanted = get_key_fingerprints(spec)
+    if not wanted:
+        record = (records or {}).get(name, {})
+        return (
+            record.get('spec') == get_spec_hash(spec)
+            and record.get('digest') == content_hash(data)
+        )
+    try:
+        existing = [key.fingerprint for key in openpgp.parse_keyring(data)]
+    except ValueError as err:
+        log.debug('Could not read keyring %s: %s', path, err)
+        return False
+    # Fingerprint imports may give a key ID, which matches the end
+    return (
+        len(existing) == len(wanted)
+        and all(
+            any(fingerprint.endswith(want) for fingerprint in existing)
+            for want in wanted
+        )
+    )
+
+def get_key_type(spec):
+    """ Get which of `KEY_TYPES` a key specification imports by. """
+    if spec.get('url'):
+        # A fingerprint next to a URL is the key the URL should serve
+        return 'url'
+    return [key_type for key_type in KEY_TYPES if spec.get(key_type)][0]
+
+def _as_bool(value):
+    if hasattr(value, 'get_bool'):
+        return value.get_bool()
+    if isinstance(value, str):
+        return value.strip().lower() in ('yes', 'true', '1')
+    return bool(value)
+
+def _as_list(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return value.split()
+    return [str(item) for item in value]
+
+class Bundle:
+    """ A set of sources, keys and Flatpak remotes to apply to the system.
+
+    Attributes:
+        sources (dict): Normalized source entries by ident. Properties which
+            the bundle doesn't mention are None and are left alone.
+        keys (dict): Key specifications by name, each a dict with one of
+            `KEY_TYPES` and an optional `keyserver`. A `url` key may also
+            give the `fingerprint` it's expected to contain.
+        remotes (list): Flatpak remotes as dicts with `name`, `url` and
+            `installation`.
+    """
+
+    def __init__(self):
+        self.sources = {}
+        self.keys = {}
+        self.remotes = []
+
+    @classmethod
+    def from_text(cls, text):
+        """ Read a bundle from deb822 stanzas or a JSON manifest.
+
+        Raises:
+            ValueError: If the bundle is malformed.
+        """
+        bundle = cls()
+        if text.lstrip().startswith('{'):
+            bundle.load_manifest(json.loads(text))
+        else:
+            for stanza in parse_deb822(text):
+                bundle.add_stanza(stanza)
+        return bundle
+
+    @classmethod
+    def from_file(cls, path):
+        """ Read a bundle from `path`. """
+        with open(path) as bundle_file:
+            return cls.from_text(bundle_file.read())
+
+    def load_manifest(self, manifest):
+        """ Add the contents of a JSON manifest.
+
+        Arguments:
+            manifest (dict): The manifest, with optional `sources`, `keys`
+                and `flatpak_remotes` members.
+        """
+        for name, spec in manifest.get('keys', {}).items():
+            self.add_key(name, spec)
+        for entry in manifest.get('sources', []):
+            self.add_source(entry)
+        for remote in manifest.get('flatpak_remotes', []):
+            if not remote.get('name') or not remote.get('url'):
+                raise ValueError(f'Flatpak remotes need a name and url: {remote}')
+            self.remotes.append({
+                'name': remote['name'],
+                'url': remote['url'],
+                'installation': remote.get('installation', 'user').lower(),
+            })
+
+    def add_stanza(self, stanza):
+        """ Add a source from a deb822 stanza. """
+        entry = {}
+        for field, value in stanza.items():
+            if field in DEB822_FIELDS:
+                entry[DEB822_FIELDS[field]] = value
+        signed_by = entry.get('signed_by') or ''
+        if 'BEGIN PGP PUBLIC KEY BLOCK' in signed_by:
+            # An embedded key is imported into a keyring of its own
+            entry['ident'] = entry.get('ident') or self._get_ident(entry)
+            self.add_key(entry['ident'], {'ascii': entry.pop('signed_by')})
+            entry['key'] = entry['ident']
+        self.add_source(entry)
+
+    def add_key(self, name, spec):
+        """ Add a key specification. """
+        types = [key_type for key_type in KEY_TYPES if spec.get(key_type)]
+        if types == ['fingerprint', 'url']:
+            types = ['url']
+        if len(types) != 1:
+            raise ValueError(
+                f'Key {name} needs exactly one of {", ".join(KEY_TYPES)}'
+            )
+        self.keys[name] = dict(spec)
+
+    def _get_ident(self, entry):
+        uris = _as_list(entry.get('uris'))
+        if not uris:
+            raise ValueError(f'Source has no URIs: {entry}')
+        return default_ident(uris[0])
+
+    def add_source(self, entry):
+        """ Add a source entry, normalizing its values. """
+        ident = entry.get('ident') or self._get_ident(entry)
+        if not _as_list(entry.get('suites')):
+            raise ValueError(f'Source {ident} has no suites')
+        key = entry.get('key')
+        if key and key not in self.keys:
+            raise ValueError(f'Source {ident} uses unknown key {key}')
+
+        types = _as_list(entry.get('types'))
+        sourcecode = entry.get('sourcecode')
+        if sourcecode is None and types is not None:
+            sourcecode = 'deb-src' in types
+        enabled = entry.get('enabled')
+        self.sources[ident] = {
+            'ident': ident,
+            'file': entry.get('file') or ident,
+            'key': key,
+            'name': entry.get('name'),
+            'enabled': None if enabled is None else _as_bool(enabled),
+            'sourcecode': None if sourcecode is None else _as_bool(sourcecode),
+            'uris': _as_list(entry.get('uris')),
+            'suites': _as_list(entry.get('suites')),
+            'components': _as_list(entry.get('components')),
+            'signed_by': entry.get('signed_by'),
+        }
+
+    def get_signed_by(self, entry):
+        """ Get the keyring path a source entry should be signed with. """
+        key = entry['key']
+        if not key:
+            return entry['signed_by']
+        spec = self.keys[key]
+        if spec.get('path'):
+            return str(spec['path'])
+        return str(key_path(key))
+
+def get_source_values(source):
+    """ Get the current values of the bundle properties of a source. """
+    return {
+        'name': source.name,
+        'enabled': _as_bool(source.enabled),
+        'sourcecode': _as_bool(source.sourcecode_enabled),
+        'uris': list(source.uris),
+        'suites': list(source.suites),
+        'components': list(source.components),
+        'signed_by': str(source.signed_by or ''),
+    }
+
+def set_source_values(source, values):
+    """ Set bundle properties on a source. """
+    for prop, value in values.items():
+        if prop == 'sourcecode':
+            source.sourcecode_enabled = value
+        else:
+            setattr(source, prop, value)
+
+class BundlePlan:
+    """ The changes needed to bring the system in line with a bundle.
+
+    Attributes:
+        keys (dict): Specifications of the keys to import, by name.
+        changes (dict): The properties to change on existing sources, by
+            ident.
+        additions (list): Source entries which don't exist yet.
+        remotes (list): Flatpak remotes which don't exist yet.
+    """
+
+    def __init__(self, bundle):
+        self.bundle = bundle
+        self.keys = {}
+        self.changes = {}
+        self.additions = []
+        self.remotes = []
+
+    def __bool__(self):
+        return bool(self.keys or self.changes or self.additions or self.remotes)
+
+    def describe(self):
+        """ Get a line describing each change in the plan. """
+        lines = []
+        for name in self.keys:
+            lines.append(f'import key {name}')
+        for entry in self.additions:
+            lines.append(f'add source {entry["ident"]} to {entry["file"]}')
+        for ident, values in self.changes.items():
+            lines.append(f'change source {ident}: {", ".join(sorted(values))}')
+        for remote in self.remotes:
+            lines.append(f'add flatpak remote {remote["installation"]}:{remote["name"]}')
+        return lines
+
+def find_source(store, entry):
+    """ Find the loaded source a bundle entry describes, or None.
+
+    repolib gives the sources it loads idents of its own, based on the file
+    name, so a source the bundle added before may not have the bundle's
+    ident. Failing that, it's the source in the entry's file with the same
+    URIs.
+    """
+    source = store.get(entry['ident'])
+    if source is not None:
+        return source
+    file = repolib.util.files.get(f'{entry["file"]}.sources')
+    if file is None or not entry['uris']:
+        return None
+    for source in file.sources:
+        if list(source.uris) == entry['uris']:
+            return source
+    return None
+
+def plan_bundle(bundle, store, remotes=(), records=None):
+    """ Work out the minimal set of changes to apply a bundle.
+
+    This only looks at the loaded sources, the keyrings and the records of
+    imported keys, and never at the network, so planning a bundle which is
+    already applied doesn't touch any files.
+
+    Arguments:
+        bundle (:obj:`Bundle`): The bundle to apply.
+        store (:obj:`SourceStore`): The loaded sources.
+        remotes (iterable): (installation, name) tuples of the Flatpak remotes
+            which already exist.
+        records (dict): The records of imported keys; read from
+            `KEY_RECORDS` by default.
+
+    Returns:
+        A :obj:`BundlePlan`.
+    """
+    plan = BundlePlan(bundle)
+    if records is None:
+        records = load_key_records()
+    for ident, entry in bundle.sources.items():
+        wanted = {prop: entry[prop] for prop in SOURCE_PROPS}
+        wanted['signed_by'] = bundle.get_signed_by(entry)
+        key = entry['key']
+        if key and key not in plan.keys and 'path' not in bundle.keys[key]:
+            if not key_is_current(key, bundle.keys[key], records):
+                plan.keys[key] = bundle.keys[key]
+
+        source = find_source(store, entry)
+        if source is None:
+            plan.additions.append(dict(entry, signed_by=wanted['signed_by']))
+            continue
+        current = get_source_values(source)
+        changes = {
+            prop: value for prop, value in wanted.items()
+            if value is not None and value != current[prop]
+        }
+        if changes:
+            plan.changes[source.ident] = changes
+
+    existing = set(remotes)
+    for remote in bundle.remotes:
+        if (remote['installation'], remote['name']) not in existing:
+            plan.remotes.append(remote)
+    return plan
+
+def fetch_keys(keys, fetcher=None):
+    """ Import keys concurrently and wait for them all.
+
+    Arguments:
+        keys (dict): Key specifications by name.
+        fetcher (:obj:`KeyFetcher`): The fetcher to use, `key_fetcher` by
+            default.
+
+    Returns:
+        A dict of the imported :obj:`repolib.SourceKey` objects by name.
+    """
+    fetcher = fetcher or key_fetcher
+    fetches = {}
+    for name, spec in keys.items():
+        log.info('Importing key %s', name)
+        key_type = get_key_type(spec)
+        fetches[name] = fetcher.fetch(
+            name, key_type, spec[key_type], spec.get('keyserver', ''),
+            fingerprint=spec.get('fingerprint', '') if key_type == 'url' else '',
+            # Bundle sources are signed with their own keyring's path
+            reuse_path=False
+        )
+    return {name: fetch.result() for name, fetch in fetches.items()}
+
+def _get_stanza(entry):
+    """ Render a new source entry as deb822 lines for repolib to load. """
+    lines = [
+        f'X-Repolib-Name: {entry["name"] or entry["ident"]}',
+        f'Enabled: {"no" if entry["enabled"] is False else "yes"}',
+        f'Types: {"deb deb-src" if entry["sourcecode"] else "deb"}',
+        f'URIs: {" ".join(entry["uris"] or [])}',
+        f'Suites: {" ".join(entry["suites"])}',
+    ]
+    if entry['components']:
+        lines.append(f'Components: {" ".join(entry["components"])}')
+    if entry['signed_by']:
+        lines.append(f'Signed-By: {entry["signed_by"]}')
+    return lines
+
+def _get_file(name, files):
+    """ Get the loaded (or a new) source file called `name`. """
+    file_name = f'{name}.sources'
+    if file_name not in files:
+        file = repolib.util.files.get(file_name)
+        if file is None:
+            file = repolib.SourceFile(name=name)
+        files[file_name] = file
+    return files[file_name]
+
+def apply_plan(plan, store, callback=None):
+    """ Apply a :obj:`BundlePlan` in one batch.
+
+    Each key is imported once, each touched file is written once, and the
+    store notifies its subscribers once after all of the writes.
+
+    Arguments:
+        plan (:obj:`BundlePlan`): The changes to make.
+        store (:obj:`SourceStore`): The loaded sources.
+        callback (function): Called as `callback(errors)` once the files have
+            been written, see `SourceStore.write_files`.
+
+    Returns:
+        A list of :obj:`concurrent.futures.Future` for the writes.
+    """
+    imported = fetch_keys(plan.keys)
+    if imported:
+        records = load_key_records()
+        for name, key in imported.items():
+            try:
+                digest = content_hash(Path(key.path).read_bytes())
+            except OSError as err:
+                log.debug('Could not record key %s: %s', name, err)
+                continue
+            records[name] = {
+                'spec': get_spec_hash(plan.keys[name]), 'digest': digest
+            }
+        save_key_records(records)
+
+    files = {}
+    for ident, values in plan.changes.items():
+        source = store.get(ident)
+        set_source_values(source, values)
+        files[source.file.path.name] = source.file
+    for entry in plan.additions:
+        file = _get_file(entry['file'], files)
+        source = repolib.Source()
+        source.load_from_data(_get_stanza(entry))
+        if not file.sources:
+            file.format = source.default_format
+        source.file = file
+        file.add_source(source)
+
+    for file in files.values():
+        store.writes.discard(file.path)
+    futures = store.write_files(files.values(), callback)
+
+    if plan.remotes:
+        from . import flatpak_helper
+        for remote in plan.remotes:
+            log.info('Adding flatpak remote %s', remote['name'])
+            flatpak_helper.add_remote_from_url(
+                remote['name'], remote['url'], remote['installation']
+            )
+    return futures
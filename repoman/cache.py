@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+'''
+   Copyright 2020 Ian Santopietro (ian@system76.com)
+
+   This file is part of Repoman.
+
+    Repoman is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Repoman is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Repoman.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import logging
+import os
+from pathlib import Path
+import pickle
+import tempfile
+import threading
+
+log = logging.getLogger('repoman.Cache')
+
+CACHE_DIR = Path(
+    os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')
+) / 'repoman'
+
+def file_stamp(path):
+    """ Get the stamp used to tell whether a file changed since it was cached.
+
+    Arguments:
+        path (:obj:`Path`): The file to stat.
+
+    Returns:
+        A (size, mtime_ns, inode) tuple, or None if the file doesn't exist.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+def write_cache_file(path, data):
+    """ Atomically replace a cache file with `data`.
+
+    Arguments:
+        path (:obj:`Path`): The cache file to write.
+        data (bytes): The new contents of the file.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.')
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(data)
+        os.replace(tmp_name, path)
+    except:
+        os.unlink(tmp_name)
+        raise
+
+class ParseCache:
+    """ A persistent cache of parsed source files.
+
+    Each entry holds a pickled :obj:`repolib.SourceFile` keyed by the path of
+    the file it was parsed from, and is only valid as long as the file's size,
+    mtime and inode still match. A cache which can't be read for any reason
+    is thrown away and rebuilt.
+    """
+
+    version = 1
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path else CACHE_DIR / 'sources.cache'
+        self.log = logging.getLogger('repoman.ParseCache')
+        self.lock = threading.RLock()
+        self.entries = {}
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self._loaded = False
+
+    def load(self):
+        """ Read the cache from disk, discarding it if it's unusable."""
+        with self.lock:
+            self._loaded = True
+            self.entries = {}
+            try:
+                if self.path.stat().st_uid != os.getuid():
+                    # Never unpickle data written by someone else
+                    self.log.warning('Ignoring cache %s owned by another user', self.path)
+                    return
+                with open(self.path, 'rb') as cache_file:
+                    data = pickle.load(cache_file)
+                if data.get('version') != self.version:
+                    raise ValueError(f'Cache version {data.get("version")}')
+                self.entries = dict(data['entries'])
+            except FileNotFoundError:
+                pass
+            except Exception as err:
+                self.log.warning('Discarding corrupt cache %s: %s', self.path, err)
+                self.clear()
+
+    def clear(self):
+        """ Remove every entry, both in memory and on disk."""
+        with self.lock:
+            self.entries = {}
+            self.dirty = False
+            try:
+                self.path.unlink()
+            except OSError:
+                pass
+
+    def get(self, path, stamp):
+        """ Get the cached parse of `path`, if it's still fresh.
+
+        Arguments:
+            path (:obj:`Path`): The source file to look up.
+            stamp (tuple): The current stamp of the file, see `file_stamp`.
+
+        Returns:
+            The cached :obj:`repolib.SourceFile`, or None.
+        """
+        with self.lock:
+            if not self._loaded:
+                self.load()
+            entry = self.entries.get(str(path))
+            if not entry or not stamp or entry[0] != stamp:
+                self.misses += 1
+                return None
+        try:
+            sourcefile = pickle.loads(entry[1])
+        except Exception as err:
+            self.log.debug('Dropping unreadable entry for %s: %s', path, err)
+            with self.lock:
+                self.entries.pop(str(path), None)
+                self.dirty = True
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return sourcefile
+
+    def put(self, path, stamp, sourcefile):
+        """ Store the parse of `path`.
+
+        Files which can't be pickled are simply not cached.
+
+        Arguments:
+            path (:obj:`Path`): The source file which was parsed.
+            stamp (tuple): The stamp of the file when it was parsed.
+            sourcefile (:obj:`repolib.SourceFile`): The parsed file.
+        """
+        if not stamp:
+            return
+        try:
+            data = pickle.dumps(sourcefile, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as err:
+            self.log.debug('Not caching %s: %s', path, err)
+            return
+        with self.lock:
+            self.entries[str(path)] = (stamp, data)
+            self.dirty = True
+
+    def discard(self, path):
+        """ Forget the entry for `path`, if any."""
+        with self.lock:
+            if self.entries.pop(str(path), None):
+                self.dirty = True
+
+    def prune(self, paths):
+        """ Drop entries for any file not in `paths`."""
+        keep = {str(path) for path in paths}
+        with self.lock:
+            for path in list(self.entries):
+                if path not in keep:
+                    del self.entries[path]
+                    self.dirty = True
+
+    def save(self):
+        """ Write the cache back to disk if it changed."""
+        with self.lock:
+            if not self.dirty:
+                return
+            data = pickle.dumps(
+                {'version': self.version, 'entries': self.entries},
+                protocol=pickle.HIGHEST_PROTOCOL
+            )
+            self.dirty = False
+        try:
+            write_cache_file(self.path, data)
+        except OSError as err:
+            self.log.warning('Could not save cache %s: %s', self.path, err)
@@ -0,0 +1,392 @@
+#!/usr/bin/python3
+'''
+   Copyright 2020 Ian Santopietro (ian@system76.com)
+
+   This file is part of Repoman.
+
+    Repoman is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Repoman is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Repoman.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# The headless command line interface. Nothing in here (or anything it
+# imports) may load Gtk, since it's meant to run without a display.
+
+import argparse
+import json
+import logging
+import sys
+
+log = logging.getLogger('repoman.CLI')
+
+# Any of these on the command line selects the headless interface
+HEADLESS_OPTIONS = (
+    '--list', '--apply', '--check-mirrors', '--compact-keys', '--audit-keys',
+    '--seed-keys'
+)
+
+def wants_cli(argv):
+    """ Check whether the command line asks for the headless interface.
+
+    Arguments:
+        argv (list): The command line arguments, without the program name.
+
+    Returns:
+        `True` if the CLI should handle the command line instead of the GUI.
+    """
+    for arg in argv:
+        if arg.split('=')[0] in HEADLESS_OPTIONS:
+            return True
+    return False
+
+def get_parser():
+    """ Get the argument parser for the command line interface. """
+    parser = argparse.ArgumentParser(
+        prog='repoman',
+        description='Inspect software sources without starting the GUI.'
+    )
+    parser.add_argument(
+        '--list',
+        action='store_true',
+        help='List the APT sources and Flatpak remotes on the system.'
+    )
+    parser.add_argument(
+        '--apply',
+        metavar='BUNDLE',
+        help=(
+            'Make the system match a bundle of sources (deb822 stanzas or a '
+            'JSON manifest; - reads standard input).'
+        )
+    )
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help=(
+            'With --apply or --compact-keys, only print the changes which '
+            'would be made.'
+        )
+    )
+    parser.add_argument(
+        '--check-mirrors',
+        action='store_true',
+        help=(
+            "Compare the Release dates of the system source's mirrors and "
+            'flag any which lag behind.'
+        )
+    )
+    parser.add_argument(
+        '--mirror',
+        action='append',
+        metavar='URI',
+        help='With --check-mirrors, check URI instead of the system mirrors.'
+    )
+    parser.add_argument(
+        '--suite',
+        help='With --check-mirrors, the suite to compare (default: the first '
+             'suite of the system source).'
+    )
+    parser.add_argument(
+        '--compact-keys',
+        action='store_true',
+        help=(
+            'Merge keyrings with identical contents into hard links of a '
+            'single copy. This needs to be run as root.'
+        )
+    )
+    parser.add_argument(
+        '--audit-keys',
+        action='store_true',
+        help=(
+            'Report missing, expired, expiring, unused and shared signing '
+            'keys.'
+        )
+    )
+    parser.add_argument(
+        '--seed-keys',
+        metavar='DIR',
+        help=(
+            'Add the keyrings in DIR to the key cache, so importing them '
+            'needs no network access. Keys are found by fingerprint, and by '
+            'URL if DIR/urls.json maps the URL to a keyring file name.'
+        )
+    )
+    parser.add_argument(
+        '--format',
+        choices=['text', 'json'],
+        default='text',
+        help='Output format. json prints one object per line.'
+    )
+    parser.add_argument(
+        '--no-flatpak',
+        action='store_true',
+        help='Skip listing Flatpak remotes.'
+    )
+    parser.add_argument(
+        '--debug',
+        action='store_true',
+        help='Print debugging messages to stderr.'
+    )
+    return parser
+
+def _get_value(value):
+    """ Turn repolib enums (and lists of them) into plain values. """
+    if isinstance(value, (list, tuple)):
+        return [_get_value(item) for item in value]
+    if hasattr(value, 'get_bool'):
+        return value.get_bool()
+    return getattr(value, 'value', value)
+
+def source_to_dict(source, path):
+    """ Get a JSON-serializable representation of a source.
+
+    Arguments:
+        source (:obj:`repolib.Source`): The source.
+        path (:obj:`Path`): The file the source came from.
+
+    Returns:
+        A dict describing the source.
+    """
+    item = {'kind': 'source', 'ident': source.ident, 'file': str(path)}
+    for prop in ('name', 'enabled', 'types', 'uris', 'suites', 'components',
+                 'signed_by'):
+        try:
+            item[prop] = _get_value(getattr(source, prop))
+        except Exception:
+            item[prop] = None
+    return item
+
+def iter_inventory(flatpak=True):
+    """ Yield inventory items as they are loaded.
+
+    APT sources are yielded file by file as they are parsed, followed by any
+    Flatpak remotes.
+
+    Yields:
+        A dict for each source, source file error, or Flatpak remote.
+    """
+    from . import loader
+
+    for path, sourcefile, err in loader.iter_source_files():
+        if err:
+            yield {'kind': 'error', 'file': str(path), 'error': str(err)}
+            continue
+        for source in sourcefile.sources:
+            yield source_to_dict(source, path)
+    loader.parse_cache.save()
+
+    if not flatpak:
+        return
+    try:
+        from . import flatpak_helper
+    except (ImportError, ValueError) as err:
+        log.debug('Flatpak is not available: %s', err)
+        return
+    for option in ['User', 'System']:
+        try:
+            remotes = flatpak_helper.get_remotes(option)
+        except Exception as err:
+            yield {'kind': 'error', 'installation': option, 'error': str(err)}
+            continue
+        for remote in remotes:
+            yield {
+                'kind': 'flatpak-remote',
+                'name': remote.get_name(),
+                'title': remote.get_title() or remote.get_name(),
+                'url': remote.get_url(),
+                'installation': option.lower(),
+                'enabled': not remote.get_disabled(),
+            }
+
+def format_text(item):
+    """ Format an inventory item as a line of text. """
+    if item['kind'] == 'source':
+        state = 'enabled' if item.get('enabled') else 'disabled'
+        uris = ' '.join(item.get('uris') or [])
+        return f'{item["ident"]}\t{state}\t{uris}'
+    if item['kind'] == 'flatpak-remote':
+        state = 'enabled' if item['enabled'] else 'disabled'
+        return f'flatpak:{item["installation"]}:{item["name"]}\t{state}\t{item["url"]}'
+    where = item.get('file') or item.get('installation')
+    return f'error\t{where}\t{item["error"]}'
+
+def do_list(args, output=sys.stdout):
+    """ Stream the inventory to `output`. """
+    for item in iter_inventory(flatpak=not args.no_flatpak):
+        if args.format == 'json':
+            output.write(json.dumps(item, default=str))
+        else:
+            output.write(format_text(item))
+        output.write('\n')
+        output.flush()
+    return 0
+
+def get_flatpak_remotes():
+    """ Get (installation, name) tuples for the existing Flatpak remotes. """
+    from . import flatpak_helper
+
+    remotes = set()
+    for option in ['User', 'System']:
+        for remote in flatpak_helper.get_remotes(option):
+            remotes.add((option.lower(), remote.get_name()))
+    return remotes
+
+def do_apply(args, output=sys.stdout):
+    """ Apply a bundle of sources and report what changed. """
+    from .bundle import Bundle, apply_plan, plan_bundle
+    from .store import SourceStore
+
+    try:
+        if args.apply == '-':
+            bundle = Bundle.from_text(sys.stdin.read())
+        else:
+            bundle = Bundle.from_file(args.apply)
+    except (OSError, ValueError) as err:
+        log.error('Could not read bundle %s: %s', args.apply, err)
+        return 1
+
+    store = SourceStore()
+    store.load()
+    remotes = get_flatpak_remotes() if bundle.remotes else ()
+    plan = plan_bundle(bundle, store, remotes)
+    if not plan:
+        output.write('Nothing to do\n')
+        return 0
+    for line in plan.describe():
+        output.write(f'{line}\n')
+    if args.dry_run:
+        return 0
+
+    try:
+        apply_plan(plan, store)
+    except Exception as err:
+        log.error('Could not apply bundle: %s', err)
+        return 1
+    errors = store.writer.wait()
+    for file, err in errors:
+        log.error('Could not save %s: %s', file.path, err)
+    return 1 if errors else 0
+
+def do_check_mirrors(args, output=sys.stdout):
+    """ Report how fresh each mirror is. """
+    from . import mirrors
+
+    uris = args.mirror
+    suite = args.suite
+    if not uris or not suite:
+        from .store import SourceStore
+
+        store = SourceStore()
+        store.load()
+        system = store.system_source
+        if system is None:
+            log.error('There is no system source; use --mirror and --suite')
+            return 1
+        uris = uris or list(system.uris)
+        suite = suite or list(system.suites)[0]
+
+    results = mirrors.MirrorProber().probe(uris, suite).wait()
+    reports = mirrors.compare_freshness(results)
+    lagging = False
+    for uri in uris:
+        report = reports[uri]
+        lagging = lagging or report.lagging
+        if args.format == 'json':
+            item = dict(report._asdict(), kind='mirror')
+            output.write(json.dumps(item, default=str))
+        else:
+            state = 'lagging' if report.lagging else 'ok'
+            output.write(f'{uri}\t{state}\t{mirrors.format_freshness(report)}')
+        output.write('\n')
+    return 2 if lagging else 0
+
+def do_compact_keys(args, output=sys.stdout):
+    """ Merge duplicate keyrings and report which were merged. """
+    from .keys import key_store
+
+    try:
+        results = key_store.compact(dry_run=args.dry_run)
+    except OSError as err:
+        log.error('Could not compact keyrings: %s', err)
+        return 1
+    for kept, merged in results:
+        if args.format == 'json':
+            item = {'kind': 'keyring', 'path': kept, 'merged': merged}
+            output.write(json.dumps(item))
+        else:
+            output.write(f'{kept}\t{" ".join(merged)}')
+        output.write('\n')
+    if not results and args.format == 'text':
+        output.write('No duplicate keyrings\n')
+    return 0
+
+def do_audit_keys(args, output=sys.stdout):
+    """ Report problems with the signing keys of the sources. """
+    from .keys import audit_keys
+    from .store import SourceStore
+
+    store = SourceStore()
+    store.load()
+    audit = audit_keys(store.sources)
+    for issue in audit.issues:
+        if args.format == 'json':
+            item = dict(issue._asdict(), kind='key', issue=issue.kind)
+            output.write(json.dumps(item))
+        else:
+            idents = ','.join(issue.idents) or '-'
+            output.write(
+                f'{issue.severity}\t{issue.kind}\t{idents}\t{issue.path}\t'
+                f'{issue.detail}'
+            )
+        output.write('\n')
+    if args.format == 'text':
+        output.write(
+            f'{audit.keyrings} keyrings checked, {len(audit)} issues\n'
+        )
+    errors = [issue for issue in audit.issues if issue.severity == 'error']
+    return 2 if errors else 0
+
+def do_seed_keys(args, output=sys.stdout):
+    """ Seed the key cache from a directory. """
+    from .keys import key_cache
+
+    try:
+        count = key_cache.seed(args.seed_keys)
+    except (OSError, ValueError) as err:
+        log.error('Could not seed keys from %s: %s', args.seed_keys, err)
+        return 1
+    output.write(f'Added {count} keys to the cache\n')
+    return 0
+
+def main(argv=None):
+    """ Run the command line interface.
+
+    Arguments:
+        argv (list): The arguments, without the program name.
+
+    Returns:
+        The exit status.
+    """
+    args = get_parser().parse_args(argv)
+    if args.list:
+        return do_list(args)
+    if args.apply:
+        return do_apply(args)
+    if args.check_mirrors:
+        return do_check_mirrors(args)
+    if args.compact_keys:
+        return do_compact_keys(args)
+    if args.audit_keys:
+        return do_audit_keys(args)
+    if args.seed_keys:
+        return do_seed_keys(args)
+    get_parser().print_help()
+    return 1
@@ -19,14 +19,16 @@
     along with Repoman.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import logging
-from datetime import date
 from pathlib import Path
+import threading
 
 import gi
 gi.require_version('Gtk', '3.0')
 gi.require_version('Notify', '0.7')
-from gi.repository import Gtk, Notify
+from gi.repository import Gtk, GLib, Notify
  
 from gettext import gettext as _ 
 
@@ -35,11 +37,81 @@ try:
 except (ImportError, ValueError):
     pass
 from . import repo
+from .index import get_key_path
+from .keys import key_info
 
 settings = Gtk.Settings.get_default()
 header = settings.props.gtk_dialogs_use_header
 header = True
 
+# Milliseconds to wait after the last keystroke before validating an entry
+VALIDATE_DELAY = 200
+
+def validate_entry(entry_text, flatpak=False):
+    """ Check whether the text in the Add Source entry can be added.
+
+    Arguments:
+        entry_text (str): The stripped text of the entry.
+        flatpak (bool): Whether this is a flatpakrepo URL instead of an APT
+            source.
+
+    Returns:
+        `True` if the entry is valid.
+    """
+    # Validate differently based on APT vs Flatpak
+    if flatpak:
+        entry_valid = flatpak_helper.validate_flatpakrepo(entry_text)
+    
+    else:
+        entry_valid = repo.validate(entry_text)
+    
+    entry_isshortcut = entry_text in ['ppa', 'popdev']
+    entry_isdeb = entry_text.startswith('deb')
+
+    # If we're dealing with a plain URL, it can't have spaces
+    if not entry_isshortcut and not entry_isdeb:
+        uri = entry_text.split()
+        if len(uri) != 1:
+            entry_valid = False
+    
+    # deb lines must have at least three elements (type, URI, suite)
+    if entry_isdeb:
+        line = entry_text.split()
+        if len(line) < 3:
+            entry_valid = False
+
+    return bool(entry_valid)
+
+class ValidationCache:
+    """ A small LRU cache of validation results, keyed by input. """
+
+    def __init__(self, size=64):
+        self.size = size
+        self.lock = threading.Lock()
+        self.results = OrderedDict()
+
+    def get(self, key):
+        """ Get the cached result for `key`, or None. """
+        with self.lock:
+            if key not in self.results:
+                return None
+            self.results.move_to_end(key)
+            return self.results[key]
+
+    def put(self, key, result):
+        """ Store the result for `key`, evicting the oldest if needed. """
+        with self.lock:
+            self.results[key] = result
+            self.results.move_to_end(key)
+            while len(self.results) > self.size:
+                self.results.popitem(last=False)
+
+validation_cache = ValidationCache()
+validation_worker = ThreadPoolExecutor(
+    max_workers=1,
+    thread_name_prefix='repoman-validate'
+)
+
 class ErrorDialog(Gtk.Dialog):
 
     def __init__(self, parent, dialog_title, dialog_icon,
@@ -89,6 +161,9 @@ class AddDialog(Gtk.Dialog):
 
         self.log = logging.getLogger("repoman.AddDialog")
         self.flatpak = flatpak
+        self.validate_generation = 0
+        self.validate_timeout = 0
+        self.connect('destroy', self.on_destroy)
 
         content_area = self.get_content_area()
 
@@ -144,33 +219,66 @@ class AddDialog(Gtk.Dialog):
         self.show_all()
 
     def on_entry_changed(self, widget):
+        """ entry::changed signal handler
+
+        Validation happens on a worker once typing pauses, so pasting a long
+        line doesn't block the UI. Results are cached by input, and any
+        result for text which has since changed is thrown away.
+        """
         entry_text = widget.get_text().strip()
-        entry_valid = False
-        self.log.debug('Using Flatpak validator: %s', self.flatpak)
+        self.validate_generation += 1
+        if self.validate_timeout:
+            GLib.source_remove(self.validate_timeout)
+            self.validate_timeout = 0
+
+        cached = validation_cache.get((entry_text, self.flatpak))
+        if cached is not None:
+            self.set_entry_valid(cached)
+            return
+
+        self.set_entry_valid(False)
+        self.validate_timeout = GLib.timeout_add(
+            VALIDATE_DELAY,
+            self.start_validation,
+            self.validate_generation,
+            entry_text
+        )
 
-        # Validate differently based on APT vs Flatpak
-        if self.flatpak:
-            entry_valid = flatpak_helper.validate_flatpakrepo(entry_text)
-        
-        else:
-            entry_valid = repo.validate(entry_text)
-        
-        entry_isshortcut = entry_text in ['ppa', 'popdev']
-        entry_isdeb = entry_text.startswith('deb')
-
-        # If we're dealing with a plain URL, it can't have spaces
-        if not entry_isshortcut and not entry_isdeb:
-            uri = entry_text.split()
-            if len(uri) != 1:
-                entry_valid = False
-        
-        # deb lines must have at least three elements (type, URI, suite)
-        if entry_isdeb:
-            line = entry_text.split()
-            if len(line) < 3:
-                entry_valid = False
+    def start_validation(self, generation, entry_text):
+        """ Run the validation for `entry_text` on the worker. """
+        self.validate_timeout = 0
+        self.log.debug('Using Flatpak validator: %s', self.flatpak)
+        future = validation_worker.submit(
+            validate_entry, entry_text, self.flatpak
+        )
+        future.add_done_callback(
+            lambda future: GLib.idle_add(
+                self.on_validated, generation, entry_text, future
+            )
+        )
+        return False
 
-        # Set the add button's sensitivity based on the results of validation.
+    def on_validated(self, generation, entry_text, future):
+        """ Apply a finished validation, unless the entry has changed. """
+        try:
+            entry_valid = future.result()
+        except Exception as err:
+            self.log.debug('Could not validate %s: %s', entry_text, err)
+            entry_valid = False
+        validation_cache.put((entry_text, self.flatpak), entry_valid)
+        if generation == self.validate_generation:
+            self.set_entry_valid(entry_valid)
+        return False
+
+    def on_destroy(self, widget):
+        """ Drop any pending validation when the dialog goes away. """
+        self.validate_generation += 1
+        if self.validate_timeout:
+            GLib.source_remove(self.validate_timeout)
+            self.validate_timeout = 0
+
+    def set_entry_valid(self, entry_valid):
+        """ Set the add button's sensitivity based on validation. """
         try:
             self.add_button.set_sensitive(entry_valid)
         except TypeError:
@@ -327,14 +435,18 @@ class EditDialog(Gtk.Dialog):
         # Ensure the source is fully up to date.
         self.source.file.load()
         self.key = None
+        self.key_info = None
         has_key: bool = False
         supports_keys: bool = True
+        key_path = get_key_path(self.source)
         try: 
-            if self.source.get_key_info():
+            if key_path:
+                # From the key cache; this doesn't run gpg
+                keys = key_info.lookup(key_path)
+                if not keys:
+                    raise ValueError(f'{key_path} contains no keys')
+                self.key_info = keys[0]
                 has_key = True
-        except AttributeError:
-            # Repolib installed does not support keys
-            supports_keys = False
         except Exception as err:
             # Some other issue with keys
             self.log.error(
@@ -371,33 +483,13 @@ class EditDialog(Gtk.Dialog):
                 try:
                     file = source.file
                     out_source = file.get_source_by_ident(source.ident)
-                    old_key = out_source.key
-                    out_source.key = None
-                    out_source.signed_by = ''
-                    multi_key: bool = False
-                    for other_source in repo.sources.values():
-                        if other_source.ident == out_source.ident:
-                            continue
-                        if other_source.key == old_key:
-                            self.log.debug(
-                                'Found key in use with %s', other_source.ident
-                            )
-                            multi_key = True
-                            break
-                    if multi_key:
-                        self.log.info(
-                            'Key file %s in use with another key, not deleting',
-                            old_key.path
-                        )
-                    else:
-                        self.log.warning(
-                            'No other source found using the key %s, deleting',
-                            old_key.path
-                        )
-                        old_key.delete_key()
                     self.log.debug('Saving new source %s', source)
-                    out_source.save()
-                    self.log.debug('Source saved')
+                    repo.store.remove_source_key(
+                        out_source,
+                        callback=lambda file, err: self.on_key_removed(
+                            parent, source, err
+                        )
+                    )
                 except Exception as err:
                     self.log.error(
                         'Could not edit mirror %s: %s', source.ident, str(err)
@@ -533,7 +625,6 @@ class EditDialog(Gtk.Dialog):
         edit_grid.attach(self.enabled_switch, 1, 5, 1, 1)
 
         if has_key:
-            self.key = self.source.get_key_info()
             keyid_label = Gtk.Label.new(_('Key ID:'))
             keyid_label.set_halign(Gtk.Align.END)
             keyid_label.set_valign(Gtk.Align.START)
@@ -543,8 +634,8 @@ class EditDialog(Gtk.Dialog):
             keytype_label.set_halign(Gtk.Align.END)
             issuedate_label = Gtk.Label.new(_('Issue Date:'))
             issuedate_label.set_halign(Gtk.Align.END)
-            keysize_label = Gtk.Label.new(_('Size:'))
-            keysize_label.set_halign(Gtk.Align.END)
+            expiredate_label = Gtk.Label.new(_('Expires:'))
+            expiredate_label.set_halign(Gtk.Align.END)
             keypath_label = Gtk.Label.new(_('Keyring Path:'))
             keypath_label.set_halign(Gtk.Align.END)
             keypath_label.set_valign(Gtk.Align.START)
@@ -558,38 +649,43 @@ class EditDialog(Gtk.Dialog):
             key_grid.attach(fingerprint_label, 0, 1, 1, 1)
             key_grid.attach(keytype_label,     0, 2, 1, 1)
             key_grid.attach(issuedate_label,   0, 3, 1, 1)
-            key_grid.attach(keysize_label,     0, 4, 1, 1)
+            key_grid.attach(expiredate_label,  0, 4, 1, 1)
             key_grid.attach(keypath_label,     0, 5, 1, 1)
             key_grid.attach(delete_key_button, 1, 6, 1, 1)
-            keyid = Gtk.Label.new(self.key['uids'][0])
+            uid = self.key_info.uids[0] if self.key_info.uids else ''
+            keyid = Gtk.Label.new(uid)
             keyid.set_selectable(True)
             keyid.set_line_wrap(True)
             keyid.set_max_width_chars(60)
             keyid.props.xalign = 0
-            fingerprint = Gtk.Label.new(self.key['keyid'])
+            fingerprint = Gtk.Label.new(self.key_info.fingerprint)
             fingerprint.set_selectable(True)
-            if self.key['type'] == 'pub':
-                keytype = Gtk.Label.new(_('Public'))
-            else:
-                keytype = Gtk.Label.new(_('Private'))
-            keydate = date.fromtimestamp(int(self.key['date']))
+            # Keyrings used for sources only ever hold public keys
+            keytype = Gtk.Label.new(_('Public'))
+            keydate = self.key_info.created.astimezone()
             issuedate = Gtk.Label.new(keydate.ctime())
             issuedate.set_selectable(True)
-            sizeunit:str = _('Bytes')
-            keysize = Gtk.Label.new(f'{self.key["length"]} {sizeunit}')
-            keysize.set_selectable(True)
-            keypath = Gtk.Label.new(str(self.source.key.path))
+            if self.key_info.revoked:
+                expiredate = Gtk.Label.new(_('Revoked'))
+            elif self.key_info.expires:
+                expiredate = Gtk.Label.new(
+                    self.key_info.expires.astimezone().ctime()
+                )
+            else:
+                expiredate = Gtk.Label.new(_('Never'))
+            expiredate.set_selectable(True)
+            keypath = Gtk.Label.new(key_path)
             keypath.set_selectable(True)
             keypath.set_line_wrap(True)
             keypath.set_max_width_chars(60)
             keypath.props.xalign = 0
-            for i in [keyid, fingerprint, keytype, issuedate, keysize, keypath]:
+            for i in [keyid, fingerprint, keytype, issuedate, expiredate, keypath]:
                 i.set_halign(Gtk.Align.START)
             key_grid.attach(keyid,       1, 0, 1, 1)
             key_grid.attach(fingerprint, 1, 1, 1, 1)
             key_grid.attach(keytype,     1, 2, 1, 1)
             key_grid.attach(issuedate,   1, 3, 1, 1)
-            key_grid.attach(keysize,     1, 4, 1, 1)
+            key_grid.attach(expiredate,  1, 4, 1, 1)
             key_grid.attach(keypath,     1, 5, 1, 1)
 
 
@@ -620,45 +716,73 @@ class EditDialog(Gtk.Dialog):
             action_area.add(cancel_button)
             action_area.add(save_button)
     
+    def on_key_removed(self, parent, source, err):
+        """ Writer callback for removing a faulty key. """
+        if not err:
+            self.log.debug('Source saved')
+            return
+        self.log.error(
+            'Could not edit mirror %s: %s', source.ident, str(err)
+        )
+        repo.show_error_messagedialog(
+            parent,
+            f'Could not save source',
+            err,
+            f'{source.name} could not be saved'
+        )
+
     def on_add_key_clicked(self, button):
         """ button::clicked signal handler
         
-        Open a dialog to add a signing key
+        Open a dialog to add a signing key. The key is fetched in the
+        background while the dialog shows a spinner, and the user can cancel
+        the fetch.
         """
         dialog = AddKeyDialog(self, self.source)
         response = dialog.run()
-        if response == Gtk.ResponseType.OK:
-            try:
-                self.key = repo.get_key(
-                    self.source,
-                    key_type=dialog.key_type_combo.get_active_id(),
-                    key_data=dialog.prime_buffer,
-                    key_options=dialog.secondary_buffer
-                )
-            except Exception as err:
-                self.log.error(
-                    'Could not add key to %s: %s', 
-                    self.source.ident, 
-                    str(err)
-                )
-                error_dialog = repo.get_error_messagedialog(
-                    self.parent,
-                    f'Could not add key to {self.source.name}',
-                    err,
-                    f'{self.source.ident} will not be saved.'
-                )
-                error_dialog.run()
-                error_dialog.destroy()
-                dialog.destroy()
-                self.response(Gtk.ResponseType.CANCEL)
-                return
-            self.key_data = dialog.prime_buffer
-            self.keytype = dialog.key_type_combo.get_active_id()
+        if response != Gtk.ResponseType.OK:
+            dialog.destroy()
+            return
+
+        key_type = dialog.key_type_combo.get_active_id()
+        fetch = repo.key_fetcher.fetch(
+            self.source.ident,
+            key_type,
+            dialog.prime_buffer,
+            dialog.secondary_buffer,
+            callback=dialog.on_key_fetched
+        )
+        dialog.set_fetching(True)
+        response = dialog.run()
+        if response != Gtk.ResponseType.ACCEPT:
+            self.log.info('Cancelled fetching key for %s', self.source.ident)
+            fetch.cancel()
+            dialog.set_fetching(False)
             dialog.destroy()
-            if not self.key:
-                raise Exception(f'Could not add the key to source {self.source.ident}!')
-            self.response(Gtk.ResponseType.APPLY)
+            return
+
+        self.key, err = dialog.fetch_result
+        if err:
+            self.log.error(
+                'Could not add key to %s: %s', 
+                self.source.ident, 
+                str(err)
+            )
+            error_dialog = repo.get_error_messagedialog(
+                self.parent,
+                f'Could not add key to {self.source.name}',
+                err,
+                f'{self.source.ident} will not be saved.'
+            )
+            error_dialog.run()
+            error_dialog.destroy()
+            dialog.destroy()
+            self.response(Gtk.ResponseType.CANCEL)
+            return
+        self.key_data = dialog.prime_buffer
+        self.keytype = key_type
         dialog.destroy()
+        self.response(Gtk.ResponseType.APPLY)
     
     def on_delete_key_button_clicked(self, button):
         delete_dialog = DeleteKeyDialog(self, self.source.ident)
@@ -807,9 +931,37 @@ class AddKeyDialog(Gtk.Dialog):
                                    "suggested-action")
         self.save_button.set_sensitive(False)
 
+        self.spinner = Gtk.Spinner()
+        self.spinner.set_no_show_all(True)
+        content_grid.attach(self.spinner, 0, 3, 2, 1)
+        self.fetch_result = (None, None)
+        self.fetching = False
+
         self.show_all()
         self.key_type_combo.set_active_id('fingerprint')
 
+    def set_fetching(self, fetching):
+        """ Show that the key is being fetched, leaving only Cancel usable. """
+        self.fetching = fetching
+        self.spinner.set_visible(fetching)
+        if fetching:
+            self.spinner.start()
+        else:
+            self.spinner.stop()
+        self.save_button.set_sensitive(not fetching)
+        self.key_type_combo.set_sensitive(not fetching)
+        self.key_select_stack.set_sensitive(not fetching)
+
+    def on_key_fetched(self, key, err):
+        """ KeyFetcher callback, run on the main loop. """
+        if not self.fetching:
+            # The user already cancelled
+            return False
+        self.fetch_result = (key, err)
+        self.set_fetching(False)
+        self.response(Gtk.ResponseType.ACCEPT)
+        return False
+
 
     def on_file_set(self, button):
         self.prime_buffer = button.get_filename()
@@ -28,7 +28,9 @@ from threading import Thread
 gi.require_version('Flatpak', '1.0')
 gi.require_version('Gtk', '3.0')
 gi.require_version('GdkPixbuf', '2.0')
-from gi.repository import GObject, Gio, Flatpak, GLib, GdkPixbuf, Gtk
+# Gtk and GdkPixbuf are imported where they're used, so that listing remotes
+# from the command line doesn't need a display.
+from gi.repository import GObject, Gio, Flatpak, GLib
 
 log = logging.getLogger('repoman.flatpak-helper')
 
@@ -58,6 +60,26 @@ def add_remote(widget, name, url, option):
     add_thread = AddThread(widget, name, url, option)
     add_thread.start()
 
+def add_remote_from_url(name, url, option):
+    """ Add a remote from a .flatpakrepo file, in the calling thread.
+
+    Arguments:
+        name (str): The internal name for the new remote.
+        url (str): The URL of the .flatpakrepo file.
+        option (str): The installation to add it to, 'user' or 'system'.
+    """
+    installation = get_installation_for_type(option)
+    repofile = Gio.File.new_for_uri(url)
+    log.debug('Loading file from %s', url)
+    a, contents, b = repofile.load_contents()
+    log.debug('File loaded')
+    repodata = GLib.Bytes.new(contents)
+
+    log.debug('Creating Remote Object for %s', name)
+    new_remote = Flatpak.Remote.new_from_file(name, repodata)
+    log.debug('Adding remote %s to %s', new_remote.get_name(), option)
+    installation.add_remote(new_remote, True, None)
+
 def delete_remote(widget, name, option):
     """ Deletes a remote from the installation of option.
 
@@ -155,6 +177,8 @@ def get_image_from_pixbuf(pixbuf):
     Returns:
         A `Gtk.Image` with the contents of the pixbuf.
     """
+    from gi.repository import Gtk
+
     image = Gtk.Image.new_from_pixbuf(pixbuf)
     image.set_margin_top(12)
     image.set_margin_bottom(12)
@@ -169,6 +193,8 @@ def get_icon_pixbuf(path):
     Returns:
         A `GdkPixbuf.Pixbuf` of the image at `path`.
     """
+    from gi.repository import GdkPixbuf
+
     try: 
         pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(
             str(path), 64, -1, True
@@ -432,23 +458,11 @@ class AddThread(Thread):
         self.option = option
 
     def run(self):
-        installation = get_installation_for_type(self.option)
-        repofile = Gio.File.new_for_uri(self.url)
         try:
-            log.debug('Loading file from %s', self.url)
-            a, contents, b = repofile.load_contents()
-            log.debug('File loaded')
-            repodata = GLib.Bytes.new(contents)
-            
-            log.debug('Creating Remote Object for %s', self.name)
-            new_remote = Flatpak.Remote.new_from_file(self.name, repodata)
-            log.debug('Adding remote %s to %s', new_remote.get_name(), self.option)
-            installation.add_remote(new_remote, True, None)
-        
+            add_remote_from_url(self.name, self.url, self.option)
         except GLib.Error as e:
             log.warning('Could not add flatpakrepo %s (%s)', self.url, e.args)
             self.throw_error(e, self.url)
-            contents = None
         
         GObject.idle_add(self.parent.parent.parent.stack.flatpak.generate_entries)
         GObject.idle_add(self.parent.parent.parent.stack.flatpak.view.set_sensitive, True)
@@ -472,6 +486,8 @@ class IconThread(Thread):
         self.log = logging.getLogger(f'repoman.{self.name}-icon')
 
     def run(self):
+        from gi.repository import Gtk
+
         installation = get_installation_for_type(self.option)
         remote = installation.get_remote_by_name(self.name)
         icon_url = remote.get_icon()
@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+'''
+   Copyright 2020 Ian Santopietro (ian@system76.com)
+
+   This file is part of Repoman.
+
+    Repoman is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Repoman is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Repoman.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# The client for repolib's privileged D-Bus helper. Nothing in here may load
+# Gtk. dbus itself is only imported once the helper is first needed.
+
+import logging
+import threading
+
+from .writer import thread_schedule
+
+HELPER_NAME = 'org.pop_os.repolib'
+HELPER_PATH = '/Repo'
+# Seconds without calls before the helper is told to exit
+IDLE_TIMEOUT = 60
+# Errors meaning the helper went away before it got the call, after which
+# the call is retried once. NoReply isn't one: the helper may have made the
+# call before the reply was lost, and calls like delete_source_file mustn't
+# be made twice.
+GONE_ERRORS = (
+    'org.freedesktop.DBus.Error.ServiceUnknown',
+    'org.freedesktop.DBus.Error.Disconnected',
+)
+
+class PrivilegedHelper:
+    """ A session-long connection to repolib's privileged helper.
+
+    The system bus connection and the proxy for the helper are made on the
+    first call and reused after that, so a run of calls activates (and
+    authorizes) the helper once. Once no call has been made for
+    `idle_timeout` seconds the helper is told to exit; the next call starts
+    it again.
+
+    Attributes:
+        schedule (function): Called as `schedule(delay, callback)` to arm
+            the idle timeout, returning a function which cancels it. The
+            GUI replaces it with one which runs on the GLib main loop.
+        calls (int): The number of calls made to the helper.
+        activations (int): The number of times a proxy was created.
+    """
+
+    def __init__(self, idle_timeout=IDLE_TIMEOUT, schedule=None):
+        self.log = logging.getLogger('repoman.PrivilegedHelper')
+        self.idle_timeout = idle_timeout
+        self.schedule = schedule or thread_schedule
+        self.lock = threading.RLock()
+        self.bus = None
+        self.proxy = None
+        self.calls = 0
+        self.activations = 0
+        self._cancel_idle = None
+
+    def _get_proxy(self):
+        if self.proxy is None:
+            if self.bus is None:
+                import dbus
+
+                self.bus = dbus.SystemBus()
+            self.proxy = self.bus.get_object(HELPER_NAME, HELPER_PATH)
+            self.activations += 1
+            self.log.debug('Connected to %s', HELPER_NAME)
+        return self.proxy
+
+    def _arm_idle(self):
+        if self._cancel_idle:
+            self._cancel_idle()
+        self._cancel_idle = self.schedule(
+            self.idle_timeout * 1000, self.on_idle
+        )
+
+    def _call(self, method, args):
+        try:
+            return getattr(self._get_proxy(), method)(*args)
+        except Exception as err:
+            name = getattr(err, 'get_dbus_name', lambda: None)()
+            if name not in GONE_ERRORS:
+                raise
+            self.log.debug('%s went away (%s), reconnecting', HELPER_NAME, name)
+            self.proxy = None
+            return getattr(self._get_proxy(), method)(*args)
+
+    def call(self, method, *args):
+        """ Call `method` on the helper.
+
+        Returns:
+            The value returned by the helper.
+        """
+        return self.batch([(method, args)])[0]
+
+    def batch(self, calls):
+        """ Make several calls to the helper, in order, over one proxy.
+
+        Arguments:
+            calls (list): (method, args) tuples.
+
+        Returns:
+            A list with the return value of each call.
+
+        Raises:
+            Exception: The first error raised by a call; the calls after it
+                are not made.
+        """
+        results = []
+        with self.lock:
+            try:
+                for method, args in calls:
+                    self.log.debug('Calling %s%s', method, tuple(args))
+                    self.calls += 1
+                    results.append(self._call(method, args))
+            finally:
+                self._arm_idle()
+        return results
+
+    def on_idle(self):
+        """ Let the helper exit once it hasn't been used for a while. """
+        self.close()
+        return False
+
+    def close(self):
+        """ Tell the helper to exit now, e.g. when quitting. """
+        with self.lock:
+            if self._cancel_idle:
+                self._cancel_idle()
+                self._cancel_idle = None
+            proxy, self.proxy = self.proxy, None
+            if proxy is None:
+                return
+            self.log.debug('Letting %s exit', HELPER_NAME)
+            try:
+                proxy.exit()
+            except Exception as err:
+                # It may have exited on its own already
+                self.log.debug('Could not stop %s: %s', HELPER_NAME, err)
@@ -0,0 +1,170 @@
+#!/usr/bin/python3
+'''
+   Copyright 2020 Ian Santopietro (ian@system76.com)
+
+   This file is part of Repoman.
+
+    Repoman is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Repoman is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Repoman.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import logging
+import threading
+
+log = logging.getLogger('repoman.Index')
+
+def get_key_path(source):
+    """ Get the path of the keyring a source is signed with.
+
+    Arguments:
+        source (:obj:`repolib.Source`): The source to check.
+
+    Returns:
+        The path as a str, or '' if the source has no key.
+    """
+    key = getattr(source, 'key', None)
+    if key and getattr(key, 'path', None):
+        return str(key.path)
+    try:
+        return str(source.signed_by or '')
+    except AttributeError:
+        return ''
+
+def get_file_name(source):
+    """ Get the name of the file a source is stored in, or ''."""
+    file = getattr(source, 'file', None)
+    if file and getattr(file, 'path', None):
+        return file.path.name
+    return ''
+
+class SourceIndex:
+    """ Lookup tables over the loaded sources.
+
+    Alongside the sources by ident, the index maps each URI, keyring path,
+    suite and file name to the set of idents which use it, so questions like
+    "is any other source signed with this key?" don't need to walk every
+    source. It is kept up to date as sources are added, edited and removed.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        """ Remove everything from the index. """
+        with self.lock:
+            self.sources = {}
+            self.by_uri = {}
+            self.by_key = {}
+            self.by_suite = {}
+            self.by_file = {}
+            # What each source was indexed under, so it can be removed again
+            # after the source object itself has been modified.
+            self._entries = {}
+
+    def __len__(self):
+        return len(self.sources)
+
+    def __contains__(self, ident):
+        return ident in self.sources
+
+    def build(self, sources):
+        """ Rebuild the index from scratch.
+
+        Arguments:
+            sources (dict): The loaded sources, keyed by ident.
+        """
+        with self.lock:
+            self.clear()
+            for source in sources.values():
+                self.add(source)
+        log.debug('Indexed %s sources', len(self.sources))
+
+    def add(self, source):
+        """ Add (or re-index) a source. """
+        with self.lock:
+            if source.ident in self.sources:
+                self.remove(source.ident)
+            try:
+                uris = list(source.uris)
+                suites = list(source.suites)
+            except AttributeError:
+                uris = []
+                suites = []
+            entries = (
+                (self.by_uri, uris),
+                (self.by_key, [get_key_path(source)]),
+                (self.by_suite, suites),
+                (self.by_file, [get_file_name(source)]),
+            )
+            self.sources[source.ident] = source
+            self._entries[source.ident] = entries
+            for table, values in entries:
+                for value in values:
+                    if value:
+                        table.setdefault(value, set()).add(source.ident)
+
+    def update(self, source):
+        """ Re-index a source after it was edited. """
+        self.add(source)
+
+    def remove(self, ident):
+        """ Remove the source `ident` from the index, if present. """
+        with self.lock:
+            self.sources.pop(ident, None)
+            for table, values in self._entries.pop(ident, ()):
+                for value in values:
+                    idents = table.get(value)
+                    if idents:
+                        idents.discard(ident)
+                        if not idents:
+                            del table[value]
+
+    def get(self, ident):
+        """ Get the source with `ident`, or None. """
+        return self.sources.get(ident)
+
+    def _lookup(self, table, value):
+        with self.lock:
+            return [self.sources[ident] for ident in table.get(value, ())]
+
+    def find_by_uri(self, uri):
+        """ Get a list of the sources which use `uri`. """
+        return self._lookup(self.by_uri, uri)
+
+    def find_by_key(self, key_path):
+        """ Get a list of the sources signed with the keyring `key_path`. """
+        return self._lookup(self.by_key, str(key_path))
+
+    def find_by_suite(self, suite):
+        """ Get a list of the sources which include `suite`. """
+        return self._lookup(self.by_suite, suite)
+
+    def find_by_file(self, file_name):
+        """ Get a list of the sources stored in the file `file_name`. """
+        return self._lookup(self.by_file, file_name)
+
+    def key_in_use(self, key_path, exclude=None):
+        """ Check whether a keyring is used by any source.
+
+        Arguments:
+            key_path (str): The path to the keyring.
+            exclude (str): The ident of a source to ignore, e.g. the one
+                which is having its key removed.
+
+        Returns:
+            `True` if another source is signed with the keyring.
+        """
+        with self.lock:
+            idents = self.by_key.get(str(key_path), set())
+            return bool(idents - {exclude})
@@ -0,0 +1,1220 @@
+#!/usr/bin/python3
+'''
+   Copyright 2020 Ian Santopietro (ian@system76.com)
+
+   This file is part of Repoman.
+
+    Repoman is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Repoman is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Repoman.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Fetching and importing signing keys. Nothing in here may load Gtk; results
+# are handed to a `dispatch` function, which the GUI sets to GLib.idle_add.
+
+from collections import deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import json
+import logging
+import os
+from pathlib import Path
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+import repolib
+
+from . import openpgp
+from .index import get_key_path
+from .cache import CACHE_DIR, file_stamp, write_cache_file
+from .writer import content_hash
+
+log = logging.getLogger('repoman.Keys')
+
+# Seconds to allow for fetching a key
+FETCH_TIMEOUT = 15
+# The number of keys to fetch at once, and from any one host
+FETCH_WORKERS = 8
+PER_HOST_FETCHES = 2
+CHUNK_SIZE = 16 * 1024
+USER_AGENT = 'repoman'
+# Seconds fetched keys are served from the cache before being fetched again
+KEY_CACHE_TTL = 7 * 24 * 60 * 60
+# A directory of keys to serve imports from, e.g. for offline image builds
+KEY_SEED_DIR = os.environ.get('REPOMAN_KEY_SEED', '')
+# The file in a seed directory mapping key URLs to the keyrings they serve
+SEED_URLS = 'urls.json'
+# How soon before a key expires to start warning about it
+EXPIRY_WARNING = timedelta(days=30)
+# The files in KEYS_DIR which are treated as keyrings
+KEYRING_PATTERNS = ('*.gpg', '*.asc', '*.pgp')
+
+class FetchCancelled(Exception):
+    """ Raised inside a key fetch which was cancelled. """
+
+def get_keyserver_url(fingerprint, keyserver=''):
+    """ Get the HKP lookup URL for a fingerprint on a keyserver.
+
+    Arguments:
+        fingerprint (str): The fingerprint of the key.
+        keyserver (str): The keyserver, as a host name or an hkp://,
+            hkps:// or https:// URL. Defaults to repolib's keyserver.
+
+    Returns:
+        The URL to fetch the ASCII-armored key from.
+    """
+    keyserver = keyserver or repolib.key.SKS_KEYSERVER
+    if '://' not in keyserver:
+        keyserver = f'hkps://{keyserver}'
+    parsed = urllib.parse.urlparse(keyserver)
+    if parsed.scheme == 'hkps':
+        base = f'https://{parsed.netloc}'
+    elif parsed.scheme == 'hkp':
+        port = parsed.port or 11371
+        base = f'http://{parsed.hostname}:{port}'
+    else:
+        base = f'{parsed.scheme}://{parsed.netloc}'
+    search = fingerprint.replace(' ', '')
+    if not search.startswith('0x'):
+        search = f'0x{search}'
+    query = urllib.parse.urlencode({'op': 'get', 'options': 'mr', 'search': search})
+    return f'{base}/pks/lookup?{query}'
+
+def get_key_url(key_type, key_data, key_options=''):
+    """ Get the URL a key has to be fetched from, or None for local keys. """
+    if key_type == 'fingerprint':
+        return get_keyserver_url(key_data, key_options)
+    if key_type == 'url':
+        return key_data
+    return None
+
+def fetch_url(url, timeout=FETCH_TIMEOUT, cancelled=None):
+    """ Download key material.
+
+    Arguments:
+        url (str): Where to get the key from.
+        timeout (float): Seconds to allow for the whole download.
+        cancelled (:obj:`threading.Event`): Set to abandon the download.
+
+    Returns:
+        The downloaded data as bytes.
+
+    Raises:
+        FetchCancelled: If `cancelled` was set.
+    """
+    cancelled = cancelled or threading.Event()
+    log.debug('Fetching key from %s', url)
+    request = urllib.request.Request(url, headers={'User-Agent': USER_AGENT})
+    start = time.monotonic()
+    chunks = []
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        while True:
+            if cancelled.is_set():
+                raise FetchCancelled()
+            if time.monotonic() - start > timeout:
+                raise TimeoutError(f'Timed out fetching {url}')
+            chunk = response.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    return b''.join(chunks)
+
+def normalize_fingerprint(fingerprint):
+    """ Get a fingerprint or key ID as upper-case hex without spaces. """
+    fingerprint = fingerprint.replace(' ', '').upper()
+    if fingerprint.startswith('0X'):
+        fingerprint = fingerprint[2:]
+    return fingerprint
+
+def get_fingerprints(armor):
+    """ Get the fingerprints of the primary keys in armored key data.
+
+    Raises:
+        ValueError: If the data isn't a valid keyring.
+    """
+    keys = openpgp.parse_keyring(armor.encode('utf-8'))
+    if not keys:
+        raise ValueError('No keys were found')
+    return [key.fingerprint for key in keys]
+
+class KeyResponseCache:
+    """ Key material fetched from keyservers and URLs, kept between runs.
+
+    Entries are keyed by the fingerprint or URL that was imported and hold
+    the armored key, the fingerprints in it and when it was fetched. They
+    are served for `ttl` seconds, and past that only if fetching again
+    fails. A cached key is always checked before it's used: it must still
+    parse, contain the same keys as when it was stored and the key the
+    import asked for. Any key fetched for a URL also serves later imports of
+    its fingerprint. URL imports which don't say which key they expect are
+    only served from the seeds, since nothing else could check the key.
+    The cache file is ignored unless it's owned by this user and only
+    writable by them, so a root process never trusts keys another user put
+    there.
+
+    The cache can be seeded from a directory of keyrings (binary or
+    armored). Seeded keys never expire. Fingerprint imports find them by
+    their fingerprints. URL imports find them by the full URL, if the
+    directory's `urls.json` maps it to the keyring's file name, or by the
+    fingerprint the caller expects the URL to serve.
+    """
+
+    def __init__(self, path=None, ttl=KEY_CACHE_TTL, seed_dir=None):
+        self.path = Path(path) if path else CACHE_DIR / 'key-responses.json'
+        self.log = logging.getLogger('repoman.KeyResponseCache')
+        self.ttl = ttl
+        self.seed_dir = seed_dir if seed_dir is not None else KEY_SEED_DIR
+        self.lock = threading.RLock()
+        self.entries = {}
+        self.seeded = set()
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self._loaded = False
+
+    def load(self):
+        """ Read the cache, starting afresh if it can't be read. """
+        try:
+            with open(self.path) as cache_file:
+                stat = os.fstat(cache_file.fileno())
+                if stat.st_uid != os.getuid() or stat.st_mode & 0o022:
+                    raise ValueError('Owned or writable by another user')
+                entries = json.load(cache_file)
+            if not isinstance(entries, dict):
+                raise ValueError('Not a mapping')
+        except FileNotFoundError:
+            entries = {}
+        except (OSError, ValueError) as err:
+            self.log.warning('Discarding key cache %s: %s', self.path, err)
+            entries = {}
+        with self.lock:
+            self._loaded = True
+            self.entries = entries
+            self.seeded = set()
+            self.dirty = False
+        if self.seed_dir:
+            try:
+                self.seed(self.seed_dir, save=False)
+            except (OSError, ValueError) as err:
+                self.log.warning('Could not seed keys from %s: %s', self.seed_dir, err)
+
+    def save(self):
+        """ Write the cache if it changed. """
+        with self.lock:
+            if not self.dirty:
+                return
+            data = json.dumps(self.entries, indent=2).encode()
+            self.dirty = False
+        try:
+            write_cache_file(self.path, data)
+        except OSError as err:
+            self.log.warning('Could not save key cache %s: %s', self.path, err)
+
+    def _ensure_loaded(self):
+        with self.lock:
+            if not self._loaded:
+                self.load()
+
+    def _get_key(self, key_type, key_data):
+        if key_type == 'fingerprint':
+            return f'fingerprint:{normalize_fingerprint(key_data)}'
+        return f'url:{key_data}'
+
+    def _verify(self, entry, fingerprint=None):
+        """ Check a cached entry still holds the keys it was stored with. """
+        try:
+            fingerprints = get_fingerprints(entry['armor'])
+        except (KeyError, ValueError) as err:
+            self.log.warning('Ignoring invalid cached key: %s', err)
+            return False
+        if sorted(fingerprints) != sorted(entry.get('fingerprints', ())):
+            self.log.warning('Ignoring cached key with changed contents')
+            return False
+        if fingerprint:
+            return any(fpr.endswith(fingerprint) for fpr in fingerprints)
+        return True
+
+    def _find(self, key_type, key_data, fingerprint=None):
+        """ Yield the entries which could answer an import. """
+        with self.lock:
+            cache_key = self._get_key(key_type, key_data)
+            entry = self.entries.get(cache_key)
+            if entry and (fingerprint or cache_key in self.seeded):
+                yield entry
+            if fingerprint:
+                for entry in list(self.entries.values()):
+                    if any(fpr.endswith(fingerprint)
+                           for fpr in entry.get('fingerprints', ())):
+                        yield entry
+
+    def get(self, key_type, key_data, allow_stale=False, now=None,
+            fingerprint=''):
+        """ Get cached key material for an import.
+
+        Arguments:
+            key_type (str): 'fingerprint' or 'url'.
+            key_data (str): The fingerprint or URL.
+            allow_stale (bool): Also return entries older than the TTL.
+            fingerprint (str): For URL imports, the fingerprint the key must
+                contain. Any cached key containing it can answer the import;
+                without it, only keys seeded for the URL can.
+
+        Returns:
+            The armored key as a str, or None.
+        """
+        if key_type == 'fingerprint':
+            fingerprint = key_data
+        fingerprint = normalize_fingerprint(fingerprint or '')
+        if fingerprint and len(fingerprint) < 16:
+            # Short key IDs are too easy to collide with
+            return None
+        self._ensure_loaded()
+        now = now or time.time()
+        for entry in self._find(key_type, key_data, fingerprint):
+            fresh = entry.get('seeded') or now - entry.get('fetched', 0) <= self.ttl
+            if not (fresh or allow_stale):
+                continue
+            if self._verify(entry, fingerprint):
+                self.hits += 1
+                self.log.debug('Using cached key for %s', key_data)
+                return entry['armor']
+        self.misses += 1
+        return None
+
+    def put(self, key_type, key_data, armor, now=None, fingerprint=''):
+        """ Store key material fetched for an import, and save the cache.
+
+        Arguments:
+            fingerprint (str): For URL imports, the fingerprint the key must
+                contain.
+
+        Raises:
+            ValueError: If the material isn't a valid key, or doesn't contain
+                the fingerprint which was asked for.
+        """
+        fingerprints = get_fingerprints(armor)
+        if key_type == 'fingerprint':
+            fingerprint = key_data
+        if fingerprint:
+            expected = normalize_fingerprint(fingerprint)
+            if not any(fpr.endswith(expected) for fpr in fingerprints):
+                raise ValueError(
+                    f'The key received does not match the fingerprint {fingerprint}'
+                )
+        self._ensure_loaded()
+        with self.lock:
+            self.entries[self._get_key(key_type, key_data)] = {
+                'armor': armor,
+                'fingerprints': fingerprints,
+                'fetched': now or time.time(),
+            }
+            self.dirty = True
+        self.save()
+
+    def seed(self, directory, save=True):
+        """ Add every keyring in `directory` to the cache.
+
+        Each keyring is stored under the fingerprints of its keys. If the
+        directory has a `urls.json` mapping key URLs to keyring file names,
+        those keyrings are stored under their URLs too.
+
+        Returns:
+            The number of keyrings added.
+
+        Raises:
+            ValueError: If `urls.json` isn't a mapping of URLs to file names.
+        """
+        directory = Path(directory)
+        urls = {}
+        try:
+            with open(directory / SEED_URLS) as urls_file:
+                urls = json.load(urls_file)
+        except FileNotFoundError:
+            pass
+        if not isinstance(urls, dict):
+            raise ValueError(f'{directory / SEED_URLS} is not a mapping')
+        by_name = {}
+        for url, name in urls.items():
+            by_name.setdefault(name, []).append(url)
+
+        count = 0
+        for path in sorted(directory.glob('*')):
+            if not path.is_file() or path.name == SEED_URLS:
+                continue
+            try:
+                armor = openpgp.enarmor(path.read_bytes())
+                fingerprints = get_fingerprints(armor)
+            except (OSError, ValueError) as err:
+                self.log.debug('Not seeding %s: %s', path, err)
+                continue
+            entry = {
+                'armor': armor,
+                'fingerprints': fingerprints,
+                'fetched': path.stat().st_mtime,
+                'seeded': True,
+            }
+            with self.lock:
+                for fingerprint in fingerprints:
+                    self.entries[f'fingerprint:{fingerprint}'] = entry
+                for url in by_name.pop(path.name, ()):
+                    self.entries[f'url:{url}'] = entry
+                    self.seeded.add(f'url:{url}')
+                self.dirty = True
+            count += 1
+        for name, missing in by_name.items():
+            self.log.warning('No keyring %s to seed %s', name, ', '.join(missing))
+        self.log.debug('Seeded %s keys from %s', count, directory)
+        if save:
+            self.save()
+        return count
+
+key_cache = KeyResponseCache()
+
+def fetch_key(key_type, key_data, key_options='', timeout=FETCH_TIMEOUT,
+              cancelled=None, fingerprint=''):
+    """ Get the armored key for a fingerprint or URL import.
+
+    Keys are served from `key_cache` when possible. Otherwise they're
+    downloaded and cached; if the download fails, a cached key past its
+    TTL is used instead. A URL import may give the `fingerprint` of the key
+    it expects, which the key is checked against.
+
+    Raises:
+        ValueError: If no key was found, or it doesn't match the fingerprint.
+    """
+    armor = key_cache.get(key_type, key_data, fingerprint=fingerprint)
+    if armor is not None:
+        return armor
+    url = get_key_url(key_type, key_data, key_options)
+    try:
+        armor = fetch_url(url, timeout, cancelled).decode('utf-8', 'replace')
+    except FetchCancelled:
+        raise
+    except Exception as err:
+        armor = key_cache.get(
+            key_type, key_data, allow_stale=True, fingerprint=fingerprint
+        )
+        if armor is None:
+            raise
+        log.warning('Could not fetch %s (%s), using the cached key', url, err)
+        return armor
+    if 'BEGIN PGP PUBLIC KEY BLOCK' not in armor:
+        raise ValueError(f'No key was found at {url}')
+    key_cache.put(key_type, key_data, armor, fingerprint=fingerprint)
+    return armor
+
+def _reuse_keyring(key, existing, reuse_path):
+    """ Make `key` use the existing keyring `existing`, if possible.
+
+    The key's own keyring becomes a hard link to `existing` when the keys
+    directory is writable. Otherwise (e.g. in the GUI, which runs
+    unprivileged) the key is pointed at `existing` itself, if `reuse_path`
+    allows it.
+
+    Returns:
+        `True` if the key now uses `existing`.
+    """
+    if key_store.link(existing, key.path):
+        return True
+    if not reuse_path:
+        return False
+    log.info('Using the existing keyring %s for %s', existing, key.path)
+    key.path = Path(existing)
+    return True
+
+def import_key(name, key_type, key_data, key_options='',
+               timeout=FETCH_TIMEOUT, cancelled=None, fingerprint='',
+               reuse_path=True):
+    """ Import a key into the keyring for `name`.
+
+    Remote keys come from `fetch_key`, which serves them from the key cache
+    or downloads them (with a timeout, and cancellably), and are handed to
+    repolib as ASCII armor, so repolib itself never waits on the network.
+    Keys which are already on the system reuse their keyring instead; see
+    `_reuse_keyring`. The source should then be signed with the returned
+    key's `path`, which may not be the keyring for `name`.
+
+    Arguments:
+        name (str): The name of the keyring, usually the source's ident.
+        key_type (str): One of 'fingerprint', 'url', 'ascii' or 'path'.
+        key_data (str): The fingerprint, URL, armored key or keyring path.
+        key_options (str): The keyserver, for fingerprints.
+        timeout (float): Seconds to allow for downloading the key.
+        cancelled (:obj:`threading.Event`): Set to abandon the import.
+        fingerprint (str): For URL imports, the fingerprint the key must
+            contain.
+        reuse_path (bool): Whether the key may be left at the path of an
+            existing keyring, rather than at its own.
+
+    Returns:
+        The :obj:`repolib.SourceKey`.
+
+    Raises:
+        FetchCancelled: If `cancelled` was set before the key was written.
+        ValueError: If the key data is missing or invalid.
+    """
+    cancelled = cancelled or threading.Event()
+    if not key_data:
+        raise ValueError(f'No {key_type} given for the key')
+    key = repolib.SourceKey(name=name)
+    if key_type == 'path':
+        # The keyring already exists and is used where it is
+        if not Path(key_data).exists():
+            raise ValueError(f'The keyring {key_data} does not exist')
+        return key
+    if key_type == 'fingerprint':
+        # No need to go to the keyserver for a key we already have
+        existing = key_store.find_by_fingerprint(key_data)
+        if existing and _reuse_keyring(key, existing, reuse_path):
+            return key
+    if key_type == 'ascii':
+        armor = key_data
+    else:
+        armor = fetch_key(
+            key_type, key_data, key_options, timeout, cancelled, fingerprint
+        )
+    if cancelled.is_set():
+        raise FetchCancelled()
+    try:
+        digest = content_hash(openpgp.dearmor(armor.encode('utf-8')))
+    except ValueError:
+        digest = None
+    existing = key_store.find_by_digest(digest) if digest else None
+    if existing and _reuse_keyring(key, existing, reuse_path):
+        return key
+    key.load_key_data(ascii=armor)
+    return key
+
+KeyringEntry = namedtuple(
+    'KeyringEntry', ['path', 'stamp', 'digest', 'fingerprints', 'keys']
+)
+KeyringEntry.__doc__ = """ A keyring indexed by the :obj:`KeyStore`.
+
+Attributes:
+    path (str): The path to the keyring.
+    stamp (tuple): The file's stamp when it was read, see `file_stamp`.
+    digest (str): The hash of the keyring's contents.
+    fingerprints (frozenset): The fingerprints of its primary keys.
+    keys (tuple): The :obj:`openpgp.KeyInfo` for each primary key.
+"""
+
+class KeyStore:
+    """ Index of the keyrings in the keys directory.
+
+    Keyrings are indexed by the hash of their contents and by the
+    fingerprints of the keys in them, so importing a key which is already on
+    the system can reuse the existing keyring instead of writing another
+    copy. Each keyring is only read again when its stamp changes, so
+    `refresh` costs a stat() per file.
+
+    Reused keyrings are hard links where possible: every source keeps its
+    own keyring name (and can remove it without affecting the others) while
+    the data is stored once. Making them needs write access to the keys
+    directory, which is owned by root, so only works when running as root
+    (e.g. `sudo repoman --compact-keys`). The GUI runs unprivileged, so it
+    signs new sources with the existing keyring's path instead.
+    """
+
+    def __init__(self, keys_dir=None):
+        self.log = logging.getLogger('repoman.KeyStore')
+        self._keys_dir = keys_dir
+        self.lock = threading.RLock()
+        self.entries = {}
+
+    @property
+    def keys_dir(self):
+        """ Path: The directory holding the keyrings. """
+        return Path(self._keys_dir or repolib.util.KEYS_DIR)
+
+    @property
+    def writable(self):
+        """ bool: Whether keyrings can be linked in the keys directory. """
+        return os.access(self.keys_dir, os.W_OK)
+
+    def _read(self, path, stamp):
+        try:
+            with open(path, 'rb') as keyring_file:
+                data = keyring_file.read()
+        except OSError as err:
+            self.log.debug('Could not read keyring %s: %s', path, err)
+            return None
+        try:
+            keys = tuple(openpgp.parse_keyring(data))
+        except ValueError as err:
+            self.log.debug('Could not parse keyring %s: %s', path, err)
+            keys = ()
+        return KeyringEntry(
+            str(path), stamp, content_hash(data),
+            frozenset(key.fingerprint for key in keys), keys
+        )
+
+    def refresh(self):
+        """ Bring the index in line with the keys directory.
+
+        Returns:
+            The list of :obj:`KeyringEntry` for every keyring.
+        """
+        paths = set()
+        for pattern in KEYRING_PATTERNS:
+            paths.update(str(path) for path in self.keys_dir.glob(pattern))
+        with self.lock:
+            for path in set(self.entries) - paths:
+                del self.entries[path]
+            for path in paths:
+                stamp = file_stamp(path)
+                entry = self.entries.get(path)
+                if entry and entry.stamp == stamp:
+                    continue
+                entry = self._read(path, stamp)
+                if entry:
+                    self.entries[path] = entry
+                else:
+                    self.entries.pop(path, None)
+            return list(self.entries.values())
+
+    def get(self, path):
+        """ Get the :obj:`KeyringEntry` for `path`, or None. """
+        path = str(path)
+        stamp = file_stamp(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and entry.stamp == stamp:
+                return entry
+            entry = self._read(path, stamp) if stamp else None
+            if entry:
+                self.entries[path] = entry
+            return entry
+
+    def find_by_digest(self, digest):
+        """ Get the path of a keyring with the contents hashing to `digest`.
+
+        Returns:
+            The path as a str, or None.
+        """
+        for entry in sorted(self.refresh()):
+            if entry.digest == digest:
+                return entry.path
+        return None
+
+    def find_by_fingerprint(self, fingerprint):
+        """ Get the path of a keyring holding only the key `fingerprint`.
+
+        Keyrings where the key has expired or been revoked are skipped, so
+        those get fetched again.
+
+        Returns:
+            The path as a str, or None.
+        """
+        fingerprint = normalize_fingerprint(fingerprint)
+        now = datetime.now(timezone.utc)
+        for entry in sorted(self.refresh()):
+            if len(entry.keys) != 1:
+                continue
+            key = entry.keys[0]
+            if key.revoked or (key.expires and key.expires <= now):
+                continue
+            # Short and long key IDs are suffixes of the fingerprint
+            if len(fingerprint) >= 16 and key.fingerprint.endswith(fingerprint):
+                return entry.path
+        return None
+
+    def duplicates(self):
+        """ Find keyrings which hold the same data in separate files.
+
+        Returns:
+            A list of lists of paths, one list per set of duplicates, each
+            sorted with the oldest keyring first.
+        """
+        groups = {}
+        for entry in self.refresh():
+            groups.setdefault(entry.digest, []).append(entry)
+        duplicates = []
+        for entries in groups.values():
+            # Files which are already links of each other don't count
+            inodes = {entry.stamp[2] for entry in entries}
+            if len(inodes) < 2:
+                continue
+            entries.sort(key=lambda entry: (entry.stamp[1], entry.path))
+            duplicates.append([entry.path for entry in entries])
+        return sorted(duplicates)
+
+    def link(self, existing, target):
+        """ Make `target` a hard link to the keyring `existing`.
+
+        Arguments:
+            existing (str): The keyring to reuse.
+            target (str): The keyring path to create or replace.
+
+        This needs write access to the directory of `target`; see the class
+        docs.
+
+        Returns:
+            `True` if `target` now shares the data of `existing`.
+        """
+        existing, target = str(existing), str(target)
+        if existing == target:
+            return True
+        temp = f'{target}.{os.getpid()}.tmp'
+        try:
+            if os.path.exists(target) and os.path.samefile(existing, target):
+                return True
+            if not os.access(os.path.dirname(target), os.W_OK):
+                self.log.debug(
+                    'Not linking %s to %s: its directory is not writable',
+                    target, existing
+                )
+                return False
+            os.link(existing, temp)
+            os.replace(temp, target)
+        except OSError as err:
+            self.log.debug('Could not link %s to %s: %s', target, existing, err)
+            if os.path.lexists(temp):
+                os.unlink(temp)
+            return False
+        self.log.info('Reusing keyring %s for %s', existing, target)
+        self.get(target)
+        return True
+
+    def compact(self, dry_run=False):
+        """ Merge duplicate keyrings into one copy each.
+
+        Every duplicate is replaced by a hard link to the oldest copy, so the
+        sources signed with them don't change.
+
+        Arguments:
+            dry_run (bool): Only report what would be merged.
+
+        Returns:
+            A list of (kept, merged) tuples, where `merged` is the list of
+            paths which now (or would) share the data of `kept`.
+
+        Raises:
+            PermissionError: If the keys directory isn't writable, unless
+                this is a dry run.
+        """
+        if not dry_run and not self.writable:
+            raise PermissionError(
+                f'{self.keys_dir} is not writable; run this as root'
+            )
+        results = []
+        for paths in self.duplicates():
+            kept, others = paths[0], paths[1:]
+            merged = [
+                path for path in others
+                if dry_run or self.link(kept, path)
+            ]
+            if merged:
+                results.append((kept, merged))
+        return results
+
+key_store = KeyStore()
+
+def _key_to_dict(key):
+    return {
+        'fingerprint': key.fingerprint,
+        'created': key.created.timestamp(),
+        'expires': key.expires.timestamp() if key.expires else None,
+        'uids': list(key.uids),
+        'revoked': key.revoked,
+    }
+
+def _key_from_dict(item):
+    expires = item.get('expires')
+    return openpgp.KeyInfo(
+        item['fingerprint'],
+        datetime.fromtimestamp(item['created'], timezone.utc),
+        datetime.fromtimestamp(expires, timezone.utc) if expires else None,
+        tuple(item.get('uids', ())),
+        item.get('revoked', False)
+    )
+
+class KeyInfoCache:
+    """ What is in each keyring, kept between runs.
+
+    Entries are keyed by keyring path and hold the file's stamp along with
+    the fingerprint, user IDs, creation and expiry dates of each key, or the
+    error the keyring gave. An entry is only used while the stamp still
+    matches, so a replaced keyring is read again. Keyrings are parsed with
+    :mod:`openpgp`, never gpg.
+    """
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path else CACHE_DIR / 'keys.json'
+        self.log = logging.getLogger('repoman.KeyInfoCache')
+        self.lock = threading.RLock()
+        self.entries = {}
+        self.dirty = False
+        self.executor = None
+        self._loaded = False
+
+    def load(self):
+        """ Read the cache, starting afresh if it can't be read. """
+        try:
+            with open(self.path) as cache_file:
+                entries = json.load(cache_file)
+            if not isinstance(entries, dict):
+                raise ValueError('Not a mapping')
+        except FileNotFoundError:
+            entries = {}
+        except (OSError, ValueError) as err:
+            self.log.warning('Discarding key cache %s: %s', self.path, err)
+            entries = {}
+        with self.lock:
+            self._loaded = True
+            self.entries = entries
+            self.seeded = set()
+            self.dirty = False
+
+    def save(self):
+        """ Write the cache if it changed. """
+        with self.lock:
+            if not self.dirty:
+                return
+            data = json.dumps(self.entries, indent=2).encode()
+            self.dirty = False
+        try:
+            write_cache_file(self.path, data)
+        except OSError as err:
+            self.log.warning('Could not save key cache %s: %s', self.path, err)
+
+    def _get_entry(self, path, stamp):
+        with self.lock:
+            if not self._loaded:
+                self.load()
+            entry = self.entries.get(path)
+        if entry and stamp and entry.get('stamp') == list(stamp):
+            return entry
+        return None
+
+    def get(self, path):
+        """ Get the cached keys in the keyring `path`, without reading it.
+
+        Returns:
+            A list of :obj:`openpgp.KeyInfo`, or None if the keyring isn't
+            cached (or changed since).
+
+        Raises:
+            ValueError: If the keyring couldn't be parsed last time.
+        """
+        path = str(path)
+        entry = self._get_entry(path, file_stamp(path))
+        if entry is None:
+            return None
+        if entry.get('error'):
+            raise ValueError(entry['error'])
+        return [_key_from_dict(item) for item in entry['keys']]
+
+    def update(self, path):
+        """ Read the keyring `path` and cache what is in it.
+
+        Returns:
+            `True` if the entry changed.
+        """
+        path = str(path)
+        stamp = file_stamp(path)
+        if self._get_entry(path, stamp):
+            return False
+        if stamp is None:
+            with self.lock:
+                if self.entries.pop(path, None) is not None:
+                    self.dirty = True
+            return False
+        entry = {'stamp': list(stamp)}
+        try:
+            entry['keys'] = [
+                _key_to_dict(key) for key in openpgp.read_keyring(path)
+            ]
+        except (OSError, ValueError) as err:
+            self.log.debug('Could not read keyring %s: %s', path, err)
+            entry['error'] = str(err)
+        with self.lock:
+            self.entries[path] = entry
+            self.dirty = True
+        return True
+
+    def lookup(self, path):
+        """ Get the keys in the keyring `path`, reading it if needed.
+
+        Returns:
+            A list of :obj:`openpgp.KeyInfo`.
+
+        Raises:
+            FileNotFoundError: If there is no keyring at `path`.
+            ValueError: If the keyring can't be parsed.
+        """
+        keys = self.get(path)
+        if keys is None:
+            if file_stamp(path) is None:
+                raise FileNotFoundError(f'The keyring {path} does not exist')
+            if self.update(path):
+                self.save()
+            keys = self.get(path)
+        return keys or []
+
+    def refresh(self, paths):
+        """ Bring the entries for `paths` up to date, then save the cache.
+
+        Entries for keyrings which no longer exist are dropped.
+        """
+        paths = {str(path) for path in paths if path}
+        changed = 0
+        for path in sorted(paths):
+            changed += self.update(path)
+        with self.lock:
+            for path in list(self.entries):
+                if path not in paths and not os.path.exists(path):
+                    del self.entries[path]
+                    self.dirty = True
+        self.log.debug('Refreshed key info for %s keyrings (%s changed)',
+                       len(paths), changed)
+        self.save()
+
+    def refresh_in_background(self, paths):
+        """ Run `refresh` on a background thread.
+
+        Returns:
+            A :obj:`concurrent.futures.Future` for the refresh.
+        """
+        return self.submit(self.refresh, list(paths))
+
+    def submit(self, function, *args):
+        """ Run `function(*args)` on the cache's background thread.
+
+        Jobs run one at a time, in order, so a refresh and an audit never
+        read the same keyrings at once.
+
+        Returns:
+            A :obj:`concurrent.futures.Future` for the job.
+        """
+        if not self.executor:
+            self.executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='repoman-keyinfo'
+            )
+        return self.executor.submit(function, *args)
+
+key_info = KeyInfoCache()
+
+KeyIssue = namedtuple('KeyIssue', ['kind', 'severity', 'path', 'idents', 'detail'])
+KeyIssue.__doc__ = """ A problem found by `audit_keys`.
+
+Attributes:
+    kind (str): One of 'missing', 'unreadable', 'empty', 'revoked',
+        'expired', 'expiring', 'unused' or 'shared'.
+    severity (str): 'error', 'warning' or 'info'.
+    path (str): The keyring involved.
+    idents (tuple): The sources affected, if any.
+    detail (str): A description of the problem.
+"""
+
+class KeyAudit:
+    """ The result of auditing the keyrings of the loaded sources.
+
+    Attributes:
+        issues (list): The :obj:`KeyIssue` found.
+        keyrings (int): The number of keyrings checked.
+        elapsed (float): Seconds the audit took.
+        results (dict): The (keys, error, inode) read for each keyring, by
+            path, for later audits to reuse.
+        source_keys (dict): The keyring used by each source, by ident.
+    """
+
+    severities = ('error', 'warning', 'info')
+
+    def __init__(self, issues, keyrings, elapsed, results=None,
+                 source_keys=None):
+        self.issues = issues
+        self.keyrings = keyrings
+        self.elapsed = elapsed
+        self.results = results or {}
+        self.source_keys = source_keys or {}
+        self.by_ident = {}
+        for issue in issues:
+            for ident in issue.idents:
+                self.by_ident.setdefault(ident, []).append(issue)
+
+    def __len__(self):
+        return len(self.issues)
+
+    def get(self, ident):
+        """ Get the issues affecting the source `ident`. """
+        return list(self.by_ident.get(ident, ()))
+
+    def get_severity(self, ident):
+        """ Get the most severe issue level for `ident`, or None. """
+        levels = {issue.severity for issue in self.by_ident.get(ident, ())}
+        for severity in self.severities:
+            if severity in levels:
+                return severity
+        return None
+
+def _read_keys(cache, path):
+    """ Get (keys, error, inode) for a keyring, through the cache. """
+    try:
+        stat = os.stat(path)
+        inode = (stat.st_dev, stat.st_ino)
+    except OSError:
+        inode = path
+    try:
+        cache.update(path)
+        keys = cache.get(path)
+    except ValueError as err:
+        return None, err, inode
+    if keys is None:
+        err = FileNotFoundError(f'The keyring {path} does not exist')
+        return None, err, inode
+    return keys, None, inode
+
+def audit_keys(sources, keys_dir=None, cache=None, workers=FETCH_WORKERS,
+               warning=EXPIRY_WARNING, now=None, previous=None, changed=None):
+    """ Check the keyrings used by `sources` and those in the keys directory.
+
+    Keyrings are read through the key cache on a pool of threads, so only
+    the ones which changed since the last run are parsed. Given a `previous`
+    audit and the idents which `changed` since, only the keyrings those
+    sources use (or used) are read again; the rest are taken from `previous`.
+
+    Arguments:
+        sources (dict): The sources to check, by ident.
+        keys_dir (str): The keys directory; defaults to repolib's KEYS_DIR.
+        cache (:obj:`KeyInfoCache`): The cache to read keyrings through.
+        workers (int): The number of keyrings to read at once.
+        warning (:obj:`timedelta`): How soon an expiry is warned about.
+        now (:obj:`datetime`): The time to check expiry against.
+        previous (:obj:`KeyAudit`): An earlier audit to update.
+        changed (set): The idents of the sources added, changed or removed
+            since `previous`.
+
+    Returns:
+        A :obj:`KeyAudit`.
+    """
+    start = time.monotonic()
+    cache = cache or key_info
+    now = now or datetime.now(timezone.utc)
+    keys_dir = Path(keys_dir or repolib.util.KEYS_DIR)
+
+    users = {}
+    source_keys = {}
+    for ident, source in sources.items():
+        path = get_key_path(source)
+        if path:
+            users.setdefault(path, []).append(ident)
+            source_keys[ident] = path
+
+    if previous is None or changed is None:
+        results = {}
+        paths = set(users)
+        for pattern in KEYRING_PATTERNS:
+            paths.update(str(path) for path in keys_dir.glob(pattern))
+    else:
+        results = dict(previous.results)
+        paths = {
+            used.get(ident)
+            for used in (source_keys, previous.source_keys)
+            for ident in changed
+        }
+        paths.discard(None)
+    paths = sorted(paths)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results.update(zip(
+            paths, pool.map(lambda path: _read_keys(cache, path), paths)
+        ))
+    cache.save()
+
+    issues = []
+    by_fingerprint = {}
+    inodes = {}
+    for path, (keys, err, inode) in sorted(results.items()):
+        idents = tuple(sorted(users.get(path, ())))
+        if isinstance(err, FileNotFoundError) and not idents:
+            # A keyring deleted along with the last source using it
+            del results[path]
+            continue
+        if err:
+            kind = 'missing' if isinstance(err, FileNotFoundError) else 'unreadable'
+            issues.append(KeyIssue(kind, 'error', path, idents, str(err)))
+            continue
+        if not idents:
+            issues.append(KeyIssue(
+                'unused', 'info', path, (), 'No source is signed with this keyring'
+            ))
+            continue
+        if not keys:
+            issues.append(KeyIssue(
+                'empty', 'error', path, idents, 'The keyring contains no keys'
+            ))
+        inodes[path] = inode
+        for key in keys:
+            key_paths, key_idents = by_fingerprint.setdefault(
+                key.fingerprint, (set(), set())
+            )
+            key_paths.add(path)
+            key_idents.update(idents)
+            if key.revoked:
+                issues.append(KeyIssue(
+                    'revoked', 'error', path, idents,
+                    f'{key.fingerprint} has been revoked'
+                ))
+            elif key.expires and key.expires <= now:
+                issues.append(KeyIssue(
+                    'expired', 'error', path, idents,
+                    f'{key.fingerprint} expired on {key.expires:%Y-%m-%d}'
+                ))
+            elif key.expires and key.expires - now <= warning:
+                issues.append(KeyIssue(
+                    'expiring', 'warning', path, idents,
+                    f'{key.fingerprint} expires on {key.expires:%Y-%m-%d}'
+                ))
+
+    for path, idents in users.items():
+        if len(idents) > 1:
+            issues.append(KeyIssue(
+                'shared', 'info', path, tuple(sorted(idents)),
+                f'Used by {len(idents)} sources'
+            ))
+    for fingerprint, (key_paths, idents) in by_fingerprint.items():
+        # Hard links of one keyring (see `KeyStore.compact`) are one copy
+        copies = {inodes[path] for path in key_paths}
+        if len(copies) > 1:
+            issues.append(KeyIssue(
+                'shared', 'info', ' '.join(sorted(key_paths)),
+                tuple(sorted(idents)),
+                f'{fingerprint} is in {len(copies)} keyrings'
+            ))
+
+    elapsed = time.monotonic() - start
+    log.debug('Audited %s keyrings (%s read) in %.3fs: %s issues',
+              len(results), len(paths), elapsed, len(issues))
+    return KeyAudit(issues, len(results), elapsed, results, source_keys)
+
+class KeyFetch:
+    """ A key import running in the background.
+
+    Attributes:
+        future (:obj:`concurrent.futures.Future`): Resolves to the
+            :obj:`repolib.SourceKey` once the import finishes.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.cancelled = threading.Event()
+        self.future = Future()
+
+    @property
+    def done(self):
+        """ bool: Whether the import finished or was cancelled. """
+        return self.cancelled.is_set() or self.future.done()
+
+    def cancel(self):
+        """ Abandon the import; its callback won't be called. """
+        self.cancelled.set()
+        self.future.cancel()
+
+    def result(self, timeout=None):
+        """ Wait for the import and return the :obj:`repolib.SourceKey`. """
+        return self.future.result(timeout=timeout)
+
+class KeyFetcher:
+    """ Imports keys on a pool of threads.
+
+    Fetches run concurrently, but no more than `per_host` at a time go to
+    any one host, so a bulk import doesn't hammer a single keyserver. Fetches
+    over the limit wait in a queue for their host without tying up a thread.
+    """
+
+    def __init__(self, workers=FETCH_WORKERS, per_host=PER_HOST_FETCHES,
+                 timeout=FETCH_TIMEOUT, dispatch=None):
+        self.log = logging.getLogger('repoman.KeyFetcher')
+        self.timeout = timeout
+        self.per_host = per_host
+        self.dispatch = dispatch or (lambda callback, *args: callback(*args))
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='repoman-keys'
+        )
+        self.lock = threading.Lock()
+        self.active = {}
+        self.waiting = {}
+
+    def fetch(self, name, key_type, key_data, key_options='', callback=None,
+              fingerprint='', reuse_path=True):
+        """ Start importing a key.
+
+        Arguments:
+            name (str): The name of the keyring.
+            key_type (str): One of 'fingerprint', 'url', 'ascii' or 'path'.
+            key_data (str): The fingerprint, URL, armored key or path.
+            key_options (str): The keyserver, for fingerprints.
+            callback (function): Dispatched as `callback(key, err)` when the
+                import finishes, unless it was cancelled.
+            fingerprint (str): For URL imports, the fingerprint the key must
+                contain.
+            reuse_path (bool): Whether the key may be left at the path of an
+                existing keyring; see `import_key`.
+
+        Returns:
+            A :obj:`KeyFetch` handle.
+        """
+        fetch = KeyFetch(name)
+        self.log.debug('Fetching %s key for %s', key_type, name)
+        url = get_key_url(key_type, key_data, key_options)
+        host = urllib.parse.urlparse(url).netloc if url else ''
+        job = (
+            fetch, host, key_type, key_data, key_options, fingerprint,
+            reuse_path
+        )
+
+        def done(future):
+            if future.cancelled() or fetch.cancelled.is_set():
+                return
+            err = future.exception()
+            if err:
+                self.log.error('Could not import key %s: %s', name, err)
+            if callback:
+                self.dispatch(callback, None if err else future.result(), err)
+
+        fetch.future.add_done_callback(done)
+        with self.lock:
+            if host and self.active.get(host, 0) >= self.per_host:
+                self.waiting.setdefault(host, deque()).append(job)
+                return fetch
+            self.active[host] = self.active.get(host, 0) + 1
+        self.executor.submit(self._run, *job)
+        return fetch
+
+    def _run(self, fetch, host, key_type, key_data, key_options, fingerprint,
+             reuse_path):
+        try:
+            if fetch.future.set_running_or_notify_cancel():
+                try:
+                    key = import_key(
+                        fetch.name, key_type, key_data, key_options,
+                        self.timeout, fetch.cancelled, fingerprint, reuse_path
+                    )
+                except Exception as err:
+                    fetch.future.set_exception(err)
+                else:
+                    fetch.future.set_result(key)
+        finally:
+            # Hand this host's slot to the next fetch waiting for it
+            with self.lock:
+                waiting = self.waiting.get(host)
+                job = waiting.popleft() if waiting else None
+                if not job:
+                    self.active[host] -= 1
+            if job:
+                self.executor.submit(self._run, *job)
+
+# Imports keys in the background for the GUI and for bundles. The GUI
+# dispatches its callbacks onto the main loop.
+key_fetcher = KeyFetcher()
@@ -24,9 +24,10 @@ import logging
 
 import gi
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk, Gio
+from gi.repository import Gtk, GLib
 
 from . import repo
+from .keys import audit_keys, key_info
 from .dialog import AddDialog, DeleteDialog, EditDialog, ErrorDialog
 
 class List(Gtk.Box):
@@ -36,6 +37,7 @@ class List(Gtk.Box):
     def __init__(self, parent):
         Gtk.Box.__init__(self, False, 0)
         self.parent = parent
+        self.store = parent.store
 
         self.settings = Gtk.Settings()
 
@@ -70,13 +72,20 @@ class List(Gtk.Box):
         Gtk.StyleContext.add_class(list_window.get_style_context(), "list_window")
         list_grid.attach(list_window, 0, 0, 1, 1)
 
-        self.ppa_liststore = Gtk.ListStore(str, str, str)
+        # Columns: name markup, URI, ident, enabled, key badge icon, tooltip
+        self.ppa_liststore = Gtk.ListStore(str, str, str, bool, str, str)
         self.view = Gtk.TreeView(self.ppa_liststore)
         renderer = Gtk.CellRendererText()
         name_column = Gtk.TreeViewColumn(_("Source"), renderer, markup=0)
         self.view.append_column(name_column)
         uri_column = Gtk.TreeViewColumn(_('URI'), renderer, markup=1)
         self.view.append_column(uri_column)
+        badge_renderer = Gtk.CellRendererPixbuf()
+        key_column = Gtk.TreeViewColumn(_('Key'), badge_renderer, icon_name=4)
+        self.view.append_column(key_column)
+        self.view.set_tooltip_column(5)
+        self.key_audit = None
+        self.last_audit = None
         self.view.set_hexpand(True)
         self.view.set_vexpand(True)
         self.tree_selection = self.view.get_selection()
@@ -119,13 +128,15 @@ class List(Gtk.Box):
         action_bar.insert(self.add_button, 0)
         list_grid.attach(action_bar, 0, 1, 1, 1)
 
-        # Watch the config directory for changes, so we can reload if so
-        self.file = Gio.File.new_for_path('/etc/apt/sources.list.d/')
-        self.monitor = self.file.monitor_directory(Gio.FileMonitorFlags.NONE)
-        self.monitor.connect('changed', self.on_config_changed)
-        self.log.debug('Monitor Created: %s', self.monitor)
+        # Update whenever the sources change
+        self.store.subscribe(self.on_config_changed)
 
-        self.generate_entries()
+        # Shown until the sources finish loading in the background
+        self.ppa_liststore.insert_with_valuesv(
+            -1,
+            [0, 1, 2, 3, 4, 5],
+            [_('<i>Loading sources…</i>'), '', '', True, '', '']
+        )
     
     def on_delete_button_clicked(self, widget):
         selec = self.view.get_selection()
@@ -136,44 +147,43 @@ class List(Gtk.Box):
         self.do_delete(repo_name)
     
     def do_delete(self, repo_name):
-        file = repo.sources[repo_name].file
-        source = file.get_source_by_ident(repo_name)
+        source = self.store.get(repo_name)
         dialog = DeleteDialog(self.parent.parent, source.name)
         response = dialog.run()
+        dialog.destroy()
 
+        # We don't remove the source if the user clicks "Cancel", but that
+        # was intentional so there's no error to show.
         if response == Gtk.ResponseType.OK:
             self.add_button.set_sensitive(False)
             self.edit_button.set_sensitive(False)
             self.delete_button.set_sensitive(False)
-            dialog.destroy()
             try:
-                file.remove_source(repo_name)
-                file.save()
-                repo.load_all_sources()
-                self.generate_entries()
-                success = True
-            except:
-                success = False
-            
-        else:
-            dialog.destroy()
-            # We didn't remove the source... but that was intentional. 
-            # Don't display an error if the user clicks "Cancel"
-            success = True
-        
-        if not success:
-            error_dialog = Gtk.MessageDialog(
-                transient_for=self.parent.parent,
-                flags=0,
-                message_type=Gtk.MessageType.ERROR,
-                buttons=Gtk.ButtonsType.CANCEL,
-                text="Could not remove source",
-            )
-            error_dialog.format_secondary_text(
-                f"The source {repo_name} could not be removed."
-            )
-            error_dialog.run()
-            error_dialog.destroy()
+                self.store.remove_source(
+                    repo_name,
+                    callback=lambda file, err: self.on_source_removed(repo_name, err)
+                )
+            except Exception as err:
+                self.on_source_removed(repo_name, err)
+
+    def on_source_removed(self, repo_name, err):
+        """ Writer callback for a source removal. """
+        self.add_button.set_sensitive(True)
+        if not err:
+            return
+        self.log.error('Could not remove source %s: %s', repo_name, err)
+        error_dialog = Gtk.MessageDialog(
+            transient_for=self.parent.parent,
+            flags=0,
+            message_type=Gtk.MessageType.ERROR,
+            buttons=Gtk.ButtonsType.CANCEL,
+            text="Could not remove source",
+        )
+        error_dialog.format_secondary_text(
+            f"The source {repo_name} could not be removed."
+        )
+        error_dialog.connect('response', lambda dialog, response: dialog.destroy())
+        error_dialog.show()
 
     def on_edit_button_clicked(self, widget):
         selec = self.view.get_selection()
@@ -184,7 +194,7 @@ class List(Gtk.Box):
         if ident == 'x-repoman-legacy-sources':
             repo.edit_system_legacy_sources_list()
         else:
-            source = repo.sources[ident]
+            source = self.store.get(ident)
             self.do_edit(source)
     
     def edit_sources_list(self):
@@ -213,101 +223,54 @@ class List(Gtk.Box):
             dialog.content_stack.set_visible_child_name('key')
         response = dialog.run()
 
-        if response == Gtk.ResponseType.OK:
-            try:
-                file = source.file
-                out_source = file.get_source_by_ident(source.ident)
-                self.sync_source(out_source, dialog)
-                self.log.debug('Saving new source %s', source)
-                out_source.save()
-                self.log.debug('Source saved')
-            except Exception as err:
-                self.log.error(
-                    'Could not edit mirror %s: %s', source.ident, str(err)
-                )
-                err_dialog = repo.get_error_messagedialog(
-                    self.parent.parent,
-                    f'Could not save source',
-                    err,
-                    f'{source.name} could not be saved'
-                )
-                err_dialog.run()
-                err_dialog.destroy()
-        elif response == Gtk.ResponseType.APPLY:
+        if response in (
+            Gtk.ResponseType.OK,
+            Gtk.ResponseType.APPLY,
+            Gtk.ResponseType.REJECT
+        ):
             try:
                 file = source.file
                 out_source = file.get_source_by_ident(source.ident)
                 self.sync_source(out_source, dialog)
-                if dialog.keytype == 'path':
-                    out_source.signed_by = dialog.key_data
-                else:
-                    out_source.key = dialog.key
-                    out_source.signed_by = str(out_source.key.path)
                 self.log.debug('Saving new source %s', source)
-                out_source.save()
-                self.log.debug('Source saved')
-            except Exception as err:
-                self.log.error(
-                    'Could not edit mirror %s: %s', source.ident, str(err)
-                )
-                err_dialog = repo.get_error_messagedialog(
-                    self.parent.parent,
-                    f'Could not save source',
-                    err,
-                    f'{source.name} could not be saved'
-                )
-                err_dialog.run()
-                err_dialog.destroy()
-        elif response == Gtk.ResponseType.REJECT:
-            try:
-                file = source.file
-                out_source = file.get_source_by_ident(source.ident)
-                self.sync_source(out_source, dialog)
-                old_key = out_source.key
-                out_source.key = None
-                out_source.signed_by = ''
-                multi_key: bool = False
-                for other_source in repo.sources.values():
-                    if other_source.ident == out_source.ident:
-                        continue
-                    if other_source.key == old_key:
-                        self.log.debug(
-                            'Found key in use with %s', other_source.ident
+                callback = lambda file, err: self.on_source_saved(source, err)
+                if response == Gtk.ResponseType.APPLY:
+                    if dialog.keytype == 'path':
+                        self.store.set_source_key(
+                            out_source, key_path=dialog.key_data,
+                            callback=callback
                         )
-                        multi_key = True
-                        break
-                if multi_key:
-                    self.log.info(
-                        'Key file %s in use with another key, not deleting',
-                        old_key.path
-                    )
+                    else:
+                        self.store.set_source_key(
+                            out_source, key=dialog.key, callback=callback
+                        )
+                elif response == Gtk.ResponseType.REJECT:
+                    self.store.remove_source_key(out_source, callback=callback)
                 else:
-                    self.log.warning(
-                        'No other source found using the key %s, deleting',
-                        old_key.path
-                    )
-                    old_key.delete_key()
-                self.log.debug('Saving new source %s', source)
-                out_source.save()
-                self.log.debug('Source saved')
+                    self.store.save_source(out_source, callback=callback)
             except Exception as err:
-                self.log.error(
-                    'Could not edit mirror %s: %s', source.ident, str(err)
-                )
-                err_dialog = repo.get_error_messagedialog(
-                    self.parent.parent,
-                    f'Could not save source',
-                    err,
-                    f'{source.name} could not be saved'
-                )
-                err_dialog.run()
-                err_dialog.destroy()
+                self.on_source_saved(source, err)
         else:
             self.log.debug('Cancelling edit')
 
         self.log.debug('New source: %s', dialog.source)
         dialog.destroy()
 
+    def on_source_saved(self, source, err):
+        """ Writer callback for an edited source. """
+        if not err:
+            self.log.debug('Source saved')
+            return
+        self.log.error(
+            'Could not edit mirror %s: %s', source.ident, str(err)
+        )
+        repo.show_error_messagedialog(
+            self.parent.parent,
+            f'Could not save source',
+            err,
+            f'{source.name} could not be saved'
+        )
+
     def on_add_button_clicked(self, widget):
         dialog = AddDialog(self.parent.parent)
         response = dialog.run()
@@ -326,54 +289,165 @@ class List(Gtk.Box):
 
     def generate_entries(self, *args, **kwargs):
         self.log.debug('Generating list of repos')
-        repo.load_all_sources()
         self.ppa_liststore.clear()
 
-        for i in repo.sources:
+        for i in self.store.sources:
             self.log.debug('Source: %s', i)
 
         
         # Print a warning to console about source file errors.
-        if repo.errors:
+        if self.store.errors:
             err_string = 'The following source files have errors:\n\n'
-            for file in repo.errors:
+            for file in self.store.errors:
                 err_string += f'{file}\n'
             self.log.warning(err_string)
 
-        # self.log.debug('Sources found:\n%s', repo.sources)
-        for i in repo.sources:
+        # self.log.debug('Sources found:\n%s', self.store.sources)
+        rows = []
+        for i in self.store.sources:
             if i == 'system':
                 continue
-            source = repo.sources[i]
-            try:
-                if source.enabled.get_bool():
-                    self.log.debug('Source: %s, URIs: %s', source.name, source.uris[0])
-                    self.ppa_liststore.insert_with_valuesv(
-                        -1,
-                        [0, 1, 2],
-                        [f'<b>{source.name}</b>', source.uris[0], source.ident]
-                    )
-            except AttributeError:
-                # Skip any weirdly malformed sources
-                pass
-
-        for i in repo.sources:
-            source = repo.sources[i]
-            try:
-                if not source.enabled.get_bool(): 
-                    self.ppa_liststore.insert_with_valuesv(
-                        -1,
-                        [0, 1, 2],
-                        [source.name, source.uris[0], source.ident]
-                    )
-            except AttributeError:
-                pass
+            values = self.get_row_values(self.store.sources[i])
+            if values:
+                rows.append(values)
+
+        # Enabled sources are listed first, then disabled ones.
+        for values in rows:
+            if values[3]:
+                self.add_row(values, -1)
+        for values in rows:
+            if not values[3]:
+                self.add_row(values, -1)
             
         self.add_button.set_sensitive(True)
+        self.audit_keys()
+
+    def get_row_values(self, source):
+        """ Get the values for a list row representing `source`.
+
+        Returns:
+            A list of the column values, or None if the source is malformed.
+        """
+        try:
+            enabled = source.enabled.get_bool()
+            name = source.name
+            if enabled:
+                name = f'<b>{source.name}</b>'
+            uri = source.uris[0]
+        except (AttributeError, IndexError):
+            # Skip any weirdly malformed sources
+            return None
+        self.log.debug('Source: %s, URIs: %s', source.name, uri)
+        badge, tooltip = self.get_key_badge(source.ident)
+        return [name, uri, source.ident, enabled, badge, tooltip]
+
+    def get_key_badge(self, ident):
+        """ Get the (icon name, tooltip) showing key problems for `ident`. """
+        if not self.key_audit:
+            return '', ''
+        severity = self.key_audit.get_severity(ident)
+        tooltip = '\n'.join(
+            issue.detail for issue in self.key_audit.get(ident)
+        )
+        if severity == 'error':
+            return 'dialog-error-symbolic', tooltip
+        if severity == 'warning':
+            return 'dialog-warning-symbolic', tooltip
+        return '', tooltip
+
+    def audit_keys(self, delta=None):
+        """ Check the keys of the sources in the background.
+
+        Arguments:
+            delta (:obj:`repo.SourceDelta`): If given, only the keys of the
+                sources which changed are checked again.
+        """
+        sources = dict(self.store.sources)
+        changed = None
+        if delta is not None:
+            changed = delta.added | delta.changed | delta.removed
+        future = key_info.submit(self.run_key_audit, sources, changed)
+        future.add_done_callback(
+            lambda future: GLib.idle_add(self.on_keys_audited, future)
+        )
+
+    def run_key_audit(self, sources, changed):
+        """ Audit the keys on the key info thread.
+
+        Audits run one at a time on that thread, so each one builds on the
+        result of the one before, even if it hasn't been shown yet.
+        """
+        self.last_audit = audit_keys(
+            sources, previous=self.last_audit, changed=changed
+        )
+        return self.last_audit
+
+    def on_keys_audited(self, future):
+        """ Show the results of a key audit as badges on the rows. """
+        try:
+            self.key_audit = future.result()
+        except Exception as err:
+            self.log.error('Could not audit keys: %s', err)
+            return False
+        for row in self.ppa_liststore:
+            if row[2]:
+                row[4], row[5] = self.get_key_badge(row[2])
+        return False
+
+    def add_row(self, values, position=None):
+        """ Add a row to the list.
+
+        Unless a position is given, enabled sources are placed after the last
+        enabled row and disabled ones are placed at the end.
+
+        Arguments:
+            values (list): The column values, from `get_row_values`.
+            position (int): Where to insert the row.
+        """
+        if position is None:
+            position = -1
+            if values[3]:
+                position = 0
+                for row in self.ppa_liststore:
+                    if not row[3]:
+                        break
+                    position += 1
+        self.ppa_liststore.insert_with_valuesv(
+            position,
+            [0, 1, 2, 3, 4, 5],
+            values
+        )
+
+    def remove_row(self, ident):
+        """ Remove the row for the source `ident`, if there is one."""
+        for row in self.ppa_liststore:
+            if row[2] == ident:
+                self.ppa_liststore.remove(row.iter)
+                return
+
+    def apply_delta(self, delta):
+        """ Patch the list with the sources changed by a reload.
+
+        Arguments:
+            delta (:obj:`repo.SourceDelta`): The sources which changed.
+        """
+        self.log.debug('Updating list for %s', delta)
+        for ident in delta.removed | delta.changed:
+            self.remove_row(ident)
+        for ident in delta.added | delta.changed:
+            source = self.store.get(ident)
+            if ident == 'system' or not source:
+                continue
+            values = self.get_row_values(source)
+            if values:
+                self.add_row(values)
 
-    def on_config_changed(self, monitor, file, other_file, event_type):
-        self.log.debug('Installation changed, regenerating list')
-        self.generate_entries()
+    def on_config_changed(self, paths, delta):
+        """ SourceStore subscriber for changes to the sources. """
+        if delta:
+            self.log.debug('Installation changed, updating list')
+            self.apply_delta(delta)
+            self.audit_keys(delta)
 
     def on_row_selected(self, widget):
         (model, pathlist) = widget.get_selected_rows()
@@ -382,6 +456,11 @@ class List(Gtk.Box):
             for path in pathlist :
                 tree_iter = model.get_iter(path)
                 repo_name = model.get_value(tree_iter,2)
+                if not repo_name:
+                    # The loading placeholder row isn't a source
+                    self.edit_button.set_sensitive(False)
+                    self.delete_button.set_sensitive(False)
+                    return
                 self.remote_name = repo_name
                 if repo_name != 'x-repoman-legacy-sources':
                     self.delete_button.set_sensitive(True)
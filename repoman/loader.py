@@ -0,0 +1,417 @@
+#!/usr/bin/python3
+'''
+   Copyright 2020 Ian Santopietro (ian@system76.com)
+
+   This file is part of Repoman.
+
+    Repoman is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Repoman is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Repoman.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+from pathlib import Path
+import threading
+import time
+
+import repolib
+
+from .cache import ParseCache, file_stamp
+from .index import SourceIndex, get_file_name, get_key_path
+
+log = logging.getLogger('repoman.Loader')
+
+parse_cache = ParseCache()
+source_index = SourceIndex()
+_load_lock = threading.Lock()
+
+# The number of files to read and parse at once during a full load. Reading
+# in parallel mostly helps with cold caches on slow (e.g. network) storage.
+# Set REPOMAN_LOAD_WORKERS to override it.
+def _get_load_workers():
+    try:
+        return max(1, int(os.environ['REPOMAN_LOAD_WORKERS']))
+    except (KeyError, ValueError):
+        return min(8, os.cpu_count() or 1)
+
+LOAD_WORKERS = _get_load_workers()
+
+def get_source_paths():
+    """ Get the paths of all of the source files on the system.
+
+    Returns:
+        A list of :obj:`Path`, deb822 files first, then legacy files.
+    """
+    sources_dir = Path(repolib.util.SOURCES_DIR)
+    paths = list(sources_dir.glob('*.sources'))
+    paths += list(sources_dir.glob('*.list'))
+    return paths
+
+def finish_cached_load(sourcefile):
+    """ Redo what `SourceFile.load()` does beyond parsing, for a cache hit.
+
+    A cached file is unpickled rather than loaded, so the sources are
+    pointed back at their file and their signing keys are loaded from the
+    keyrings as they are now, just as repolib's load would.
+
+    Arguments:
+        sourcefile (:obj:`repolib.SourceFile`): The file from the cache.
+    """
+    for source in sourcefile.sources:
+        source.file = sourcefile
+        load_key = getattr(source, 'load_key', None)
+        if load_key:
+            try:
+                load_key()
+            except Exception as err:
+                log.debug('Could not load the key for %s: %s', source.ident, err)
+
+def parse_source_file(path):
+    """ Parse a single source file, using the parse cache if possible.
+
+    Arguments:
+        path (:obj:`Path`): The file to parse.
+
+    Returns:
+        The loaded :obj:`repolib.SourceFile`.
+    """
+    stamp = file_stamp(path)
+    sourcefile = parse_cache.get(path, stamp)
+    if sourcefile:
+        finish_cached_load(sourcefile)
+        return sourcefile
+
+    log.debug('Parsing %s', path)
+    sourcefile = repolib.SourceFile(path=path)
+    sourcefile.load()
+    parse_cache.put(path, stamp, sourcefile)
+    return sourcefile
+
+def _try_parse_source_file(path):
+    """ Parse `path`, returning a (sourcefile, error) tuple. """
+    try:
+        return parse_source_file(path), None
+    except Exception as err:
+        return None, err
+
+def iter_source_files(paths=None, workers=None):
+    """ Parse source files, yielding each one as soon as it's ready.
+
+    Files are parsed on a pool of up to `workers` threads, but are always
+    yielded in the order of `paths`.
+
+    Arguments:
+        paths (list): The files to parse. Defaults to `get_source_paths()`.
+        workers (int): The number of files to parse at once. Defaults to
+            `LOAD_WORKERS`; 1 parses the files one after another.
+
+    Yields:
+        A (path, sourcefile, error) tuple for each file. Exactly one of
+        sourcefile and error is None.
+    """
+    if paths is None:
+        paths = get_source_paths()
+    workers = workers or LOAD_WORKERS
+    if workers > 1 and len(paths) > 1:
+        with ThreadPoolExecutor(
+            max_workers=min(workers, len(paths)),
+            thread_name_prefix='repoman-parse'
+        ) as pool:
+            # map() yields in submission order, keeping this deterministic
+            for path, result in zip(paths, pool.map(_try_parse_source_file, paths)):
+                yield (path, *result)
+    else:
+        for path in paths:
+            yield (path, *_try_parse_source_file(path))
+
+def _add_source(source, sourcefile):
+    """ Add a loaded source to the repolib registries.
+
+    As with repolib's own load, a source whose ident is already taken by a
+    source from another file is given a numbered ident instead of replacing
+    it, and its key is recorded in `repolib.util.keys` by keyring path.
+
+    Arguments:
+        source (:obj:`repolib.Source`): The source to add.
+        sourcefile (:obj:`repolib.SourceFile`): The file it was loaded from.
+    """
+    source.file = sourcefile
+    ident = source.ident
+    if ident in repolib.util.sources:
+        number = 1
+        while f'{ident}-{number}' in repolib.util.sources:
+            number += 1
+        source.ident = f'{ident}-{number}'
+        log.info(
+            'Source %s in %s is already loaded from %s, using %s',
+            ident, sourcefile.path.name,
+            get_file_name(repolib.util.sources[ident]), source.ident
+        )
+    repolib.util.sources[source.ident] = source
+    key_path = get_key_path(source)
+    key = getattr(source, 'key', None)
+    if key_path and key:
+        repolib.util.keys.setdefault(key_path, key)
+
+def _remove_unused_keys(key_paths):
+    """ Drop the entries of `repolib.util.keys` for keyrings no longer used.
+
+    Arguments:
+        key_paths (set): The keyrings which might have lost their last source.
+    """
+    for key_path in key_paths:
+        if key_path and not source_index.find_by_key(key_path):
+            repolib.util.keys.pop(key_path, None)
+
+def load_all_sources(workers=None):
+    """ Load (or reload) all of the sources on the system.
+
+    Files which haven't changed since they were last parsed are taken from the
+    parse cache, so only new or modified files are actually read. The results
+    are stored in the repolib registries (`repolib.util.sources`,
+    `repolib.util.files`, `repolib.util.keys` and `repolib.util.errors`).
+
+    Files are parsed in parallel (see `iter_source_files`), but the results
+    are always merged in the same order as a sequential load.
+
+    Arguments:
+        workers (int): The number of files to parse at once. Defaults to
+            `LOAD_WORKERS`; 1 parses the files one after another.
+
+    Returns:
+        A tuple of the (sources, errors) dicts.
+    """
+    workers = workers or LOAD_WORKERS
+    with _load_lock:
+        log.debug('Loading all sources')
+        start = time.monotonic()
+        paths = get_source_paths()
+        files = {}
+        errors = {}
+        for path, sourcefile, err in iter_source_files(paths, workers):
+            if err:
+                log.debug('Could not load %s: %s', path, err)
+                parse_cache.discard(path)
+                errors[path.name] = err
+            else:
+                files[path.name] = sourcefile
+
+        repolib.util.sources.clear()
+        repolib.util.files.clear()
+        repolib.util.keys.clear()
+        repolib.util.errors.clear()
+        for name, sourcefile in files.items():
+            repolib.util.files[name] = sourcefile
+            for source in sourcefile.sources:
+                _add_source(source, sourcefile)
+        repolib.util.errors.update(errors)
+        source_index.build(repolib.util.sources)
+
+        parse_cache.prune(paths)
+        parse_cache.save()
+        log.debug(
+            'Loaded %s files with %s workers in %.3fs (%s cached, %s parsed)',
+            len(paths), workers, time.monotonic() - start,
+            parse_cache.hits, parse_cache.misses
+        )
+        return repolib.util.sources, repolib.util.errors
+
+def reload_source_file(path, sourcefile=None):
+    """ Reload a single source file after it changed on disk.
+
+    Only `path` is parsed; the rest of the loaded sources are left alone. If
+    the file no longer exists, its sources are removed.
+
+    Arguments:
+        path (:obj:`Path`): The file which changed.
+        sourcefile (:obj:`repolib.SourceFile`): The new contents of the
+            file, if they're already known (e.g. because repoman just saved
+            it), in which case the file isn't parsed again.
+
+    Returns:
+        A :obj:`SourceDelta` describing the affected idents.
+    """
+    path = Path(path)
+    if path.suffix not in ('.sources', '.list'):
+        return SourceDelta()
+
+    with _load_lock:
+        log.debug('Reloading %s', path)
+        old_file = repolib.util.files.pop(path.name, None)
+        # Sources removed from a file in memory are no longer in the file
+        # object, but the index still knows where they came from.
+        old_idents = {source.ident for source in source_index.find_by_file(path.name)}
+        if old_file:
+            old_idents.update(source.ident for source in old_file.sources)
+        old_keys = set()
+        for ident in old_idents:
+            source = repolib.util.sources.get(ident)
+            if source is None or get_file_name(source) == path.name:
+                if source is not None:
+                    old_keys.add(get_key_path(source))
+                repolib.util.sources.pop(ident, None)
+                source_index.remove(ident)
+        repolib.util.errors.pop(path.name, None)
+
+        new_idents = set()
+        if path.exists():
+            # repolib registers the sources it parses itself, which would
+            # replace those of other files with the same idents.
+            sources = dict(repolib.util.sources)
+            try:
+                if sourcefile is None:
+                    sourcefile = parse_source_file(path)
+                else:
+                    parse_cache.put(path, file_stamp(path), sourcefile)
+            except Exception as err:
+                log.debug('Could not load %s: %s', path, err)
+                parse_cache.discard(path)
+                repolib.util.errors[path.name] = err
+                sourcefile = None
+            repolib.util.sources.clear()
+            repolib.util.sources.update(sources)
+            if sourcefile is not None:
+                repolib.util.files[path.name] = sourcefile
+                for source in sourcefile.sources:
+                    _add_source(source, sourcefile)
+                    source_index.add(source)
+                    new_idents.add(source.ident)
+        else:
+            parse_cache.discard(path)
+        _remove_unused_keys(old_keys)
+        parse_cache.save()
+
+        return SourceDelta(
+            added=new_idents - old_idents,
+            changed=new_idents & old_idents,
+            removed=old_idents - new_idents
+        )
+
+class SourceDelta:
+    """ The set of sources affected by a reload.
+
+    Attributes:
+        added (set): Idents of sources which are new.
+        changed (set): Idents of sources which were reloaded.
+        removed (set): Idents of sources which no longer exist.
+    """
+
+    def __init__(self, added=None, changed=None, removed=None):
+        self.added = set(added or ())
+        self.changed = set(changed or ())
+        self.removed = set(removed or ())
+
+    def __repr__(self):
+        return (
+            f'SourceDelta(added={self.added}, changed={self.changed}, '
+            f'removed={self.removed})'
+        )
+
+    def __bool__(self):
+        return bool(self.added or self.changed or self.removed)
+
+    def __contains__(self, ident):
+        return (
+            ident in self.added or
+            ident in self.changed or
+            ident in self.removed
+        )
+
+    def merge(self, other):
+        """ Fold a later delta into this one.
+
+        Arguments:
+            other (:obj:`SourceDelta`): The delta which happened after this.
+        """
+        for ident in other.added:
+            if ident in self.removed:
+                self.removed.discard(ident)
+                self.changed.add(ident)
+            else:
+                self.added.add(ident)
+        for ident in other.changed:
+            if ident not in self.added:
+                self.changed.add(ident)
+        for ident in other.removed:
+            if ident in self.added:
+                self.added.discard(ident)
+            else:
+                self.changed.discard(ident)
+                self.removed.add(ident)
+        return self
+
+class SourceLoader:
+    """ Loads the system sources in the background.
+
+    Parsing the sources can take a while on systems with many source files, so
+    rather than doing it when the module is imported, the loader does it on a
+    worker thread and hands back a future which resolves once the sources are
+    available.
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix='repoman-loader'
+        )
+        self._lock = threading.Lock()
+        self._future = None
+
+    @property
+    def future(self):
+        """:obj:`concurrent.futures.Future`: The current load, if started."""
+        return self._future
+
+    @property
+    def loaded(self):
+        """ bool: Whether the sources have been loaded successfully."""
+        future = self._future
+        if future and future.done():
+            return not future.cancelled() and not future.exception()
+        return False
+
+    def start(self):
+        """ Start loading the sources, if we haven't already started.
+
+        Returns:
+            A :obj:`concurrent.futures.Future` resolving to the
+            (sources, errors) tuple.
+        """
+        with self._lock:
+            if not self._future:
+                log.debug('Starting background source load')
+                self._future = self._executor.submit(load_all_sources)
+            return self._future
+
+    def reload(self):
+        """ Discard the current results and load the sources again.
+
+        Returns:
+            A :obj:`concurrent.futures.Future` for the new load.
+        """
+        with self._lock:
+            log.debug('Starting background source reload')
+            self._future = self._executor.submit(load_all_sources)
+            return self._future
+
+    def wait(self, timeout=None):
+        """ Block until the sources are loaded.
+
+        Arguments:
+            timeout (float): The maximum number of seconds to wait.
+
+        Returns:
+            The (sources, errors) tuple.
+        """
+        return self.start().result(timeout=timeout)
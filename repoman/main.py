@@ -28,11 +28,16 @@ try:
 except ImportError:
     JournalHandler = False
 
+from . import repo
 from .window import Window
 
 class Application(Gtk.Application):
 
+    quitting = False
+
     def do_activate(self):
+        # Start parsing sources right away so it overlaps with building the UI
+        repo.loader.start()
 
         self.win = Window()
         self.win.connect("delete-event", self.application_quit)
@@ -40,6 +45,32 @@ class Application(Gtk.Application):
         Gtk.main()
     
     def application_quit(self, widget, data=None):
+        # Don't lose switches flipped just before closing the window. The
+        # writes finish in the background while the window shows it's busy.
+        if self.quitting:
+            return True
+        self.quitting = True
+        self.win.set_sensitive(False)
+        gdk_window = self.win.get_window()
+        if gdk_window:
+            gdk_window.set_cursor(
+                Gdk.Cursor.new_from_name(gdk_window.get_display(), 'wait')
+            )
+        repo.store.flush(callback=self.on_flushed)
+        return True
+
+    def on_flushed(self, errors):
+        """ Quit once the last changes have been written. """
+        for file, err in errors:
+            err_dialog = repo.get_error_messagedialog(
+                self.win,
+                f'Could not save {file.path.name}',
+                err,
+                'The changes to the system sources could not be saved'
+            )
+            err_dialog.run()
+            err_dialog.destroy()
+        repo.privileged_helper.close()
         Gtk.main_quit()
 
 app = Application()
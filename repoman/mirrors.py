@@ -0,0 +1,676 @@
+#!/usr/bin/python3
+'''
+   Copyright 2020 Ian Santopietro (ian@system76.com)
+
+   This file is part of Repoman.
+
+    Repoman is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Repoman is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Repoman.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Measuring mirrors. Nothing in here may load Gtk; results are handed to a
+# `dispatch` function, which the GUI sets to GLib.idle_add.
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import json
+import logging
+import os
+from pathlib import Path
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from .cache import CACHE_DIR, write_cache_file
+
+log = logging.getLogger('repoman.Mirrors')
+
+CONFIG_DIR = Path(
+    os.environ.get('XDG_CONFIG_HOME', Path.home() / '.config')
+) / 'repoman'
+
+# Seconds to allow for each mirror
+DEFAULT_TIMEOUT = 5
+# The number of mirrors to probe at once
+PROBE_WORKERS = 8
+CHUNK_SIZE = 64 * 1024
+USER_AGENT = 'repoman'
+# Seconds before a mirror's health should be measured again
+HEALTH_TTL = 6 * 60 * 60
+# Seconds a mirror may trail the freshest one before it's flagged
+MAX_LAG = 6 * 60 * 60
+
+ProbeResult = namedtuple(
+    'ProbeResult',
+    ['uri', 'url', 'ok', 'ttfb', 'elapsed', 'size', 'throughput', 'error',
+     'data']
+)
+ProbeResult.__doc__ = """ The outcome of probing a single mirror.
+
+Attributes:
+    uri (str): The mirror.
+    url (str): The Release file which was fetched.
+    ok (bool): Whether the file was fetched.
+    ttfb (float): Seconds until the response headers arrived.
+    elapsed (float): Seconds taken to fetch the whole file.
+    size (int): The number of bytes fetched.
+    throughput (float): Bytes per second while reading the body.
+    error (str): Why the probe failed, or ''.
+    data (bytes): The contents of the Release file.
+"""
+
+class ProbeCancelled(Exception):
+    """ Raised inside a probe which was cancelled. """
+
+def get_release_urls(uri, suite):
+    """ Get the URLs to try for the Release file of `suite` on a mirror.
+
+    Returns:
+        A list with the InRelease URL first and the Release URL second.
+    """
+    base = f'{uri.rstrip("/")}/dists/{suite}'
+    return [f'{base}/InRelease', f'{base}/Release']
+
+def _fetch(url, timeout, cancelled):
+    """ Fetch `url`, returning (ttfb, elapsed, data). """
+    if cancelled.is_set():
+        raise ProbeCancelled()
+    request = urllib.request.Request(url, headers={'User-Agent': USER_AGENT})
+    start = time.monotonic()
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        ttfb = time.monotonic() - start
+        chunks = []
+        while True:
+            if cancelled.is_set():
+                raise ProbeCancelled()
+            if time.monotonic() - start > timeout:
+                raise TimeoutError(f'Timed out after {timeout} seconds')
+            chunk = response.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    return ttfb, time.monotonic() - start, b''.join(chunks)
+
+def probe_mirror(uri, suite, timeout=DEFAULT_TIMEOUT, cancelled=None):
+    """ Measure how quickly a mirror serves the Release file for `suite`.
+
+    InRelease is tried first, falling back to Release if the mirror
+    doesn't have it.
+
+    Arguments:
+        uri (str): The mirror to probe.
+        suite (str): The suite whose Release file to fetch.
+        timeout (float): Seconds to allow for the whole fetch.
+        cancelled (:obj:`threading.Event`): Set to abandon the probe.
+
+    Returns:
+        A :obj:`ProbeResult`.
+
+    Raises:
+        ProbeCancelled: If `cancelled` was set.
+    """
+    cancelled = cancelled or threading.Event()
+    error = ''
+    url = ''
+    for url in get_release_urls(uri, suite):
+        try:
+            ttfb, elapsed, data = _fetch(url, timeout, cancelled)
+        except urllib.error.HTTPError as err:
+            error = f'HTTP {err.code}'
+            if err.code == 404:
+                continue
+            break
+        except (OSError, ValueError) as err:
+            error = str(getattr(err, 'reason', None) or err)
+            break
+        body_time = elapsed - ttfb
+        throughput = len(data) / body_time if body_time > 0 else 0.0
+        log.debug('%s: %.0f ms, %s bytes', url, ttfb * 1000, len(data))
+        return ProbeResult(
+            uri, url, True, ttfb, elapsed, len(data), throughput, '', data
+        )
+    log.debug('Probing %s failed: %s', uri, error)
+    return ProbeResult(uri, url, False, None, None, 0, 0.0, error, b'')
+
+def parse_release_fields(data):
+    """ Get the top-level fields of a Release or InRelease file.
+
+    Arguments:
+        data (bytes): The contents of the file.
+
+    Returns:
+        A dict of the single-line fields (e.g. Date, Valid-Until).
+    """
+    fields = {}
+    for line in data.decode('utf-8', 'replace').splitlines():
+        if line.startswith('-----BEGIN PGP SIGNATURE'):
+            break
+        if not line or line[0].isspace() or ':' not in line:
+            continue
+        name, value = line.split(':', 1)
+        if value.strip():
+            fields.setdefault(name.strip(), value.strip())
+    return fields
+
+def parse_release_date(value):
+    """ Parse a Date or Valid-Until value from a Release file.
+
+    Returns:
+        An aware :obj:`datetime`, or None if it can't be parsed.
+    """
+    if not value:
+        return None
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date
+
+Freshness = namedtuple(
+    'Freshness',
+    ['uri', 'ok', 'date', 'valid_until', 'lag', 'expired', 'lagging', 'error']
+)
+Freshness.__doc__ = """ How up to date a mirror is.
+
+Attributes:
+    uri (str): The mirror.
+    ok (bool): Whether its Release file could be fetched and had a Date.
+    date (datetime): The Date of its Release file.
+    valid_until (datetime): The Valid-Until of its Release file, or None.
+    lag (float): Seconds its Date trails the freshest mirror's.
+    expired (bool): Whether Valid-Until has passed.
+    lagging (bool): Whether it trails by more than the allowed lag, or has
+        expired.
+    error (str): Why the mirror couldn't be checked, or ''.
+"""
+
+def compare_freshness(results, max_lag=MAX_LAG, now=None):
+    """ Compare the Release dates of mirrors against the freshest one.
+
+    Arguments:
+        results (dict): :obj:`ProbeResult` objects by mirror.
+        max_lag (float): Seconds a mirror may trail before being flagged.
+        now (datetime): The current time, for checking Valid-Until.
+
+    Returns:
+        A dict of :obj:`Freshness` by mirror.
+    """
+    now = now or datetime.now(timezone.utc)
+    dates = {}
+    reports = {}
+    for uri, result in results.items():
+        fields = parse_release_fields(result.data) if result.ok else {}
+        date = parse_release_date(fields.get('Date'))
+        if not date:
+            error = result.error or 'No Date in the Release file'
+            reports[uri] = Freshness(uri, False, None, None, None, False, True, error)
+            continue
+        dates[uri] = (date, parse_release_date(fields.get('Valid-Until')))
+
+    freshest = max((date for date, valid in dates.values()), default=None)
+    for uri, (date, valid_until) in dates.items():
+        lag = (freshest - date).total_seconds()
+        expired = bool(valid_until and valid_until < now)
+        reports[uri] = Freshness(
+            uri, True, date, valid_until, lag, expired,
+            expired or lag > max_lag, ''
+        )
+    return reports
+
+def format_freshness(report):
+    """ Describe a :obj:`Freshness` in a few words. """
+    if not report.ok:
+        return f'Unknown ({report.error})'
+    if report.expired:
+        return 'Expired'
+    if report.lag < 60:
+        return 'Up to date'
+    return f'{format_age(report.lag).replace(" ago", "")} behind'
+
+def format_result(result):
+    """ Describe a :obj:`ProbeResult` in a few words. """
+    if not result.ok:
+        return f'Unreachable ({result.error})'
+    speed = result.throughput
+    for unit in ('B/s', 'kB/s', 'MB/s'):
+        if speed < 1000 or unit == 'MB/s':
+            break
+        speed /= 1000
+    return f'{result.ttfb * 1000:.0f} ms, {speed:.1f} {unit}'
+
+class ProbeRun:
+    """ A set of mirror probes started together.
+
+    Attributes:
+        results (dict): The finished :obj:`ProbeResult` objects, by mirror.
+    """
+
+    def __init__(self):
+        self.cancelled = threading.Event()
+        self.finished = threading.Event()
+        self.futures = {}
+        self.results = {}
+
+    @property
+    def done(self):
+        """ bool: Whether every probe has finished or been cancelled. """
+        return all(future.done() for future in self.futures.values())
+
+    def cancel(self):
+        """ Stop the probes; no more results will be reported. """
+        self.cancelled.set()
+        for future in self.futures.values():
+            future.cancel()
+        self.finished.set()
+
+    def wait(self, timeout=None):
+        """ Wait for the probes to finish and their results to be recorded.
+
+        Returns:
+            The finished :obj:`ProbeResult` objects, by mirror.
+        """
+        self.finished.wait(timeout)
+        return dict(self.results)
+
+class MirrorProber:
+    """ Probes mirrors concurrently on a pool of threads.
+
+    Each mirror gets its own timeout, and a whole run can be cancelled.
+    Callbacks are passed to `dispatch` so the GUI can run them on the main
+    loop.
+    """
+
+    def __init__(self, workers=PROBE_WORKERS, timeout=DEFAULT_TIMEOUT, dispatch=None):
+        self.log = logging.getLogger('repoman.MirrorProber')
+        self.timeout = timeout
+        self.dispatch = dispatch or (lambda callback, *args: callback(*args))
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='repoman-probe'
+        )
+
+    def probe(self, uris, suite, on_result=None, on_done=None):
+        """ Start probing `uris`.
+
+        Arguments:
+            uris (list): The mirrors to probe.
+            suite (str): The suite whose Release file to fetch.
+            on_result (function): Dispatched as `on_result(result)` as each
+                probe finishes.
+            on_done (function): Dispatched as `on_done(results)` once every
+                probe has finished, unless the run is cancelled.
+
+        Returns:
+            The :obj:`ProbeRun`.
+        """
+        run = ProbeRun()
+        uris = list(dict.fromkeys(uris))
+        self.log.debug('Probing %s mirrors for %s', len(uris), suite)
+        remaining = [len(uris)]
+        lock = threading.Lock()
+
+        def finished(uri, future):
+            if future.cancelled() or run.cancelled.is_set():
+                return
+            try:
+                result = future.result()
+            except ProbeCancelled:
+                return
+            except Exception as err:
+                result = ProbeResult(uri, '', False, None, None, 0, 0.0, str(err), b'')
+            with lock:
+                run.results[uri] = result
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                run.finished.set()
+            if on_result:
+                self.dispatch(on_result, result)
+            if last and on_done:
+                self.dispatch(on_done, dict(run.results))
+
+        for uri in uris:
+            future = self.executor.submit(
+                probe_mirror, uri, suite, self.timeout, run.cancelled
+            )
+            run.futures[uri] = future
+            future.add_done_callback(lambda future, uri=uri: finished(uri, future))
+        if not uris:
+            run.finished.set()
+            if on_done:
+                self.dispatch(on_done, {})
+        return run
+
+MirrorStats = namedtuple(
+    'MirrorStats',
+    ['uri', 'samples', 'successes', 'ttfb', 'elapsed', 'throughput']
+)
+MirrorStats.__doc__ = """ Probe results for a mirror aggregated over several samples.
+
+Timings are medians over the successful samples, or None if there were none.
+"""
+
+def _median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+def aggregate_results(uri, results):
+    """ Combine several :obj:`ProbeResult` for `uri` into :obj:`MirrorStats`. """
+    good = [result for result in results if result.ok]
+    return MirrorStats(
+        uri=uri,
+        samples=len(results),
+        successes=len(good),
+        ttfb=_median([result.ttfb for result in good]),
+        elapsed=_median([result.elapsed for result in good]),
+        throughput=_median([result.throughput for result in good]),
+    )
+
+def is_reliable(stats):
+    """ Whether a mirror answered at least half of its probes. """
+    return bool(stats and stats.successes and stats.successes * 2 >= stats.samples)
+
+def choose_mirrors(uris, stats, candidates=(), top=None):
+    """ Order mirrors from fastest to slowest.
+
+    Mirrors are ranked by the median time taken to fetch their Release file.
+    Unreliable or untested mirrors go last, and ties keep their current
+    order so the list doesn't churn.
+
+    Arguments:
+        uris (list): The configured mirrors.
+        stats (dict): :obj:`MirrorStats` by mirror.
+        candidates (list): Other mirrors which may replace the configured
+            ones; only used together with `top`.
+        top (int): Keep only the fastest `top` reliable mirrors out of the
+            configured ones and `candidates`.
+
+    Returns:
+        The new list of mirrors.
+    """
+    pool = list(dict.fromkeys(list(uris) + list(candidates if top else ())))
+
+    def rank(uri):
+        entry = stats.get(uri)
+        if not is_reliable(entry):
+            return (1, 0, pool.index(uri))
+        return (0, entry.elapsed, pool.index(uri))
+
+    ranked = sorted(pool, key=rank)
+    if top:
+        chosen = [uri for uri in ranked if is_reliable(stats.get(uri))][:top]
+        # Never leave the system without a mirror
+        return chosen or list(uris)
+    return ranked
+
+class MirrorBenchmark:
+    """ Probes a set of mirrors several times, one round after another.
+
+    Spreading the samples out evens out one-off slow responses; each round
+    probes every mirror concurrently.
+    """
+
+    def __init__(self, prober, uris, suite, samples=3, on_done=None):
+        self.prober = prober
+        self.uris = list(dict.fromkeys(uris))
+        self.suite = suite
+        self.samples = samples
+        self.on_done = on_done
+        self.results = {uri: [] for uri in self.uris}
+        self.run = None
+        self.round = 0
+        self.cancelled = False
+
+    @property
+    def done(self):
+        """ bool: Whether the benchmark has finished or been cancelled. """
+        return self.cancelled or self.round >= self.samples
+
+    def start(self):
+        """ Start the first round. """
+        self._next_round()
+        return self
+
+    def cancel(self):
+        """ Stop the benchmark; `on_done` won't be called. """
+        self.cancelled = True
+        if self.run:
+            self.run.cancel()
+
+    def _next_round(self):
+        self.run = self.prober.probe(
+            self.uris, self.suite, on_done=self.on_round_done
+        )
+
+    def on_round_done(self, results):
+        """ ProbeRun callback for the end of a round. """
+        if self.cancelled:
+            return False
+        for uri, result in results.items():
+            self.results[uri].append(result)
+        self.round += 1
+        if self.round < self.samples:
+            self._next_round()
+        elif self.on_done:
+            self.on_done(self.get_stats())
+        return False
+
+    def get_stats(self):
+        """ Get the :obj:`MirrorStats` for each mirror so far. """
+        return {
+            uri: aggregate_results(uri, results)
+            for uri, results in self.results.items()
+        }
+
+class MirrorConfig:
+    """ Preferences for how mirrors are chosen, stored in mirrors.json.
+
+    Attributes:
+        auto_sort (bool): Sort the mirrors by speed when Settings opens.
+        candidates (list): Mirrors which may replace the configured ones.
+        top (int): How many of the fastest mirrors to keep when choosing
+            from `candidates`, or None to only reorder the configured ones.
+        samples (int): How many times to probe each mirror.
+    """
+
+    defaults = {'auto_sort': False, 'candidates': [], 'top': None, 'samples': 3}
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path else CONFIG_DIR / 'mirrors.json'
+        self.__dict__.update(self.defaults)
+        self.load()
+
+    def load(self):
+        """ Read the preferences, keeping the defaults for anything missing. """
+        try:
+            with open(self.path) as config_file:
+                data = json.load(config_file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as err:
+            log.warning('Could not read %s: %s', self.path, err)
+            return
+        for name in self.defaults:
+            if name in data:
+                setattr(self, name, data[name])
+
+    def save(self):
+        """ Write the preferences. """
+        data = {name: getattr(self, name) for name in self.defaults}
+        try:
+            write_cache_file(self.path, json.dumps(data, indent=2).encode())
+        except OSError as err:
+            log.warning('Could not save %s: %s', self.path, err)
+
+def format_age(seconds):
+    """ Describe how long ago something happened, roughly. """
+    for unit, size in (('day', 86400), ('hour', 3600), ('minute', 60)):
+        if seconds >= size:
+            count = int(seconds // size)
+            return f'{count} {unit}{"s" if count > 1 else ""} ago'
+    return 'just now'
+
+class MirrorHealthCache:
+    """ The last known health of each mirror, kept between runs.
+
+    Entries are dicts keyed by mirror URI holding `latency` and `throughput`
+    from the last successful probe, the `last_success` and `last_failure`
+    times, the `error` of the last failure, the mirror's Release `date` and
+    a `ttl` after which the entry is stale. Entries which don't look like
+    that (e.g. after hand-editing) are dropped when the cache is read.
+    """
+
+    numbers = ('checked', 'ttl', 'latency', 'throughput', 'last_success',
+               'last_failure')
+    strings = ('error', 'date')
+
+    def __init__(self, path=None, ttl=HEALTH_TTL):
+        self.path = Path(path) if path else CACHE_DIR / 'mirrors.json'
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        """ Read the cache, starting afresh if it can't be read. """
+        try:
+            with open(self.path) as cache_file:
+                entries = json.load(cache_file)
+            if not isinstance(entries, dict):
+                raise ValueError('Not a mapping')
+        except FileNotFoundError:
+            entries = {}
+        except (OSError, ValueError) as err:
+            log.warning('Discarding mirror cache %s: %s', self.path, err)
+            entries = {}
+        valid = {
+            uri: entry for uri, entry in entries.items()
+            if self.is_valid(entry)
+        }
+        if len(valid) < len(entries):
+            log.warning('Dropping %s malformed entries from mirror cache %s',
+                        len(entries) - len(valid), self.path)
+        with self.lock:
+            self.entries = valid
+            self.dirty = len(valid) < len(entries)
+
+    @classmethod
+    def is_valid(cls, entry):
+        """ Check whether a cache entry has the expected fields and types. """
+        if not isinstance(entry, dict):
+            return False
+        for field in cls.numbers:
+            value = entry.get(field)
+            if value is None:
+                continue
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                return False
+        for field in cls.strings:
+            value = entry.get(field)
+            if value is not None and not isinstance(value, str):
+                return False
+        return True
+
+    def save(self):
+        """ Write the cache if it changed. """
+        with self.lock:
+            if not self.dirty:
+                return
+            data = json.dumps(self.entries, indent=2).encode()
+            self.dirty = False
+        try:
+            write_cache_file(self.path, data)
+        except OSError as err:
+            log.warning('Could not save mirror cache %s: %s', self.path, err)
+
+    def get(self, uri):
+        """ Get the entry for `uri`, or None. """
+        with self.lock:
+            entry = self.entries.get(uri)
+            return dict(entry) if entry else None
+
+    def record(self, result, now=None):
+        """ Store a :obj:`ProbeResult`. """
+        now = now or time.time()
+        with self.lock:
+            entry = self.entries.setdefault(result.uri, {})
+            entry['checked'] = now
+            entry['ttl'] = self.ttl
+            if result.ok:
+                entry['latency'] = result.ttfb
+                entry['throughput'] = result.throughput
+                entry['last_success'] = now
+                date = parse_release_fields(result.data).get('Date')
+                if date:
+                    entry['date'] = date
+            else:
+                entry['last_failure'] = now
+                entry['error'] = result.error
+            self.dirty = True
+
+    def is_stale(self, uri, now=None):
+        """ Whether `uri` has never been measured or its entry expired. """
+        now = now or time.time()
+        entry = self.get(uri)
+        if not entry:
+            return True
+        return now - entry.get('checked', 0) > entry.get('ttl', self.ttl)
+
+    def get_stale(self, uris, now=None):
+        """ Get the mirrors out of `uris` which need measuring. """
+        return [uri for uri in uris if self.is_stale(uri, now)]
+
+    def prune(self, uris):
+        """ Drop the entries for mirrors not in `uris`. """
+        keep = set(uris)
+        with self.lock:
+            for uri in list(self.entries):
+                if uri not in keep:
+                    del self.entries[uri]
+                    self.dirty = True
+
+    def describe(self, uri, now=None):
+        """ Describe the health of `uri` for display, or None if unknown. """
+        entry = self.get(uri)
+        if not entry:
+            return None
+        now = now or time.time()
+        failed = entry.get('last_failure', 0) > entry.get('last_success', 0)
+        if failed:
+            text = f'Unreachable ({entry.get("error", "")})'
+        elif entry.get('latency') is None:
+            text = 'Not measured'
+        else:
+            result = ProbeResult(
+                uri, '', True, entry.get('latency'), None, 0,
+                entry.get('throughput', 0.0), '', b''
+            )
+            text = format_result(result)
+        return f'{text}, checked {format_age(now - entry.get("checked", now))}'
+
+    def is_healthy(self, uri):
+        """ Whether the last probe of `uri` succeeded (None if unknown). """
+        entry = self.get(uri)
+        if not entry:
+            return None
+        return entry.get('last_success', 0) >= entry.get('last_failure', 0)
@@ -0,0 +1,307 @@
+#!/usr/bin/python3
+'''
+   Copyright 2020 Ian Santopietro (ian@system76.com)
+
+   This file is part of Repoman.
+
+    Repoman is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Repoman is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Repoman.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Just enough of an OpenPGP (RFC 4880) parser to describe the public keys in
+# a keyring without running gpg: fingerprints, user IDs, creation and
+# expiry dates, and revocation.
+
+import base64
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+import hashlib
+import struct
+
+TAG_SIGNATURE = 2
+TAG_PUBLIC_KEY = 6
+TAG_USER_ID = 13
+TAG_PUBLIC_SUBKEY = 14
+
+SUBPACKET_CREATED = 2
+SUBPACKET_KEY_EXPIRES = 9
+SUBPACKET_ISSUER = 16
+SUBPACKET_ISSUER_FINGERPRINT = 33
+
+SIG_CERTIFICATIONS = (0x10, 0x11, 0x12, 0x13)
+SIG_DIRECT_KEY = 0x1f
+SIG_KEY_REVOCATION = 0x20
+
+KeyInfo = namedtuple(
+    'KeyInfo', ['fingerprint', 'created', 'expires', 'uids', 'revoked']
+)
+KeyInfo.__doc__ = """ A public key found in a keyring.
+
+Attributes:
+    fingerprint (str): The fingerprint, as upper-case hex.
+    created (datetime): When the key was created.
+    expires (datetime): When the key expires, or None if it doesn't.
+    uids (tuple): The user IDs of the key.
+    revoked (bool): Whether the key carries a revocation self-signature.
+"""
+
+def dearmor(data):
+    """ Get the binary packets from ASCII-armored data.
+
+    Data which isn't armored is returned unchanged.
+    """
+    if not data.lstrip().startswith(b'-----BEGIN PGP'):
+        return data
+    lines = data.decode('ascii', 'replace').splitlines()
+    body = []
+    in_body = False
+    headers_done = False
+    for line in lines:
+        line = line.strip()
+        if line.startswith('-----BEGIN PGP'):
+            in_body = True
+            continue
+        if not in_body:
+            continue
+        if line.startswith('-----END PGP'):
+            break
+        if not headers_done:
+            # Armor headers end at the first blank line
+            if not line:
+                headers_done = True
+            elif ':' not in line:
+                headers_done = True
+                body.append(line)
+            continue
+        if line.startswith('='):
+            # The checksum
+            continue
+        body.append(line)
+    return base64.b64decode(''.join(body))
+
+def crc24(data):
+    """ Get the CRC-24 checksum used by ASCII armor. """
+    crc = 0xb704ce
+    for byte in data:
+        crc ^= byte << 16
+        for _ in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= 0x1864cfb
+    return crc & 0xffffff
+
+def enarmor(data):
+    """ Get ASCII armor for binary public key packets.
+
+    Data which is already armored is returned as text, unchanged.
+    """
+    if data.lstrip().startswith(b'-----BEGIN PGP'):
+        return data.decode('ascii', 'replace')
+    body = base64.b64encode(data).decode('ascii')
+    lines = [body[pos:pos + 64] for pos in range(0, len(body), 64)]
+    checksum = base64.b64encode(crc24(data).to_bytes(3, 'big')).decode('ascii')
+    return '\n'.join(
+        ['-----BEGIN PGP PUBLIC KEY BLOCK-----', '']
+        + lines
+        + [f'={checksum}', '-----END PGP PUBLIC KEY BLOCK-----', '']
+    )
+
+def iter_packets(data):
+    """ Yield (tag, body) for each packet in binary OpenPGP data. """
+    pos = 0
+    while pos < len(data):
+        header = data[pos]
+        pos += 1
+        if not header & 0x80:
+            raise ValueError(f'Bad packet header at offset {pos - 1}')
+        if header & 0x40:
+            tag = header & 0x3f
+            body = bytearray()
+            while True:
+                first = data[pos]
+                if first < 192:
+                    length, pos = first, pos + 1
+                elif first < 224:
+                    length = ((first - 192) << 8) + data[pos + 1] + 192
+                    pos += 2
+                elif first == 255:
+                    length = struct.unpack('>I', data[pos + 1:pos + 5])[0]
+                    pos += 5
+                else:
+                    # A partial body length; more parts follow
+                    part = 1 << (first & 0x1f)
+                    body += data[pos + 1:pos + 1 + part]
+                    pos += 1 + part
+                    continue
+                body += data[pos:pos + length]
+                pos += length
+                break
+            body = bytes(body)
+        else:
+            tag = (header >> 2) & 0x0f
+            length_type = header & 0x03
+            if length_type == 3:
+                length = len(data) - pos
+            else:
+                size = (1, 2, 4)[length_type]
+                length = int.from_bytes(data[pos:pos + size], 'big')
+                pos += size
+            body = data[pos:pos + length]
+            pos += length
+        yield tag, body
+
+def get_fingerprint(body):
+    """ Get the fingerprint of a public key packet body. """
+    version = body[0]
+    if version == 4:
+        digest = hashlib.sha1(b'\x99' + struct.pack('>H', len(body)) + body)
+    elif version == 6:
+        digest = hashlib.sha256(b'\x9b' + struct.pack('>I', len(body)) + body)
+    elif version == 5:
+        digest = hashlib.sha256(b'\x9a' + struct.pack('>I', len(body)) + body)
+    else:
+        return ''
+    return digest.hexdigest().upper()
+
+def _timestamp(value):
+    return datetime.fromtimestamp(value, timezone.utc)
+
+def _iter_subpackets(data):
+    pos = 0
+    while pos < len(data):
+        first = data[pos]
+        if first < 192:
+            length, pos = first, pos + 1
+        elif first < 255:
+            length = ((first - 192) << 8) + data[pos + 1] + 192
+            pos += 2
+        else:
+            length = struct.unpack('>I', data[pos + 1:pos + 5])[0]
+            pos += 5
+        if not length:
+            break
+        yield data[pos] & 0x7f, data[pos + 1:pos + length]
+        pos += length
+
+def parse_signature(body):
+    """ Get (type, created, key_expires, issuer) from a signature packet body.
+
+    `key_expires` is the key expiration time in seconds after the key's
+    creation, or None. `issuer` is the fingerprint or, failing that, the key
+    ID of the signing key as upper-case hex, or ''. Only version 4 and later
+    signatures are understood; others give (None, None, None, '').
+    """
+    version = body[0]
+    if version not in (4, 5, 6):
+        return None, None, None, ''
+    sig_type = body[1]
+    if version == 4 or version == 5:
+        size, length_format = 2, '>H'
+    else:
+        size, length_format = 4, '>I'
+    pos = 4
+    hashed_length = struct.unpack(length_format, body[pos:pos + size])[0]
+    hashed = body[pos + size:pos + size + hashed_length]
+    pos += size + hashed_length
+    unhashed_length = struct.unpack(length_format, body[pos:pos + size])[0]
+    unhashed = body[pos + size:pos + size + unhashed_length]
+
+    created = expires = None
+    for kind, data in _iter_subpackets(hashed):
+        if kind == SUBPACKET_CREATED and len(data) == 4:
+            created = struct.unpack('>I', data)[0]
+        elif kind == SUBPACKET_KEY_EXPIRES and len(data) == 4:
+            expires = struct.unpack('>I', data)[0]
+    # The issuer is only a hint, so gpg often puts it in the unhashed area
+    fingerprint = key_id = ''
+    for kind, data in _iter_subpackets(hashed + unhashed):
+        if kind == SUBPACKET_ISSUER_FINGERPRINT and len(data) > 1:
+            fingerprint = fingerprint or data[1:].hex().upper()
+        elif kind == SUBPACKET_ISSUER and len(data) == 8:
+            key_id = key_id or data.hex().upper()
+    return sig_type, created, expires, fingerprint or key_id
+
+def is_issued_by(issuer, fingerprint):
+    """ Check whether a signature's `issuer` is the key `fingerprint`. """
+    return bool(issuer) and len(issuer) >= 16 and fingerprint.endswith(issuer)
+
+def parse_keyring(data):
+    """ Describe the primary public keys in a keyring.
+
+    Arguments:
+        data (bytes): A binary or ASCII-armored keyring.
+
+    Returns:
+        A list of :obj:`KeyInfo`, one per primary key.
+
+    Raises:
+        ValueError: If the data isn't a valid keyring.
+    """
+    try:
+        packets = list(iter_packets(dearmor(data)))
+    except (IndexError, struct.error, ValueError) as err:
+        raise ValueError(f'Not an OpenPGP keyring: {err}') from err
+
+    keys = []
+    current = None
+    in_subkey = False
+
+    def finish():
+        if current:
+            created = current['created']
+            expires = None
+            if current['expiry'] is not None and current['expiry'][1]:
+                expires = created + timedelta(seconds=current['expiry'][1])
+            keys.append(KeyInfo(
+                current['fingerprint'], created, expires,
+                tuple(current['uids']), current['revoked']
+            ))
+
+    for tag, body in packets:
+        if tag == TAG_PUBLIC_KEY:
+            finish()
+            current = {
+                'fingerprint': get_fingerprint(body),
+                'created': _timestamp(struct.unpack('>I', body[1:5])[0]),
+                'uids': [],
+                'expiry': None,
+                'revoked': False,
+            }
+            in_subkey = False
+        elif current is None:
+            continue
+        elif tag == TAG_PUBLIC_SUBKEY:
+            in_subkey = True
+        elif tag == TAG_USER_ID:
+            in_subkey = False
+            current['uids'].append(body.decode('utf-8', 'replace'))
+        elif tag == TAG_SIGNATURE and not in_subkey:
+            sig_type, created, expires, issuer = parse_signature(body)
+            # Certifications by other keys say nothing about this key's
+            # expiry or revocation, however new they are
+            if not is_issued_by(issuer, current['fingerprint']):
+                continue
+            if sig_type == SIG_KEY_REVOCATION:
+                current['revoked'] = True
+            elif sig_type in SIG_CERTIFICATIONS + (SIG_DIRECT_KEY,):
+                # The newest self-signature decides the expiry
+                created = created or 0
+                if current['expiry'] is None or created >= current['expiry'][0]:
+                    current['expiry'] = (created, expires)
+    finish()
+    return keys
+
+def read_keyring(path):
+    """ Parse the keyring at `path`; see `parse_keyring`. """
+    with open(path, 'rb') as keyring_file:
+        return parse_keyring(keyring_file.read())
@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+'''
+   Copyright 2020 Ian Santopietro (ian@system76.com)
+
+   This file is part of Repoman.
+
+    Repoman is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Repoman is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Repoman.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from collections import namedtuple
+import logging
+import os
+import threading
+from types import MappingProxyType
+
+log = logging.getLogger('repoman.OSInfo')
+
+OS_RELEASE_PATH = '/etc/os-release'
+FALLBACK_NAME = 'your OS'
+
+OSIdentity = namedtuple(
+    'OSIdentity',
+    ['name', 'pretty_name', 'id', 'id_like', 'version_codename', 'codename',
+     'fields']
+)
+OSIdentity.__doc__ = """ The identity of the running OS.
+
+Attributes:
+    name (str): NAME, or a generic fallback.
+    pretty_name (str): PRETTY_NAME, or `name`.
+    id (str): ID.
+    id_like (tuple): The IDs in ID_LIKE.
+    version_codename (str): VERSION_CODENAME, as written in os-release.
+    codename (str): The codename to use for suites. On Ubuntu derivatives
+        this is the Ubuntu base release, so it's UBUNTU_CODENAME, the
+        codename detected by repolib or VERSION_CODENAME, in that order.
+    fields (Mapping): All of the fields in os-release (read-only).
+"""
+
+def _unquote(value):
+    value = value.strip()
+    if len(value) > 1 and value[0] == value[-1] and value[0] in '"\'':
+        value = value[1:-1]
+        for char in '\\$"`\'':
+            value = value.replace(f'\\{char}', char)
+    return value
+
+def parse_os_release(text):
+    """ Parse the contents of an os-release file.
+
+    Arguments:
+        text (str): The contents of the file.
+
+    Returns:
+        A dict of the fields in the file.
+    """
+    fields = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#') or '=' not in line:
+            continue
+        key, value = line.split('=', 1)
+        fields[key.strip()] = _unquote(value)
+    return fields
+
+def _fallback_codename():
+    try:
+        import repolib
+        return repolib.util.DISTRO_CODENAME
+    except Exception:
+        return ''
+
+def make_identity(fields):
+    """ Build an :obj:`OSIdentity` from parsed os-release fields. """
+    name = fields.get('NAME') or FALLBACK_NAME
+    # Derivatives (e.g. Mint, elementary) have their own VERSION_CODENAME,
+    # but their suites are named after the Ubuntu release they're based on.
+    codename = (
+        fields.get('UBUNTU_CODENAME') or
+        _fallback_codename() or
+        fields.get('VERSION_CODENAME', '')
+    )
+    return OSIdentity(
+        name=name,
+        pretty_name=fields.get('PRETTY_NAME') or name,
+        id=fields.get('ID', ''),
+        id_like=tuple(fields.get('ID_LIKE', '').split()),
+        version_codename=fields.get('VERSION_CODENAME', ''),
+        codename=codename,
+        fields=MappingProxyType(dict(fields))
+    )
+
+class OSIdentityProvider:
+    """ Reads the OS identity once and keeps it until os-release changes.
+
+    Every call to `get` costs a single stat() of the file; it is only parsed
+    again when its mtime (or inode) differs from the last read.
+    """
+
+    def __init__(self, path=OS_RELEASE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self._identity = None
+        self._stamp = None
+
+    def _get_stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_ino)
+
+    def get(self):
+        """ Get the current :obj:`OSIdentity`. """
+        stamp = self._get_stamp()
+        with self.lock:
+            if self._identity and stamp == self._stamp:
+                return self._identity
+            try:
+                with open(self.path) as os_release_file:
+                    fields = parse_os_release(os_release_file.read())
+            except OSError as err:
+                log.debug('Could not read %s: %s', self.path, err)
+                fields = {}
+            self._identity = make_identity(fields)
+            self._stamp = stamp
+            log.debug('OS identity: %s (%s)', self._identity.name, self._identity.codename)
+            return self._identity
+
+os_identity = OSIdentityProvider()
+
+def get_os_identity():
+    """ Get the identity of the running OS.
+
+    Returns:
+        An :obj:`OSIdentity`.
+    """
+    return os_identity.get()
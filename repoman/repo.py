@@ -26,18 +26,34 @@ import threading
 import traceback
 from urllib.parse import urlparse
 
-import dbus
-import gi
-from gi.repository import GLib, Gtk
+from gi.repository import GLib
 import repolib
 
+from .loader import (
+    SourceDelta,
+    load_all_sources,
+    reload_source_file,
+    source_index
+)
+from .helper import PrivilegedHelper
+from .keys import import_key, key_fetcher
+from .osinfo import get_os_identity
+from .store import SourceStore
+
 ## Uncomment for debugging
 # repolib.set_logging_level(2)
 
-repolib.system.load_all_sources()
+# The privileged helper, connected on first use and kept for the session
+privileged_helper = PrivilegedHelper()
+
+# The application-wide model of the sources. They are loaded in the
+# background (see `store.start()`); `sources` and `errors` are the repolib
+# registries, and are empty until the first load completes. Files are
+# written through the privileged helper.
+store = SourceStore(helper=privileged_helper)
+loader = store.loader
 sources = repolib.util.sources
 errors = repolib.util.errors
-load_all_sources = repolib.system.load_all_sources
 
 log = logging.getLogger("repoman.Repo")
 log.debug('Logging established')
@@ -61,60 +77,35 @@ def _do_edit_system_legacy_sources_list(name):
                 '/etc/apt/sources.list'
             ])
 
-def _add_fingerprint(key, fingerprint: str, options: str = '') -> bool:
-    if not fingerprint:
-        return False
-    
-    if options:
-        key.load_key_data(fingerprint=fingerprint, keyserver=options)
-    else:
-        key.load_key_data(fingerprint=fingerprint)
-    
-    return True
-
-def _add_ascii(key, ascii:str, options:str = '') -> bool:
-    if not ascii:
-        return False
-    
-    key.load_key_data(ascii=ascii)
-
-    return True
-
-def _add_url(key, url:str, options:str = '') -> bool:
-    if not url:
-        return False
-    
-    key.load_key_data(url=url)
+def get_key(source, key_type: str = '', key_data:str = '', key_options:str = ''):
+    """ Add a key to the system, in the calling thread.
 
-    return True
+    Use `key_fetcher` instead from the main loop, since this can wait on
+    the network.
 
-def _add_path(key, path:str, options:str = '') -> bool:
-    if not path:
-        return False
-    
-    key_path = Path(path)
-    
-    if not key_path.exists():
-        return False
-    
-    return True
+    Arguments:
+        source (:obj:`repolib.Source`): The source the key is for.
+        key_type (str): One of 'fingerprint', 'url', 'path' or 'ascii'.
+        key_data (str): The fingerprint, URL, path or armored key.
+        key_options (str): The keyserver, for fingerprints.
 
-def get_key(source, key_type: str = '', key_data:str = '', key_options:str = ''):
+    Returns:
+        The :obj:`repolib.SourceKey`.
+    """
     log.debug('Adding %s key for source %s', key_type, source.ident)
-    """Add a key to the system"""
+    return import_key(source.ident, key_type, key_data, key_options)
 
-    key = repolib.SourceKey(name=source.ident)
-    add_funcs = {
-        # 'key_type': add_function,
-        'fingerprint': _add_fingerprint,
-        'url': _add_url,
-        'path': _add_path,
-        'ascii': _add_ascii
-    }
+def key_in_use(key, ident):
+    """ Check whether a key is used by any source other than `ident`.
 
-    add_funcs[key_type](key, key_data, options=key_options)
+    Arguments:
+        key (:obj:`repolib.SourceKey`): The key to check.
+        ident (str): The ident of the source the key is being removed from.
 
-    return key
+    Returns:
+        `True` if some other source is signed with the key.
+    """
+    return store.key_in_use(key, ident)
 
 def edit_system_legacy_sources_list():
     thread = threading.Thread(
@@ -167,6 +158,14 @@ def get_repo_for_name(name):
     Returns:
         A repolib.Source (or subclass) representing the given name.
     """
+    source = source_index.get(name)
+    if source:
+        return source
+    for suffix in ('.sources', '.list'):
+        file_sources = source_index.find_by_file(f'{name}{suffix}')
+        if file_sources:
+            return file_sources[0]
+
     full_path = repolib.util.get_source_path(name)
     if full_path:
         if full_path.suffix == '.sources':
@@ -209,7 +208,7 @@ def get_all_sources(get_system=False):
 
 def get_os_codename():
     """ Returns the current OS codename."""
-    return repolib.util.DISTRO_CODENAME
+    return get_os_identity().codename
 
 def validate(line):
     """ Validate a repo line. """
@@ -229,22 +228,7 @@ def validate(line):
 
 def get_os_name():
     """ Returns the current OS name, or fallback if not available."""
-    try:
-        with open("/etc/os-release") as os_release_file:
-            os_release = os_release_file.readlines()
-            for line in os_release:
-                parse = line.split('=')
-                if parse[0] == "NAME":
-                    if parse[1].startswith('"'):
-                        return parse[1][1:-2]
-                    else:
-                        return parse[1][:-1]
-                else:
-                    continue
-    except FileNotFoundError:
-        return "your OS"
-
-    return "your OS"
+    return get_os_identity().name
 
 def get_error_messagedialog(parent, text, exc, prefix):
     """ Get an error dialog to display an error to the user.
@@ -258,6 +242,9 @@ def get_error_messagedialog(parent, text, exc, prefix):
     Returns:
         A :obj:`Gtk.MessageDialog`
     """
+    # Imported here so that headless users of this module don't load Gtk
+    from gi.repository import Gtk
+
     dialog = Gtk.MessageDialog(
         transient_for=parent,
         flags=0,
@@ -283,6 +270,18 @@ def get_error_messagedialog(parent, text, exc, prefix):
 
     return dialog
 
+def show_error_messagedialog(parent, text, exc, prefix):
+    """ Show an error dialog without blocking the main loop.
+
+    This is for errors which are reported from a callback, such as a failed
+    background write. The arguments are the same as for
+    `get_error_messagedialog`.
+    """
+    dialog = get_error_messagedialog(parent, text, exc, prefix)
+    dialog.connect('response', lambda dialog, response: dialog.destroy())
+    dialog.show()
+    return dialog
+
 def _do_add_source(name, line, dialog):
     try:
         # New process with key management
@@ -296,7 +295,7 @@ def _do_add_source(name, line, dialog):
             disabled = True
 
         if line.startswith('http') and len(line.split()) == 1:
-            line = f'deb {line} {repolib.util.DISTRO_CODENAME} main'
+            line = f'deb {line} {get_os_codename()} main'
         
         for prefix in repolib.shortcut_prefixes:
             if line.startswith(prefix):
@@ -322,7 +321,8 @@ def _do_add_source(name, line, dialog):
         log.debug('File path: %s', add_file.path)
         log.debug('Sources in file %s:\n%s', add_file.path, add_file.sources)
 
-        add_file.save()
+        # Wait for the writer so the dialog stays busy until it's saved
+        store.write_file(add_file).result()
 
     except Exception as err:
         GLib.idle_add(dialog.show_error, err)
@@ -338,17 +338,3 @@ def add_source(line, dialog):
     dialog.set_busy()
     thread = threading.Thread(target=_do_add_source, args=(1, line, dialog))
     thread.start()
-
-def delete_repo(repo):
-    """ Delete a repo from the sytem.
-
-    Note: This is about the only thing we need dbus for, so we use it here
-    and only here.
-    """
-    remove_source = repo.filename
-    remove_key = repo.key_file
-    bus = dbus.SystemBus()
-    privileged_object = bus.get_object('org.pop_os.repolib', '/Repo')
-    privileged_object.delete_source(remove_source, remove_key.name)
-    privileged_object.exit()
-    return True
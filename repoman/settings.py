@@ -22,8 +22,12 @@
 import gi
 import logging
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk, Gio
+from gi.repository import Gtk, GLib
 from . import repo
+from .mirrors import (
+    MirrorBenchmark, MirrorConfig, MirrorHealthCache, MirrorProber,
+    choose_mirrors, compare_freshness, format_freshness, format_result
+)
 from gettext import gettext as _
 
 prime_pos = Gtk.EntryIconPosition.PRIMARY
@@ -39,13 +43,31 @@ class Settings(Gtk.Box):
     def __init__(self, parent):
         Gtk.Box.__init__(self, False, 0)
 
+        self.store = parent.store
         self.system_repo = parent.system_repo
         self.log = logging.getLogger('repoman.Settings')
         self.log.debug('Logging established.')
-        self.os_name = repo.get_os_name()
+        os_identity = repo.get_os_identity()
+        self.os_name = os_identity.name
         self.handlers = {}
+        # What the component switches and mirror entries were built for, so
+        # they're only rebuilt when that changes
+        self.switch_components = None
+        self.shown_mirrors = None
         self.prev_enabled = False
-        self.proposed_name = f'{repo.get_os_codename()}-proposed'
+        self.proposed_name = f'{os_identity.codename}-proposed'
+        self.prober = MirrorProber(dispatch=GLib.idle_add)
+        self.probe_run = None
+        self.mirror_config = MirrorConfig()
+        self.benchmark = None
+        self.auto_sorted = False
+        # A faster order found by the automatic sort, for the user to apply
+        self.suggested_mirrors = None
+        self.apply_sort = True
+        # Stale mirrors are re-measured one at a time in the background
+        self.mirror_health = MirrorHealthCache()
+        self.health_prober = MirrorProber(workers=1, dispatch=GLib.idle_add)
+        self.refresh_run = None
 
         self.parent = parent
 
@@ -72,7 +94,7 @@ class Settings(Gtk.Box):
         source_label.set_halign(Gtk.Align.START)
         source_box.add(source_label)
         source_switch = Gtk.Switch()
-        source_switch.suite = f'{repo.get_os_codename()}-proposed'
+        source_switch.suite = self.proposed_name
         source_switch.set_halign(Gtk.Align.END)
 
         settings_grid = Gtk.Grid()
@@ -108,21 +130,49 @@ class Settings(Gtk.Box):
         Gtk.StyleContext.add_class(self.mirror_box.get_style_context(), 'linked')
         settings_grid.attach(self.mirror_box, 0, 2, 1, 1)
 
-        if self.system_repo:
-            if self.system_repo.default_mirror:
-                self.reset_mirrors_button = Gtk.Button()
-                self.reset_mirrors_button.set_label(_('Reset Mirrors to Defaults'))
-                self.reset_mirrors_button.set_halign(Gtk.Align.END)
-                self.reset_mirrors_button.set_margin_top(6)
-                Gtk.StyleContext.add_class(
-                    self.reset_mirrors_button.get_style_context(),
-                    'destructive-action'
-                )
-                self.reset_mirrors_button.connect(
-                    'clicked',
-                    self.on_reset_mirror_button_clicked
-                )
-                settings_grid.attach(self.reset_mirrors_button, 0, 3, 1, 1)
+        # Only shown once we know the system source has a default mirror
+        self.reset_mirrors_button = Gtk.Button()
+        self.reset_mirrors_button.set_label(_('Reset Mirrors to Defaults'))
+        self.reset_mirrors_button.set_halign(Gtk.Align.END)
+        self.reset_mirrors_button.set_margin_top(6)
+        self.reset_mirrors_button.set_no_show_all(True)
+        Gtk.StyleContext.add_class(
+            self.reset_mirrors_button.get_style_context(),
+            'destructive-action'
+        )
+        self.reset_mirrors_button.connect(
+            'clicked',
+            self.on_reset_mirror_button_clicked
+        )
+
+        self.test_mirrors_button = Gtk.Button()
+        self.test_mirrors_button.set_label(_('Test Mirror Speed'))
+        self.test_mirrors_button.set_halign(Gtk.Align.START)
+        self.test_mirrors_button.set_margin_top(6)
+        self.test_mirrors_button.connect(
+            'clicked',
+            self.on_test_mirrors_button_clicked
+        )
+
+        self.sort_mirrors_button = Gtk.Button()
+        self.sort_mirrors_button.set_label(_('Sort Mirrors by Speed'))
+        self.sort_mirrors_button.set_margin_top(6)
+        self.sort_mirrors_button.connect(
+            'clicked',
+            self.on_sort_mirrors_button_clicked
+        )
+
+        self.auto_sort_check = Gtk.CheckButton.new_with_label(_('Automatically'))
+        self.auto_sort_check.set_margin_top(6)
+        self.auto_sort_check.set_active(self.mirror_config.auto_sort)
+        self.auto_sort_check.connect('toggled', self.on_auto_sort_toggled)
+
+        mirror_buttons = Gtk.Box.new(Gtk.Orientation.HORIZONTAL, 6)
+        mirror_buttons.pack_start(self.test_mirrors_button, False, False, 0)
+        mirror_buttons.pack_start(self.sort_mirrors_button, False, False, 0)
+        mirror_buttons.pack_start(self.auto_sort_check, False, False, 0)
+        mirror_buttons.pack_end(self.reset_mirrors_button, False, False, 0)
+        settings_grid.attach(mirror_buttons, 0, 3, 1, 1)
 
         self.checks_grid = Gtk.VBox()
         self.checks_grid.set_margin_left(12)
@@ -154,20 +204,27 @@ class Settings(Gtk.Box):
         self.developer_grid.add(self.source_check)
         self.developer_grid.add(self.proposed_check)
 
-        self.create_switches()
-        if self.system_repo:
-            self.on_config_changed(None, None, None, None)
-            developer_options.grab_focus()
-        else:
-            self.switches_sensitive = False
+        self.developer_options = developer_options
+        self.set_system_repo(self.system_repo)
 
-        # Watch the config directory for changes, so we can reload if so
-        self.file = Gio.File.new_for_path('/etc/apt/sources.list.d/')
-        self.monitor = self.file.monitor_directory(Gio.FileMonitorFlags.NONE)
-        self.monitor.connect('changed', self.on_config_changed)
-        self.log.debug('Monitor Created: %s', self.monitor)
+        # Update whenever the store reports changes to the sources
+        self.store.subscribe(self.on_config_changed)
         self.show_all()
 
+    def set_system_repo(self, system_repo):
+        """ Sets the system source and updates the page to match.
+
+        The page is built before the sources finish loading, so this fills
+        it in once the system source is available.
+
+        Arguments:
+            system_repo (:obj:`repolib.Source`): The system source, or None.
+        """
+        self.system_repo = system_repo
+        self.show_system_repo()
+        if self.system_repo:
+            self.developer_options.grab_focus()
+
     @property
     def checks_enabled(self):
         """ bool: whether the checks/switches are enabled or not. """
@@ -230,8 +287,17 @@ class Settings(Gtk.Box):
     def set_mirrors(self):
         """ Sets up the list of mirrors.
 
-        Also adds a blank entry for adding a new mirror to the list.
+        Also adds a blank entry for adding a new mirror to the list. Nothing
+        is done if the list of mirrors hasn't changed since it was shown,
+        e.g. when some other part of the system source changed.
         """
+        uris = list(self.system_repo.uris)
+        if uris == self.shown_mirrors:
+            return
+        self.shown_mirrors = uris
+        if self.suggested_mirrors:
+            # The suggested order was worked out for other mirrors
+            self.show_suggested_mirrors(None)
         self.log.debug('Adding mirrors')
         for child in self.mirror_box.get_children():
             self.log.debug('Removing outdated entry for %s', child.get_text())
@@ -259,8 +325,16 @@ class Settings(Gtk.Box):
                 # Don't allow removing the last mirror
                 self.log.debug('Mirror %s is the only mirror', uri)
                 mirror_entry.set_icon_from_icon_name(sec_pos, '')
+            self.show_mirror_health(mirror_entry)
             self.mirror_box.pack_start(mirror_entry, True, True, 0)
             mirror_entry.show()
+
+        # Forget about mirrors which are no longer configured
+        self.mirror_health.prune(
+            list(self.system_repo.uris) + list(self.mirror_config.candidates)
+        )
+        self.mirror_health.save()
+        GLib.idle_add(self.refresh_mirror_health, priority=GLib.PRIORITY_LOW)
         
         if self.system_repo.default_mirror:
             if [self.system_repo.default_mirror] == self.system_repo.uris:
@@ -268,16 +342,197 @@ class Settings(Gtk.Box):
             else:
                 self.reset_mirrors_button.set_sensitive(True)
 
+    def get_mirror_suite(self):
+        """ Get the suite whose Release file is used to test mirrors. """
+        suites = list(self.system_repo.suites)
+        if suites:
+            return suites[0]
+        return repo.get_os_codename()
+
+    def on_test_mirrors_button_clicked(self, button):
+        """ :clicked: handler for the test/cancel mirror speed button. """
+        if self.probe_run and not self.probe_run.done:
+            self.log.debug('Cancelling mirror probes')
+            self.probe_run.cancel()
+            self.on_probes_done(self.probe_run.results)
+            return
+        if not self.system_repo:
+            return
+
+        for entry in self.mirror_box.get_children():
+            if entry.uri:
+                entry.set_icon_from_icon_name(prime_pos, 'content-loading-symbolic')
+                entry.set_icon_tooltip_text(prime_pos, _('Testing mirror…'))
+        self.test_mirrors_button.set_label(_('Cancel'))
+        # Candidates are measured too, so sorting has something to go on
+        self.probe_run = self.prober.probe(
+            list(self.system_repo.uris) + list(self.mirror_config.candidates),
+            self.get_mirror_suite(),
+            on_result=self.on_probe_result,
+            on_done=self.on_probes_done
+        )
+
+    def show_mirror_health(self, entry):
+        """ Show the last known health of a mirror on its entry. """
+        healthy = self.mirror_health.is_healthy(entry.uri)
+        if healthy is None:
+            entry.set_icon_from_icon_name(prime_pos, '')
+            return
+        if healthy:
+            icon_name = 'network-transmit-receive-symbolic'
+        else:
+            icon_name = 'network-error-symbolic'
+        entry.set_icon_from_icon_name(prime_pos, icon_name)
+        entry.set_icon_tooltip_text(
+            prime_pos, self.mirror_health.describe(entry.uri)
+        )
+
+    def on_probe_result(self, result):
+        """ Record the result of probing a mirror and show it on its entry. """
+        self.mirror_health.record(result)
+        if self.system_repo and result.uri not in self.system_repo.uris:
+            self.log.info('Candidate mirror %s: %s', result.uri, format_result(result))
+        for entry in self.mirror_box.get_children():
+            if entry.uri == result.uri:
+                self.show_mirror_health(entry)
+        return False
+
+    def on_probes_done(self, results):
+        """ Reset the test button once the probes finish. """
+        self.test_mirrors_button.set_label(_('Test Mirror Speed'))
+        self.mirror_health.save()
+        # A fast mirror is no use if it's behind the others
+        freshness = compare_freshness(results) if len(results) > 1 else {}
+        for entry in self.mirror_box.get_children():
+            if entry.uri and entry.uri not in results:
+                self.show_mirror_health(entry)
+            report = freshness.get(entry.uri)
+            if report and report.ok and report.lagging:
+                entry.set_icon_from_icon_name(prime_pos, 'dialog-warning-symbolic')
+                entry.set_icon_tooltip_text(
+                    prime_pos,
+                    f'{self.mirror_health.describe(entry.uri)}\n'
+                    f'{format_freshness(report)}'
+                )
+        return False
+
+    def refresh_mirror_health(self):
+        """ Re-measure mirrors whose cached health has expired.
+
+        This runs at low priority, and not while the user is testing or
+        sorting the mirrors themselves.
+        """
+        busy = [self.probe_run, self.benchmark, self.refresh_run]
+        if not self.system_repo or any(run and not run.done for run in busy):
+            return False
+        stale = self.mirror_health.get_stale(self.system_repo.uris)
+        if stale:
+            self.log.debug('Refreshing health of %s mirrors', len(stale))
+            self.refresh_run = self.health_prober.probe(
+                stale,
+                self.get_mirror_suite(),
+                on_result=self.on_probe_result,
+                on_done=lambda results: self.mirror_health.save()
+            )
+        return False
+
+    def on_sort_mirrors_button_clicked(self, button):
+        """ :clicked: handler for the sort/cancel/apply mirrors button. """
+        if self.benchmark and not self.benchmark.done:
+            self.log.debug('Cancelling mirror benchmark')
+            self.benchmark.cancel()
+            self.sort_mirrors_button.set_label(_('Sort Mirrors by Speed'))
+            return
+        if self.suggested_mirrors:
+            uris = self.suggested_mirrors
+            self.show_suggested_mirrors(None)
+            self.apply_mirror_order(uris)
+            return
+        self.sort_mirrors()
+
+    def sort_mirrors(self, apply=True):
+        """ Benchmark the mirrors, then order them fastest first.
+
+        Arguments:
+            apply (bool): Save the new order. Otherwise it's offered on the
+                sort button for the user to apply.
+        """
+        if not self.system_repo:
+            return
+        self.show_suggested_mirrors(None)
+        self.apply_sort = apply
+        config = self.mirror_config
+        uris = list(self.system_repo.uris)
+        if config.top:
+            uris += list(config.candidates)
+        self.log.info('Benchmarking %s mirrors', len(uris))
+        self.sort_mirrors_button.set_label(_('Cancel'))
+        self.benchmark = MirrorBenchmark(
+            self.prober,
+            uris,
+            self.get_mirror_suite(),
+            samples=config.samples,
+            on_done=self.on_benchmark_done
+        ).start()
+
+    def on_benchmark_done(self, stats):
+        """ Save (or offer) the mirrors in order of speed, if that differs. """
+        self.sort_mirrors_button.set_label(_('Sort Mirrors by Speed'))
+        for results in self.benchmark.results.values():
+            if results:
+                self.mirror_health.record(results[-1])
+        self.mirror_health.save()
+        if not self.system_repo:
+            return
+        config = self.mirror_config
+        uris = choose_mirrors(
+            self.system_repo.uris, stats, config.candidates, config.top
+        )
+        self.log.info('Mirrors by speed: %s', uris)
+        if list(uris) == list(self.system_repo.uris):
+            self.log.debug('The mirrors are already in order')
+        elif self.apply_sort:
+            self.apply_mirror_order(uris)
+        else:
+            self.show_suggested_mirrors(uris)
+
+    def show_suggested_mirrors(self, uris):
+        """ Offer a faster order of mirrors on the sort button, or stop. """
+        self.suggested_mirrors = uris
+        if uris:
+            self.sort_mirrors_button.set_label(_('Use Fastest Mirrors'))
+            self.sort_mirrors_button.set_tooltip_text('\n'.join(uris))
+        else:
+            self.sort_mirrors_button.set_label(_('Sort Mirrors by Speed'))
+            self.sort_mirrors_button.set_tooltip_text(None)
+
+    def apply_mirror_order(self, uris):
+        """ Save the system mirrors in the order `uris`. """
+        try:
+            self.store.set_mirrors(uris)
+        except Exception as err:
+            self.log.error('Could not sort mirrors: %s', str(err))
+            repo.show_error_messagedialog(
+                self.parent.parent,
+                f'Could not sort mirrors',
+                err,
+                'The system mirrors could not be reordered'
+            )
+
+    def on_auto_sort_toggled(self, check):
+        """ :toggled: handler for the automatic sorting check. """
+        self.mirror_config.auto_sort = check.get_active()
+        self.mirror_config.save()
+
     def do_entry_add(self, entry, *args, **kwargs):
         """ :icon-release: signal handler for the new_mirror_entry."""
         if entry.get_icon_name(prime_pos) == 'selection-checked-symbolic':
             new_uri = entry.get_text()
-            uris = self.system_repo.uris
+            uris = list(self.system_repo.uris)
             if not new_uri in uris:
                 uris.append(new_uri)
             try:
-                self.system_repo.uris = uris
-                self.system_repo.file.save()
+                self.store.set_mirrors(uris)
             except Exception as err:
                 self.log.error(
                     'Could not add mirror %s: %s', new_uri, str(err)
@@ -320,7 +575,7 @@ class Settings(Gtk.Box):
 
         Used to remove existing entries from the list.
         """
-        uris = self.system_repo.uris
+        uris = list(self.system_repo.uris)
         if entry.get_icon_name(sec_pos):
             if entry.uri in self.system_repo.uris:
                 uris.remove(entry.uri)
@@ -331,8 +586,7 @@ class Settings(Gtk.Box):
                 uris.append(entry.get_text())
 
             try:
-                self.system_repo.uris = uris
-                self.system_repo.file.save()
+                self.store.set_mirrors(uris)
             except Exception as err:
                 self.log.error(
                     'Could not remove mirror %s: %s', entry.uri, str(err)
@@ -385,12 +639,38 @@ class Settings(Gtk.Box):
         switch.show_all()
         return switch
 
+    def get_switch_components(self):
+        """ Get the components which should have a switch, in order. """
+        components = list(self.repo_descriptions)
+        if self.system_repo:
+            for component in self.system_repo.components:
+                if component in components:
+                    continue
+                if component == 'main':
+                    # Doesn't really make sense for this to be toggleable.
+                    continue
+                components.append(component)
+        return components
+
     def create_switches(self):
-        """ Create the grid of switches that control the sources. """
+        """ Create the grid of switches that control the sources.
+
+        The switches are only rebuilt when the set of components changes;
+        `show_distro` updates their states in place.
+        """
+        components = self.get_switch_components()
+        if components == self.switch_components:
+            return
+        self.switch_components = components
+
         for switch in self.checks_grid.get_children():
+            handler = self.handlers.pop(switch.toggle, None)
+            if handler and switch.toggle.handler_is_connected(handler):
+                switch.toggle.disconnect(handler)
             self.checks_grid.remove(switch)
+            switch.destroy()
 
-        for component in self.repo_descriptions:
+        for component in components:
             switch = self.get_new_switch(component)
             self.handlers[switch.toggle] = switch.toggle.connect(
                 'state-set',
@@ -399,21 +679,6 @@ class Settings(Gtk.Box):
             switch.show()
             self.checks_grid.add(switch)
 
-        if self.system_repo:
-            for component in self.system_repo.components:
-                if component in self.repo_descriptions:
-                    continue
-                if component == 'main':
-                    # Doesn't really make sense for this to be toggleable.
-                    continue
-                switch = self.get_new_switch(component)
-                self.handlers[switch.toggle] = switch.toggle.connect(
-                    'state-set',
-                    self.on_component_toggled
-                )
-                switch.show()
-                self.checks_grid.add(switch)
-
     def set_child_checks_sensitive(self):
         self.source_check.set_sensitive(self.prev_enabled)
         self.proposed_check.set_sensitive(self.prev_enabled)
@@ -453,16 +718,8 @@ class Settings(Gtk.Box):
         self.unblock_handlers()
 
     def on_component_toggled(self, switch, state):
-        components = self.system_repo.components
-        if state:
-            if switch.component not in components:
-                components.append(switch.component)
-        else:
-            if switch.component in components:
-                components.remove(switch.component)
-        self.system_repo.components = components
         try:
-            self.system_repo.file.save()
+            self.store.set_component_enabled(switch.component, state)
         except Exception as err:
             self.log.error(
                     'Could not set component: %s', str(err)
@@ -477,9 +734,8 @@ class Settings(Gtk.Box):
             err_dialog.destroy()
 
     def on_source_check_toggled(self, switch, state):
-        self.system_repo.sourcecode_enabled = state
         try:
-            self.system_repo.file.save()
+            self.store.set_sourcecode_enabled(state)
         except Exception as err:
             self.log.error(
                     'Could not set source code: %s', str(err)
@@ -494,16 +750,8 @@ class Settings(Gtk.Box):
             err_dialog.destroy()
 
     def on_proposed_check_toggled(self, switch, state):
-        suites = self.system_repo.suites
-        if state:
-            if switch.component not in suites:
-                suites.append(switch.component)
-        else:
-            if switch.component in suites:
-                suites.remove(switch.component)
-        self.system_repo.suites = suites
         try:
-            self.system_repo.file.save()
+            self.store.set_suite_enabled(switch.component, state)
         except Exception as err:
             self.log.error(
                     'Could not set suite: %s', str(err)
@@ -517,19 +765,36 @@ class Settings(Gtk.Box):
             err_dialog.run()
             err_dialog.destroy()
 
-    def on_config_changed(self, monitor, file, other_file, event_type):
-        self.log.debug('Installation changed, regenerating list')
+    def show_system_repo(self):
+        """ Update all of the widgets to match the system source. """
         if self.system_repo:
+            self.reset_mirrors_button.set_visible(
+                bool(self.system_repo.default_mirror)
+            )
             self.show_distro()
             self.show_source_code()
             self.show_proposed()
             self.set_mirrors()
+            if self.mirror_config.auto_sort and not self.auto_sorted:
+                # Once per session. Opening the settings mustn't rewrite the
+                # system source, so a faster order is only offered.
+                self.auto_sorted = True
+                self.sort_mirrors(apply=False)
+        else:
+            self.create_switches()
+            self.switches_sensitive = False
+
+    def on_config_changed(self, paths, delta):
+        """ SourceStore subscriber for changes to the sources. """
+        if 'system' in delta:
+            self.log.debug('System source changed, updating settings')
+            self.system_repo = self.store.system_source
+            self.show_system_repo()
 
     def on_reset_mirror_button_clicked(self, button):
         self.log.warning('Resetting mirrors to default values.')
         try:
-            self.system_repo.uris = [self.system_repo.default_mirror]
-            self.system_repo.file.save()
+            self.store.reset_mirrors()
         except Exception as err:
             self.log.error(
                 'Could not reset mirrors'
@@ -19,13 +19,17 @@
     along with Repoman.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
+import logging
+
 import gi
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk
+from gi.repository import Gtk, GLib
 from .settings import Settings
 from .updates import Updates
 from .list import List
 from . import repo
+from .keys import key_info
+from .watcher import SourcesWatcher
 try:
     from .flatpak import Flatpak
 except (ImportError, ValueError):
@@ -38,13 +42,21 @@ class Stack(Gtk.Box):
     def __init__(self, parent):
         Gtk.Box.__init__(self, orientation=Gtk.Orientation.VERTICAL, spacing=6)
         self.parent = parent
-        try:
-            self.system_repo = repo.get_system_repo()
-        except:
-            self.system_repo = None
+        self.log = logging.getLogger('repoman.Stack')
+
+        # The pages start out empty and are filled in once the sources load.
+        self.system_repo = None
         self.sources = {}
         self.errors = {}
-        self.sources, self.errors = repo.get_all_sources()
+        self.store = repo.store
+        self.watcher = SourcesWatcher(self.store)
+        # Coalesced writes are scheduled, and writer callbacks run, on the
+        # main loop
+        self.store.writes.schedule = self.schedule_write
+        self.store.writer.dispatch = GLib.idle_add
+        repo.key_fetcher.dispatch = GLib.idle_add
+        repo.privileged_helper.schedule = self.schedule_write
+        self.store.on_write_error = self.on_write_error
 
         self.stack = Gtk.Stack()
         self.stack.set_transition_type(Gtk.StackTransitionType.SLIDE_LEFT_RIGHT)
@@ -67,4 +79,54 @@ class Stack(Gtk.Box):
 
         self.pack_start(self.stack, True, True, 0)
 
+        self.parent.hbar.spinner.start()
+        future = self.store.start()
+        future.add_done_callback(
+            lambda future: GLib.idle_add(self.on_sources_loaded, future)
+        )
+
+    def schedule_write(self, delay, callback):
+        """ Run delayed callbacks on the main loop instead of a thread. """
+        timeout_id = GLib.timeout_add(delay, callback)
+        return lambda: GLib.source_remove(timeout_id)
+
+    def on_write_error(self, file, err):
+        """ Tell the user about a coalesced change which couldn't be saved. """
+        repo.show_error_messagedialog(
+            self.parent,
+            f'Could not save {file.path.name}',
+            err,
+            'The changes to the system sources could not be saved'
+        )
+
+    def on_sources_loaded(self, future):
+        """ Fill in the pages once the background source load finishes.
+
+        This is called on the main loop through GLib.idle_add.
+
+        Arguments:
+            future (:obj:`concurrent.futures.Future`): The finished load.
+        """
+        self.parent.hbar.spinner.stop()
+        try:
+            future.result()
+        except Exception as err:
+            self.log.error('Could not load sources: %s', err)
+            return False
+
+        self.sources, self.errors = repo.get_all_sources()
+        self.system_repo = self.store.system_source
+
+        self.setting.set_system_repo(self.system_repo)
+        self.updates.set_system_repo(self.system_repo)
+        self.list_all.generate_entries()
+        # Read the keyrings now so the edit dialog doesn't have to
+        with self.store.index.lock:
+            key_paths = list(self.store.index.by_key)
+        key_info.refresh_in_background(key_paths)
+
+        if self.errors:
+            self.parent.show_source_errors()
+        return False
+
 
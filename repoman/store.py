@@ -0,0 +1,405 @@
+#!/usr/bin/python3
+'''
+   Copyright 2020 Ian Santopietro (ian@system76.com)
+
+   This file is part of Repoman.
+
+    Repoman is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Repoman is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Repoman.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import logging
+
+import repolib
+
+from . import loader
+from .loader import SourceDelta, SourceLoader
+from .writer import (
+    DiskHashes, SelfWrites, SourceWriter, WriteCoalescer, save_source_file
+)
+
+class SourceStore:
+    """ The model holding all of the APT sources on the system.
+
+    The store owns loading the sources, the index over them, every change
+    made to them and notifying interested parties about those changes. It
+    doesn't depend on Gtk, so it can be used from the command line or tests
+    as well as by the pages of the GUI, which are views over it.
+
+    Subscribers are called as `callback(paths, delta)` whenever the loaded
+    sources change, where `paths` is the set of files involved and `delta`
+    is a :obj:`SourceDelta`.
+
+    Files are written by `writer` on a background thread, atomically, and
+    only if their contents actually changed. Once a write finishes, the
+    saved file is put into the loaded sources directly and subscribers are
+    notified; the monitor events caused by the write are recognised through
+    `self_writes` and don't cause the file to be parsed again. Methods which
+    save take an optional `callback(file, err)` which is run once the write
+    finishes, and return a future for it. Changes to the system source made
+    by the Settings and Updates pages are coalesced through `writes`, so
+    flipping several switches in a row rewrites the file once; call `flush`
+    to write them out immediately.
+
+    Attributes:
+        writer (:obj:`SourceWriter`): The background writer.
+        writes (:obj:`WriteCoalescer`): Pending writes to source files.
+        on_write_error (function): Called as `on_write_error(file, err)`
+            when a coalesced write fails.
+        writes_skipped (int): The number of saves skipped because the file
+            on disk already had the same contents.
+        notifications (int): The number of times subscribers were notified.
+        helper (:obj:`PrivilegedHelper`): Writes the files this process
+            can't write itself; if None, repolib saves them.
+    """
+
+    def __init__(self, helper=None):
+        self.log = logging.getLogger('repoman.SourceStore')
+        self.loader = SourceLoader()
+        self.index = loader.source_index
+        self.subscribers = []
+        self.notifications = 0
+        self.writer = SourceWriter()
+        self.writes = WriteCoalescer(
+            lambda file: self.write_file(file, self._on_coalesced_write)
+        )
+        self.on_write_error = None
+        self.disk_hashes = DiskHashes()
+        self.self_writes = SelfWrites(self.disk_hashes)
+        self.writes_skipped = 0
+        self.helper = helper
+
+    # Loading
+    @property
+    def loaded(self):
+        """ bool: Whether the initial load has finished. """
+        return self.loader.loaded
+
+    def start(self):
+        """ Start loading the sources in the background.
+
+        Returns:
+            A :obj:`concurrent.futures.Future` for the load.
+        """
+        return self.loader.start()
+
+    def load(self, workers=None):
+        """ Load all of the sources in the calling thread.
+
+        Returns:
+            The (sources, errors) tuple.
+        """
+        return loader.load_all_sources(workers=workers)
+
+    def reload_paths(self, paths):
+        """ Reload the given files and notify subscribers of the changes.
+
+        Arguments:
+            paths (iterable): The paths of the files which changed.
+
+        Returns:
+            The combined :obj:`SourceDelta`.
+        """
+        paths = set(str(path) for path in paths)
+        delta = SourceDelta()
+        for path in sorted(paths):
+            delta.merge(loader.reload_source_file(path))
+        self.notify(paths, delta)
+        return delta
+
+    # Queries
+    @property
+    def sources(self):
+        """ dict: The loaded sources, by ident. """
+        return repolib.util.sources
+
+    @property
+    def errors(self):
+        """ dict: Errors from files which couldn't be loaded, by name. """
+        return repolib.util.errors
+
+    @property
+    def system_source(self):
+        """ The system source, or None if there isn't one. """
+        return self.sources.get('system')
+
+    def get(self, ident):
+        """ Get the source with `ident`, or None. """
+        source = self.index.get(ident)
+        if source is None:
+            source = self.sources.get(ident)
+        return source
+
+    def key_in_use(self, key, ident):
+        """ Check whether `key` is used by any source other than `ident`. """
+        if not key:
+            return False
+        return self.index.key_in_use(key.path, exclude=ident)
+
+    # Notification
+    def subscribe(self, callback):
+        """ Call `callback(paths, delta)` whenever the sources change. """
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """ Stop calling `callback` when the sources change. """
+        if callback in self.subscribers:
+            self.subscribers.remove(callback)
+
+    def notify(self, paths, delta):
+        """ Tell every subscriber about a change. """
+        if not delta:
+            return
+        self.log.debug('Sources changed: %s', delta)
+        self.notifications += 1
+        for callback in list(self.subscribers):
+            callback(paths, delta)
+
+    # Mutation
+    def _save_file(self, file):
+        self.log.debug('Saving file %s', file.path)
+        if not save_source_file(
+            file, self.disk_hashes, self.self_writes, self.helper
+        ):
+            self.writes_skipped += 1
+
+    def _on_coalesced_write(self, file, err):
+        if err and self.on_write_error:
+            self.on_write_error(file, err)
+
+    def write_file(self, file, callback=None):
+        """ Queue a source file to be written by the background writer.
+
+        Arguments:
+            file (:obj:`repolib.SourceFile`): The file to write.
+            callback (function): Called as `callback(file, err)` afterwards.
+
+        Returns:
+            A :obj:`concurrent.futures.Future` for the write.
+        """
+        def on_written(file, err):
+            self.notify({str(file.path)}, self._apply_write(file, err))
+            if callback:
+                callback(file, err)
+
+        return self.writer.submit(self._save_file, file, on_written)
+
+    def write_files(self, files, callback=None):
+        """ Queue several files, notifying subscribers once for all of them.
+
+        Arguments:
+            files (iterable): The :obj:`repolib.SourceFile` objects to write.
+            callback (function): Called as `callback(errors)` once every file
+                has been written, where `errors` is a list of (file,
+                exception) tuples.
+
+        Returns:
+            A list of :obj:`concurrent.futures.Future` for the writes.
+        """
+        files = list(files)
+        results = []
+        if not files:
+            if callback:
+                callback([])
+            return []
+
+        def on_written(file, err):
+            # Writer callbacks are dispatched one at a time, in order.
+            results.append((file, err))
+            if len(results) < len(files):
+                return
+            delta = SourceDelta()
+            for file, err in results:
+                delta.merge(self._apply_write(file, err))
+            self.notify({str(file.path) for file, err in results}, delta)
+            if callback:
+                callback([(file, err) for file, err in results if err])
+
+        return [
+            self.writer.submit(self._save_file, file, on_written)
+            for file in files
+        ]
+
+    def _apply_write(self, file, err):
+        """ Update the loaded sources after a write finished. """
+        if err:
+            # Put the loaded sources back in line with the disk
+            self.self_writes.forget(file.path)
+            return loader.reload_source_file(file.path)
+        return loader.reload_source_file(file.path, sourcefile=file)
+
+    def is_own_write(self, path):
+        """ Check whether a change to `path` was made by this store. """
+        return self.self_writes.is_own(path)
+
+    def save_source(self, source, callback=None):
+        """ Write a modified source back to its file.
+
+        Arguments:
+            source (:obj:`repolib.Source`): The source which was changed.
+            callback (function): Called as `callback(file, err)` afterwards.
+
+        Returns:
+            A :obj:`concurrent.futures.Future` for the write.
+        """
+        self.log.debug('Saving source %s', source.ident)
+        # This writes any queued changes to the same file too
+        self.writes.discard(source.file.path)
+        self.index.update(source)
+        return self.write_file(source.file, callback)
+
+    def queue_save(self, source):
+        """ Schedule a modified source to be written with other changes.
+
+        Arguments:
+            source (:obj:`repolib.Source`): The source which was changed.
+        """
+        self.index.update(source)
+        self.writes.add(source.file)
+
+    def flush(self, wait=False, callback=None):
+        """ Write any changes which are still waiting to be saved.
+
+        Arguments:
+            wait (bool): Block until every queued write has finished and
+                the loaded sources have been updated from it.
+            callback (function): Dispatched as `callback(errors)` once every
+                queued write has finished, without blocking; see
+                `SourceWriter.when_idle`.
+
+        Returns:
+            A list of (file, exception) tuples for files which couldn't be
+            saved, if `wait` is True, otherwise an empty list.
+        """
+        self.writes.flush()
+        if wait:
+            return self.writer.wait()
+        if callback:
+            self.writer.when_idle(callback)
+        return []
+
+    def remove_source(self, ident, callback=None):
+        """ Remove a source from its file.
+
+        Arguments:
+            ident (str): The ident of the source to remove.
+            callback (function): Called as `callback(file, err)` afterwards.
+
+        Returns:
+            A :obj:`concurrent.futures.Future` for the write.
+        """
+        source = self.get(ident)
+        if source is None:
+            raise KeyError(f'No source {ident}')
+        file = source.file
+        self.log.info('Removing source %s from %s', ident, file.path)
+        file.remove_source(ident)
+        self.writes.discard(file.path)
+        return self.write_file(file, callback)
+
+    def set_source_key(self, source, key=None, key_path=None, callback=None):
+        """ Set the signing key of a source and save it.
+
+        Arguments:
+            source (:obj:`repolib.Source`): The source to change.
+            key (:obj:`repolib.SourceKey`): The key to sign the source with.
+            key_path (str): The path to an existing keyring to use instead.
+            callback (function): Called as `callback(file, err)` afterwards.
+
+        Returns:
+            A :obj:`concurrent.futures.Future` for the write.
+        """
+        if key_path:
+            source.signed_by = key_path
+        else:
+            source.key = key
+            source.signed_by = str(key.path)
+        return self.save_source(source, callback)
+
+    def remove_source_key(self, source, callback=None):
+        """ Remove the signing key from a source.
+
+        The keyring itself is deleted unless another source still uses it.
+
+        Arguments:
+            source (:obj:`repolib.Source`): The source to change.
+            callback (function): Called as `callback(file, err)` afterwards.
+
+        Returns:
+            A :obj:`concurrent.futures.Future` for the write.
+        """
+        old_key = source.key
+        source.key = None
+        source.signed_by = ''
+        if old_key:
+            if self.key_in_use(old_key, source.ident):
+                self.log.info(
+                    'Key file %s in use with another key, not deleting',
+                    old_key.path
+                )
+            else:
+                self.log.warning(
+                    'No other source found using the key %s, deleting',
+                    old_key.path
+                )
+                old_key.delete_key()
+        return self.save_source(source, callback)
+
+    def _set_member(self, values, value, enabled):
+        values = list(values)
+        if enabled and value not in values:
+            values.append(value)
+        elif not enabled and value in values:
+            values.remove(value)
+        return values
+
+    # The setters below don't queue anything when the value is already set,
+    # e.g. when a page puts its switches back to the current state.
+    def set_component_enabled(self, component, enabled):
+        """ Enable or disable a component of the system source. """
+        source = self.system_source
+        components = self._set_member(source.components, component, enabled)
+        if components != list(source.components):
+            source.components = components
+            self.queue_save(source)
+
+    def set_suite_enabled(self, suite, enabled):
+        """ Enable or disable a suite of the system source. """
+        source = self.system_source
+        suites = self._set_member(source.suites, suite, enabled)
+        if suites != list(source.suites):
+            source.suites = suites
+            self.queue_save(source)
+
+    def set_sourcecode_enabled(self, enabled):
+        """ Enable or disable source code for the system source. """
+        source = self.system_source
+        current = source.sourcecode_enabled
+        if hasattr(current, 'get_bool'):
+            current = current.get_bool()
+        if bool(current) != bool(enabled):
+            source.sourcecode_enabled = enabled
+            self.queue_save(source)
+
+    def set_mirrors(self, uris):
+        """ Set the list of mirrors used by the system source. """
+        source = self.system_source
+        uris = list(uris)
+        if uris != list(source.uris):
+            source.uris = uris
+            self.queue_save(source)
+
+    def reset_mirrors(self):
+        """ Reset the system source to its default mirror. """
+        source = self.system_source
+        self.set_mirrors([source.default_mirror])
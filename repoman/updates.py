@@ -22,28 +22,30 @@
 import logging
 import gi
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk, Gio
+from gi.repository import Gtk
 from gettext import gettext as _
 
 from . import repo
 
 class Updates(Gtk.Box):
 
-    distro_codename = repo.get_os_codename()
-    os_name = repo.get_os_name()
-    repo_descriptions = {
-        f'{distro_codename}-security': _('Important security updates'),
-        f'{distro_codename}-updates': _('Recommended updates'),
-        f'{distro_codename}-backports': _('Unsupported updates')
-    }
-
     def __init__(self, parent):
         Gtk.Box.__init__(self, False, 0)
 
         self.log = logging.getLogger("repoman.Updates")
         self.log.debug('Logging established')
 
+        os_identity = repo.get_os_identity()
+        self.distro_codename = os_identity.codename
+        self.os_name = os_identity.name
+        self.repo_descriptions = {
+            f'{self.distro_codename}-security': _('Important security updates'),
+            f'{self.distro_codename}-updates': _('Recommended updates'),
+            f'{self.distro_codename}-backports': _('Unsupported updates')
+        }
+
         self.parent = parent
+        self.store = parent.store
         self.system_repo = parent.system_repo
         self.handlers = {}
 
@@ -77,17 +79,23 @@ class Updates(Gtk.Box):
         updates_grid.attach(self.checks_grid, 0, 2, 1, 1)
         self.checks_grid.show()
 
+        self.set_system_repo(self.system_repo)
+
+        # Update whenever the store reports changes to the sources
+        self.store.subscribe(self.on_config_changed)
+        self.show_all()
+
+    def set_system_repo(self, system_repo):
+        """ Sets the system source and updates the switches to match.
+
+        Arguments:
+            system_repo (:obj:`repolib.Source`): The system source, or None.
+        """
+        self.system_repo = system_repo
         self.create_switches()
         self.set_suites_enabled(self.parent.setting.checks_enabled)
         if self.system_repo:
             self.show_updates()
-        
-        # Watch the config directory for changes, so we can reload if so
-        self.file = Gio.File.new_for_path('/etc/apt/sources.list.d/')
-        self.monitor = self.file.monitor_directory(Gio.FileMonitorFlags.NONE)
-        self.monitor.connect('changed', self.on_config_changed)
-        self.log.debug('Monitor Created: %s', self.monitor)
-        self.show_all()
 
     def block_handlers(self):
         for widget in self.handlers:
@@ -189,16 +197,8 @@ class Updates(Gtk.Box):
 
     def on_suite_toggled(self, switch, state):
         """ state-set handler for suite switches. """
-        suites = self.system_repo.suites
-        if state:
-            if switch.suite not in suites:
-                suites.append(switch.suite)
-        else:
-            if switch.suite in suites:
-                suites.remove(switch.suite)
-        self.system_repo.suites = suites
         try:
-            self.system_repo.file.save()
+            self.store.set_suite_enabled(switch.suite, state)
         except Exception as err:
             self.log.error(
                     'Could not set suite: %s', str(err)
@@ -212,8 +212,11 @@ class Updates(Gtk.Box):
             err_dialog.run()
             err_dialog.destroy()
 
-    def on_config_changed(self, monitor, file, other_file, event_type):
-        self.log.debug('Installation changed, regenerating list')
-        if self.system_repo:
-            self.show_updates()
+    def on_config_changed(self, paths, delta):
+        """ SourceStore subscriber for changes to the sources. """
+        if 'system' in delta:
+            self.log.debug('System source changed, updating suites')
+            self.system_repo = self.store.system_source
+            if self.system_repo:
+                self.show_updates()
             self.set_suites_enabled(self.parent.setting.checks_enabled)
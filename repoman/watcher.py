@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+'''
+   Copyright 2020 Ian Santopietro (ian@system76.com)
+
+   This file is part of Repoman.
+
+    Repoman is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Repoman is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Repoman.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import logging
+
+import gi
+from gi.repository import Gio, GLib
+import repolib
+
+
+# Milliseconds to wait for a burst of events to settle before reloading
+DEFAULT_DELAY = 150
+
+# Monitor events after which a file's contents are worth reparsing. Plain
+# CHANGED events arrive in bursts while a file is written, and are always
+# followed by CHANGES_DONE_HINT.
+RELOAD_EVENTS = (
+    Gio.FileMonitorEvent.CREATED,
+    Gio.FileMonitorEvent.DELETED,
+    Gio.FileMonitorEvent.CHANGES_DONE_HINT,
+    Gio.FileMonitorEvent.MOVED_IN,
+    Gio.FileMonitorEvent.MOVED_OUT,
+    Gio.FileMonitorEvent.RENAMED,
+)
+
+class SourcesWatcher:
+    """ Watches the sources directory on behalf of the whole application.
+
+    Events are collected until none have arrived for `delay` milliseconds,
+    then the touched files are handed to the :obj:`SourceStore` in a single
+    batch, which reloads each of them once and notifies its subscribers.
+    Files which are exactly as repoman itself last wrote them are skipped.
+
+    Attributes:
+        events (int): The number of monitor events received.
+        suppressed (int): The number of files skipped because the change
+            was repoman's own write.
+        reloads (int): The number of times a batch of files was reloaded.
+        files_reloaded (int): The number of individual file reloads.
+    """
+
+    def __init__(self, store, path=None, delay=DEFAULT_DELAY):
+        self.log = logging.getLogger('repoman.SourcesWatcher')
+        self.store = store
+        self.delay = delay
+        self.pending = set()
+        self.timeout_id = 0
+
+        self.events = 0
+        self.suppressed = 0
+        self.reloads = 0
+        self.files_reloaded = 0
+
+        path = path or repolib.util.SOURCES_DIR
+        self.file = Gio.File.new_for_path(str(path))
+        self.monitor = self.file.monitor_directory(Gio.FileMonitorFlags.NONE)
+        self.monitor.connect('changed', self.on_changed)
+        self.log.debug('Monitor Created: %s', self.monitor)
+
+    def on_changed(self, monitor, file, other_file, event_type):
+        """ Gio.FileMonitor::changed handler. """
+        self.events += 1
+        if event_type not in RELOAD_EVENTS:
+            return
+        for changed_file in (file, other_file):
+            if changed_file and changed_file.get_path():
+                self.pending.add(changed_file.get_path())
+
+        # Restart the window on every event so a burst is handled once
+        if self.timeout_id:
+            GLib.source_remove(self.timeout_id)
+        self.timeout_id = GLib.timeout_add(self.delay, self.on_timeout)
+
+    def on_timeout(self):
+        """ GLib timeout handler for the end of a burst. """
+        self.timeout_id = 0
+        self.flush()
+        return False
+
+    def flush(self):
+        """ Reload everything touched since the last flush. """
+        if self.timeout_id:
+            GLib.source_remove(self.timeout_id)
+            self.timeout_id = 0
+        paths = self.pending
+        self.pending = set()
+        if not paths or not self.store.loaded:
+            # Nothing to do, or the initial load will pick the changes up.
+            return
+
+        # The store already holds what it wrote itself
+        own = {path for path in paths if self.store.is_own_write(path)}
+        self.suppressed += len(own)
+        paths -= own
+        if not paths:
+            return
+
+        self.reloads += 1
+        self.files_reloaded += len(paths)
+        self.log.debug(
+            'Reloading %s files (%s events, %s reloads)',
+            len(paths), self.events, self.reloads
+        )
+        self.store.reload_paths(paths)
@@ -56,13 +56,13 @@ class Window(Gtk.Window):
           Gtk.STYLE_PROVIDER_PRIORITY_USER)
         
         self.show_all()
-        
-        # Show an error dialog to inform the user about source errors.
-        if self.stack.errors:
-            self.get_repos_error_dialog()
-            self.err_dialog.run()
-            self.err_dialog.destroy()
-    
+
+    def show_source_errors(self):
+        """ Show an error dialog to inform the user about source errors."""
+        self.get_repos_error_dialog()
+        self.err_dialog.run()
+        self.err_dialog.destroy()
+
     def get_repos_error_dialog(self):
         err_string = 'The following source files had errors and were omitted:\n'
         for file in self.stack.errors:
@@ -0,0 +1,507 @@
+#!/usr/bin/python3
+'''
+   Copyright 2020 Ian Santopietro (ian@system76.com)
+
+   This file is part of Repoman.
+
+    Repoman is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Repoman is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Repoman.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from collections import deque
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+from .cache import file_stamp
+
+log = logging.getLogger('repoman.Writer')
+
+# Milliseconds to wait for more changes to a file before writing it
+DEFAULT_DELAY = 300
+
+# Mode for newly created source files
+DEFAULT_MODE = 0o644
+
+def content_hash(data):
+    """ Get the hash used to compare file contents. """
+    return hashlib.sha256(data).hexdigest()
+
+def atomic_write(path, data, mode=DEFAULT_MODE):
+    """ Replace the contents of `path` so it's never seen half-written.
+
+    The data is written to a temporary file in the same directory and
+    synced to disk before being renamed over `path`, so readers (and a power
+    cut) see either the old contents or the new ones.
+
+    This needs write access to the directory, which for sources.list.d means
+    running as root (e.g. the CLI under sudo); see `save_source_file`.
+
+    Arguments:
+        path (:obj:`Path`): The file to write.
+        data (bytes): The new contents.
+        mode (int): The permissions for the file, if it doesn't exist yet.
+    """
+    try:
+        mode = os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        pass
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.')
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(data)
+            tmp_file.flush()
+            os.fchmod(tmp_file.fileno(), mode)
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_name, path)
+    except:
+        os.unlink(tmp_name)
+        raise
+    dir_fd = os.open(path.parent, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+class DiskHashes:
+    """ Hashes of the source files as they are on disk.
+
+    A hash is trusted for as long as the file's stamp (size, mtime, inode)
+    matches the one it was recorded with; otherwise the file is read and
+    hashed again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, path):
+        """ Get the hash of the current contents of `path`, or None. """
+        stamp = file_stamp(path)
+        if not stamp:
+            return None
+        with self.lock:
+            entry = self.entries.get(str(path))
+        if entry and entry[0] == stamp:
+            return entry[1]
+        try:
+            with open(path, 'rb') as disk_file:
+                digest = content_hash(disk_file.read())
+        except OSError:
+            return None
+        self.put(path, digest, stamp)
+        return digest
+
+    def put(self, path, digest, stamp=None):
+        """ Record the hash of what was just written to `path`. """
+        stamp = stamp or file_stamp(path)
+        with self.lock:
+            if stamp:
+                self.entries[str(path)] = (stamp, digest)
+            else:
+                self.entries.pop(str(path), None)
+
+    def discard(self, path):
+        """ Forget the hash of `path`. """
+        with self.lock:
+            self.entries.pop(str(path), None)
+
+class SelfWrites:
+    """ The files repoman wrote itself, and what it wrote to them.
+
+    Before a file is written, the hash of its new contents is registered
+    here. When a monitor later reports a change to the file, `is_own`
+    compares what's on disk with that hash: if they match, the change is
+    repoman's own and the file doesn't need to be parsed again. Anything
+    else, such as an edit by apt-add-repository or a text editor, doesn't
+    match and is reloaded as usual.
+
+    Attributes:
+        suppressed (int): The number of events recognised as our own.
+    """
+
+    # Registered for files which are being removed
+    REMOVED = ''
+
+    def __init__(self, hashes):
+        self.hashes = hashes
+        self.lock = threading.Lock()
+        self.expected = {}
+        self.suppressed = 0
+
+    def expect(self, path, digest):
+        """ Register an upcoming write of content with `digest` to `path`. """
+        with self.lock:
+            self.expected[str(path)] = digest
+
+    def forget(self, path):
+        """ Stop treating changes to `path` as our own. """
+        with self.lock:
+            self.expected.pop(str(path), None)
+
+    def is_own(self, path):
+        """ Check whether `path` is exactly as repoman last wrote it.
+
+        Arguments:
+            path (:obj:`Path`): A file a monitor reported a change to.
+
+        Returns:
+            `True` if the change came from repoman and can be ignored.
+        """
+        with self.lock:
+            digest = self.expected.get(str(path))
+        if digest is None:
+            return False
+        if digest == self.REMOVED:
+            own = not os.path.exists(path)
+        else:
+            own = self.hashes.get(path) == digest
+        with self.lock:
+            if own:
+                self.suppressed += 1
+            else:
+                # Someone else has changed it since
+                self.expected.pop(str(path), None)
+        return own
+
+def is_writable(directory):
+    """ Check whether this process can create and replace files in `directory`. """
+    return os.access(directory, os.W_OK)
+
+def _save_privileged(file, helper):
+    """ Save (or remove) a file through the privileged helper.
+
+    Without a helper the file is saved by repolib, which connects to the
+    helper afresh for every file.
+    """
+    if helper is None:
+        file.save()
+    elif file.sources:
+        helper.call('output_file_to_disk', file.path.name, file.output)
+    else:
+        helper.call('delete_source_file', file.path.name)
+
+def save_source_file(file, hashes, self_writes=None, helper=None):
+    """ Write a source file, unless it already has the same contents.
+
+    When the process can write to the file's directory (i.e. it runs as
+    root), the file is replaced with `atomic_write`. Otherwise, as for the
+    GUI, which runs unprivileged, it is written by repolib's privileged
+    helper through `helper`, so a run of saves activates the helper once;
+    that write is not atomic, and repoman has no control over it. Either
+    way, unchanged files aren't written at all.
+
+    Arguments:
+        file (:obj:`repolib.SourceFile`): The file to save.
+        hashes (:obj:`DiskHashes`): The hashes of the files on disk.
+        self_writes (:obj:`SelfWrites`): Where to register the write so the
+            resulting monitor events can be recognised.
+        helper (:obj:`PrivilegedHelper`): The helper for files this process
+            can't write itself.
+
+    Returns:
+        `True` if the file was written (or removed), `False` if it was
+        already up to date.
+    """
+    path = file.path
+    if not file.sources:
+        # repolib removes files with no sources left in them
+        hashes.discard(path)
+        if self_writes:
+            self_writes.expect(path, SelfWrites.REMOVED)
+        if is_writable(path.parent):
+            file.save()
+        else:
+            _save_privileged(file, helper)
+        return True
+
+    data = file.output.encode()
+    digest = content_hash(data)
+    if hashes.get(path) == digest:
+        log.debug('%s is unchanged, not writing it', path)
+        return False
+
+    if self_writes:
+        self_writes.expect(path, digest)
+    if not is_writable(path.parent):
+        log.debug('Cannot write to %s, saving %s through the helper', path.parent, path)
+        hashes.discard(path)
+        _save_privileged(file, helper)
+        return True
+    try:
+        atomic_write(path, data)
+    except PermissionError as err:
+        # We may be able to write the directory but not replace the file
+        log.debug('Could not replace %s (%s), saving through the helper', path, err)
+        hashes.discard(path)
+        _save_privileged(file, helper)
+        return True
+    hashes.put(path, digest)
+    return True
+
+def call_now(callback, *args):
+    """ Run `callback` right away, on whichever thread is calling. """
+    callback(*args)
+    return False
+
+def thread_schedule(delay, callback):
+    """ Call `callback` after `delay` milliseconds on a timer thread.
+
+    This is the default scheduler for a :obj:`WriteCoalescer`; the GUI
+    replaces it with one which runs on the GLib main loop.
+
+    Returns:
+        A function which cancels the call if it hasn't happened yet.
+    """
+    timer = threading.Timer(delay / 1000, callback)
+    timer.daemon = True
+    timer.start()
+    return timer.cancel
+
+class WriteCoalescer:
+    """ Gathers changes to source files and writes each file once.
+
+    Every change marks its file as pending and (re)starts a short idle
+    window; when the window passes without further changes, each pending
+    file is saved a single time no matter how many changes were made to it.
+    Call `flush` to write everything immediately, e.g. before quitting.
+
+    Attributes:
+        schedule (function): `schedule(delay, callback)` calls `callback`
+            after `delay` milliseconds and returns a function to cancel it.
+        mutations (int): The number of changes made.
+        flushes (int): The number of times a file was actually saved.
+    """
+
+    def __init__(self, save, delay=DEFAULT_DELAY, schedule=None):
+        self.log = logging.getLogger('repoman.WriteCoalescer')
+        self.save = save
+        self.delay = delay
+        self.schedule = schedule or thread_schedule
+        self.lock = threading.RLock()
+        self.pending = {}
+        self._cancel = None
+
+        self.mutations = 0
+        self.flushes = 0
+
+    def __contains__(self, path):
+        return str(path) in self.pending
+
+    def add(self, file):
+        """ Note a change to `file` and schedule it to be written.
+
+        Arguments:
+            file (:obj:`repolib.SourceFile`): The file which was changed.
+        """
+        with self.lock:
+            self.mutations += 1
+            self.pending[str(file.path)] = file
+            # Restart the window so a run of changes is written once
+            if self._cancel:
+                self._cancel()
+            self._cancel = self.schedule(self.delay, self.on_timeout)
+
+    def discard(self, path):
+        """ Forget a pending write, e.g. because the file was just saved. """
+        with self.lock:
+            self.pending.pop(str(path), None)
+
+    def on_timeout(self):
+        """ Scheduler callback for the end of the idle window. """
+        with self.lock:
+            self._cancel = None
+        self.flush()
+        return False
+
+    def flush(self):
+        """ Hand every pending file to the writer now.
+
+        Returns:
+            A list of the futures for the writes, see `SourceWriter.submit`.
+        """
+        with self.lock:
+            if self._cancel:
+                self._cancel()
+                self._cancel = None
+            files = list(self.pending.values())
+            self.pending = {}
+            self.flushes += len(files)
+
+        if files:
+            self.log.debug(
+                'Writing %s files (%s changes, %s writes so far)',
+                len(files), self.mutations, self.flushes
+            )
+        return [self.save(file) for file in files]
+
+class SourceWriter:
+    """ Writes source files one at a time on a background thread.
+
+    Saves are queued in the order they're submitted and run by a single
+    worker, so writes to the same file always land in order and the main
+    loop never waits on the disk. When a save finishes, its callback is
+    passed to `dispatch`, which the GUI sets to `GLib.idle_add` so callbacks
+    run on the main loop.
+
+    With the default dispatch there is no main loop to hand callbacks to, so
+    they are queued and run on the thread which calls `wait` (or
+    `run_callbacks`), never on the writer thread.
+
+    Attributes:
+        dispatch (function): `dispatch(callback, *args)` runs a callback.
+        writes (int): The number of files written.
+        failures (int): The number of writes which raised an exception.
+    """
+
+    def __init__(self, dispatch=None):
+        self.log = logging.getLogger('repoman.SourceWriter')
+        self.dispatch = dispatch or call_now
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='repoman-writer'
+        )
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.pending = deque()
+        self.errors = []
+
+        self.writes = 0
+        self.failures = 0
+
+    def submit(self, save, file, callback=None):
+        """ Queue a write.
+
+        Arguments:
+            save (function): Called as `save(file)` on the writer thread.
+            file (:obj:`repolib.SourceFile`): The file to write.
+            callback (function): Dispatched as `callback(file, err)` once the
+                write finishes, where `err` is None on success or the
+                exception which was raised.
+
+        Returns:
+            A :obj:`concurrent.futures.Future` for the write. Call `result()`
+            to wait for it, or `cancel()` to drop it if it hasn't started.
+        """
+        future = self.executor.submit(self._run, save, file, callback)
+        with self.lock:
+            self.futures[future] = file
+
+        def done(future):
+            with self.lock:
+                self.futures.pop(future, None)
+            if future.cancelled():
+                self.log.debug('Write of %s was cancelled', file.path)
+
+        future.add_done_callback(done)
+        return future
+
+    def _run(self, save, file, callback):
+        err = None
+        try:
+            save(file)
+        except Exception as error:
+            err = error
+            self.log.error('Could not save %s: %s', file.path, err)
+            with self.lock:
+                self.failures += 1
+                self.errors.append((file, err))
+        else:
+            with self.lock:
+                self.writes += 1
+        # The callback is handed over before the future resolves, so anyone
+        # waiting on the future can rely on it having been queued.
+        if callback:
+            if self.dispatch is call_now:
+                with self.lock:
+                    self.pending.append((callback, file, err))
+            else:
+                self.dispatch(callback, file, err)
+        if err:
+            raise err
+
+    def when_idle(self, callback):
+        """ Dispatch `callback(errors)` once every queued write has finished.
+
+        Unlike `wait` this doesn't block the caller: the writes are waited
+        for on another thread. If their callbacks queue further writes, those
+        are waited for too. With the default dispatch there is nothing to
+        hand the callback to, so this waits and calls it directly.
+
+        Arguments:
+            callback (function): Called with the list of (file, exception)
+                tuples for the writes which failed, as returned by `wait`.
+        """
+        if self.dispatch is call_now:
+            callback(self.wait())
+            return
+        errors = []
+
+        def finished(new_errors):
+            errors.extend(new_errors)
+            with self.lock:
+                busy = bool(self.futures)
+            if busy:
+                start()
+            else:
+                callback(errors)
+            return False
+
+        def start():
+            thread = threading.Thread(
+                target=lambda: self.dispatch(finished, self.wait()),
+                name='repoman-flush', daemon=True
+            )
+            thread.start()
+
+        start()
+
+    def run_callbacks(self):
+        """ Run the queued callbacks of finished writes on this thread.
+
+        Only used with the default dispatch; see the class description.
+        """
+        while True:
+            with self.lock:
+                if not self.pending:
+                    return
+                callback, file, err = self.pending.popleft()
+            callback(file, err)
+
+    def wait(self, timeout=None):
+        """ Wait for every queued write, and its callback, to finish.
+
+        Callbacks may queue further writes, which are waited for too.
+
+        Returns:
+            A list of (file, exception) tuples for the writes which failed
+            since the last call.
+        """
+        while True:
+            with self.lock:
+                futures = list(self.futures)
+            for future in futures:
+                try:
+                    future.result(timeout=timeout)
+                except CancelledError:
+                    continue
+                except Exception:
+                    # Recorded in `errors` by the writer thread
+                    continue
+            self.run_callbacks()
+            with self.lock:
+                if not self.pending and not self.futures:
+                    errors, self.errors = self.errors, []
+                    return errors
@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+'''
+   Copyright 2020 Ian Santopietro (ian@system76.com)
+
+   This file is part of Repoman.
+
+    Repoman is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Repoman is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Repoman.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+# Planning and applying bundles against real source files. These need
+# repolib 2.
+
+from pathlib import Path
+import shutil
+
+import pytest
+
+repolib = pytest.importorskip('repolib')
+if not hasattr(repolib, 'SourceFile'):
+    pytest.skip('repolib 2 is required', allow_module_level=True)
+
+from repoman import bundle as bundles, keys, loader, openpgp
+from repoman.bundle import Bundle, apply_plan, key_path, plan_bundle
+from repoman.cache import ParseCache
+from repoman.store import SourceStore
+
+KEYRING = Path(__file__).parent / 'data' / 'example-archive-keyring.gpg'
+FINGERPRINT = '16BEF60C289175F989457CC6A06ED19C4661FC30'
+
+SYSTEM = """X-Repolib-Name: System Sources
+Enabled: yes
+Types: deb
+URIs: http://archive.example.com/ubuntu
+Suites: jammy jammy-updates
+Components: main
+"""
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """ A store over a sources directory holding a system source. """
+    directory = tmp_path / 'sources.list.d'
+    directory.mkdir()
+    (directory / 'system.sources').write_text(SYSTEM)
+    (tmp_path / 'keyrings').mkdir()
+    monkeypatch.setattr(repolib.util, 'SOURCES_DIR', directory)
+    monkeypatch.setattr(repolib.util, 'KEYS_DIR', tmp_path / 'keyrings')
+    monkeypatch.setattr(
+        loader, 'parse_cache', ParseCache(tmp_path / 'sources.cache')
+    )
+    monkeypatch.setattr(bundles, 'KEY_RECORDS', tmp_path / 'bundle-keys.json')
+    monkeypatch.setattr(
+        keys, 'key_cache', keys.KeyResponseCache(tmp_path / 'keys.json', seed_dir='')
+    )
+    store = SourceStore()
+    store.load()
+    yield store
+    repolib.util.sources.clear()
+    repolib.util.files.clear()
+    repolib.util.errors.clear()
+    loader.source_index.clear()
+
+def get_bundle():
+    bundle = Bundle()
+    bundle.load_manifest({
+        'keys': {'example': {'path': str(KEYRING)}},
+        'sources': [
+            {
+                'ident': 'system',
+                'suites': ['jammy', 'jammy-updates'],
+                'components': ['main', 'universe'],
+            },
+            {
+                'ident': 'example',
+                'name': 'Example',
+                'uris': ['http://example.com/apt'],
+                'suites': ['jammy'],
+                'components': ['main'],
+                'key': 'example',
+            },
+        ],
+    })
+    return bundle
+
+def test_applying_twice_writes_nothing(store):
+    plan = plan_bundle(get_bundle(), store)
+    assert plan.additions and plan.changes
+    apply_plan(plan, store)
+    assert store.writer.wait() == []
+    writes = store.writer.writes
+
+    plan = plan_bundle(get_bundle(), store)
+    assert not plan, plan.describe()
+    apply_plan(plan, store)
+    assert store.writer.wait() == []
+    assert store.writer.writes == writes
+
+def plan_key(store, spec):
+    bundle = Bundle()
+    bundle.load_manifest({
+        'keys': {'vendor': spec},
+        'sources': [{
+            'uris': ['http://vendor.example.com/apt'],
+            'suites': ['jammy'],
+            'key': 'vendor',
+        }],
+    })
+    return plan_bundle(bundle, store)
+
+def test_existing_key_is_not_imported_again(store):
+    shutil.copy(KEYRING, key_path('vendor'))
+    armor = openpgp.enarmor(KEYRING.read_bytes())
+
+    assert not plan_key(store, {'fingerprint': FINGERPRINT}).keys
+    assert not plan_key(store, {'fingerprint': FINGERPRINT[-16:]}).keys
+    assert not plan_key(store, {'ascii': armor}).keys
+    # A URL key which gives its fingerprint needs no download to check
+    pinned = {'url': 'https://vendor.example.com/key.gpg', 'fingerprint': FINGERPRINT}
+    assert not plan_key(store, pinned).keys
+
+def test_rotated_key_is_imported(store):
+    shutil.copy(KEYRING, key_path('vendor'))
+    rotated = '0123456789ABCDEF0123456789ABCDEF01234567'
+
+    assert 'vendor' in plan_key(store, {'fingerprint': rotated}).keys
+
+def test_replanning_url_key_needs_no_network(store, monkeypatch):
+    url = 'https://vendor.example.com/key.gpg'
+    armor = openpgp.enarmor(KEYRING.read_bytes())
+    monkeypatch.setattr(keys, 'fetch_url', lambda url, *args: armor.encode())
+    plan = plan_key(store, {'url': url})
+    assert 'vendor' in plan.keys
+    apply_plan(plan, store)
+    assert store.writer.wait() == []
+
+    def offline(*args, **kwargs):
+        raise AssertionError('Planning went to the network')
+
+    monkeypatch.setattr(keys, 'fetch_url', offline)
+    monkeypatch.setattr(keys, 'fetch_key', offline)
+    assert not plan_key(store, {'url': url})
+    # A different URL may serve a different key
+    assert 'vendor' in plan_key(store, {'url': f'{url}.new'}).keys
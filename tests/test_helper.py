@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+'''
+   Copyright 2020 Ian Santopietro (ian@system76.com)
+
+   This file is part of Repoman.
+
+    Repoman is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Repoman is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Repoman.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+# The privileged helper client, against a fake system bus.
+
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from repoman import writer
+from repoman.helper import PrivilegedHelper
+
+class FakeError(Exception):
+    def __init__(self, name):
+        super().__init__(name)
+        self.name = name
+
+    def get_dbus_name(self):
+        return self.name
+
+class FakeProxy:
+    def __init__(self, bus):
+        self.bus = bus
+
+    def __getattr__(self, method):
+        def call(*args):
+            if self.bus.failures:
+                raise FakeError(self.bus.failures.pop(0))
+            self.bus.calls.append((method,) + args)
+        return call
+
+class FakeBus:
+    def __init__(self):
+        self.calls = []
+        self.failures = []
+        self.proxies = 0
+
+    def get_object(self, name, path):
+        self.proxies += 1
+        return FakeProxy(self)
+
+@pytest.fixture
+def helper():
+    scheduled = []
+    helper = PrivilegedHelper(
+        schedule=lambda delay, callback: scheduled.append(callback) or (lambda: None)
+    )
+    helper.bus = FakeBus()
+    helper.scheduled = scheduled
+    return helper
+
+def test_deletes_make_one_activation(helper, tmp_path, monkeypatch):
+    monkeypatch.setattr(writer, 'is_writable', lambda directory: False)
+    hashes = writer.DiskHashes()
+    for number in range(5):
+        file = SimpleNamespace(path=tmp_path / f'{number}.sources', sources=[])
+        assert writer.save_source_file(file, hashes, helper=helper)
+
+    assert helper.activations == 1
+    assert helper.bus.proxies == 1
+    assert [call[:2] for call in helper.bus.calls] == [
+        ('delete_source_file', f'{number}.sources') for number in range(5)
+    ]
+
+    # The idle timeout lets the helper exit, once
+    helper.scheduled[-1]()
+    helper.close()
+    assert helper.bus.calls[-1] == ('exit',)
+    assert [call[0] for call in helper.bus.calls].count('exit') == 1
+
+def test_saves_go_through_the_helper(helper, tmp_path, monkeypatch):
+    monkeypatch.setattr(writer, 'is_writable', lambda directory: False)
+    file = SimpleNamespace(
+        path=tmp_path / 'example.sources', sources=[object()],
+        output='Types: deb\n'
+    )
+    assert writer.save_source_file(file, writer.DiskHashes(), helper=helper)
+    assert helper.bus.calls == [
+        ('output_file_to_disk', 'example.sources', 'Types: deb\n')
+    ]
+
+def test_call_is_retried_when_the_helper_was_gone(helper):
+    helper.bus.failures = ['org.freedesktop.DBus.Error.ServiceUnknown']
+    helper.call('delete_source_file', 'a.sources')
+
+    assert helper.bus.calls == [('delete_source_file', 'a.sources')]
+    assert helper.activations == 2
+
+def test_call_is_not_retried_without_a_reply(helper):
+    helper.bus.failures = ['org.freedesktop.DBus.Error.NoReply']
+    with pytest.raises(FakeError):
+        helper.call('delete_source_file', 'a.sources')
+    assert helper.bus.calls == []
@@ -0,0 +1,213 @@
+#!/usr/bin/python3
+'''
+   Copyright 2020 Ian Santopietro (ian@system76.com)
+
+   This file is part of Repoman.
+
+    Repoman is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Repoman is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Repoman.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+# Auditing and compacting keyrings, and the key cache.
+
+import json
+import os
+from pathlib import Path
+import shutil
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('repolib')
+
+from repoman import keys, openpgp
+from repoman.keys import (
+    KeyInfoCache, KeyResponseCache, KeyStore, audit_keys, get_fingerprints,
+    import_key
+)
+
+DATA = Path(__file__).parent / 'data'
+KEYRING = DATA / 'example-archive-keyring.gpg'
+FINGERPRINT = '16BEF60C289175F989457CC6A06ED19C4661FC30'
+EXPIRED = '8423EDCEDD11C7943FFBAC507BE5FA864830C465'
+
+@pytest.fixture
+def keys_dir(tmp_path):
+    directory = tmp_path / 'keyrings'
+    directory.mkdir()
+    return directory
+
+def audit(keys_dir, tmp_path, **sources):
+    sources = {
+        ident: SimpleNamespace(signed_by=str(keys_dir / name))
+        for ident, name in sources.items()
+    }
+    return audit_keys(
+        sources, keys_dir, KeyInfoCache(tmp_path / 'keys.json'), workers=2
+    )
+
+def get_shared(audit):
+    return [issue for issue in audit.issues if issue.kind == 'shared']
+
+def test_copies_of_a_key_are_shared(keys_dir, tmp_path):
+    shutil.copy(KEYRING, keys_dir / 'a.gpg')
+    shutil.copy(KEYRING, keys_dir / 'b.gpg')
+    shared = get_shared(audit(keys_dir, tmp_path, x='a.gpg', y='b.gpg'))
+
+    assert len(shared) == 1
+    assert shared[0].idents == ('x', 'y')
+    assert 'is in 2 keyrings' in shared[0].detail
+
+def test_hard_links_are_one_keyring(keys_dir, tmp_path):
+    shutil.copy(KEYRING, keys_dir / 'a.gpg')
+    os.link(keys_dir / 'a.gpg', keys_dir / 'b.gpg')
+
+    assert get_shared(audit(keys_dir, tmp_path, x='a.gpg', y='b.gpg')) == []
+
+def test_compact_links_duplicates(keys_dir, tmp_path):
+    shutil.copy(KEYRING, keys_dir / 'a.gpg')
+    shutil.copy(KEYRING, keys_dir / 'b.gpg')
+    store = KeyStore(keys_dir)
+
+    assert store.compact(dry_run=True)
+    assert not (keys_dir / 'a.gpg').samefile(keys_dir / 'b.gpg')
+    assert len(store.compact()) == 1
+    assert (keys_dir / 'a.gpg').samefile(keys_dir / 'b.gpg')
+    assert store.compact() == []
+    assert get_shared(audit(keys_dir, tmp_path, x='a.gpg', y='b.gpg')) == []
+
+def test_expired_key_is_reported(keys_dir, tmp_path):
+    shutil.copy(DATA / 'expired-archive-keyring.gpg', keys_dir / 'old.gpg')
+    result = audit(keys_dir, tmp_path, x='old.gpg')
+
+    assert [issue.kind for issue in result.get('x')] == ['expired']
+    assert result.get_severity('x') == 'error'
+
+def test_audit_rereads_only_changed_sources(keys_dir, tmp_path, monkeypatch):
+    shutil.copy(KEYRING, keys_dir / 'a.gpg')
+    shutil.copy(KEYRING, keys_dir / 'b.gpg')
+    shutil.copy(DATA / 'expired-archive-keyring.gpg', keys_dir / 'old.gpg')
+    cache = KeyInfoCache(tmp_path / 'keys.json')
+    sources = {
+        ident: SimpleNamespace(signed_by=str(keys_dir / name))
+        for ident, name in (('x', 'a.gpg'), ('y', 'b.gpg'))
+    }
+    previous = audit_keys(sources, keys_dir, cache)
+    assert len(get_shared(previous)) == 1
+
+    read = []
+    read_keys = keys._read_keys
+    monkeypatch.setattr(
+        keys, '_read_keys',
+        lambda cache, path: read.append(path) or read_keys(cache, path)
+    )
+    sources['y'] = SimpleNamespace(signed_by=str(keys_dir / 'old.gpg'))
+    result = audit_keys(
+        sources, keys_dir, cache, previous=previous, changed={'y'}
+    )
+
+    assert sorted(read) == [str(keys_dir / 'b.gpg'), str(keys_dir / 'old.gpg')]
+    assert get_shared(result) == []
+    assert [issue.kind for issue in result.get('y')] == ['expired']
+    assert result.get('x') == []
+
+@pytest.fixture
+def unprivileged(keys_dir, monkeypatch):
+    """ A keys directory which can't be written, as in the GUI. """
+    if not hasattr(keys.repolib, 'SourceKey'):
+        pytest.skip('repolib 2 is required')
+    monkeypatch.setattr(keys.repolib.util, 'KEYS_DIR', keys_dir)
+    monkeypatch.setattr(keys, 'key_store', KeyStore(keys_dir))
+    monkeypatch.setattr(keys.os, 'access', lambda path, mode: False)
+    shutil.copy(KEYRING, keys_dir / 'a.gpg')
+    return keys_dir
+
+@pytest.mark.parametrize('key_type, key_data', [
+    ('fingerprint', FINGERPRINT),
+    ('ascii', openpgp.enarmor(KEYRING.read_bytes())),
+])
+def test_unprivileged_import_uses_existing_keyring(
+        unprivileged, key_type, key_data):
+    key = import_key('vendor', key_type, key_data)
+
+    assert key.path == unprivileged / 'a.gpg'
+    assert sorted(path.name for path in unprivileged.iterdir()) == ['a.gpg']
+
+def test_existing_keyring_path_can_be_refused(unprivileged):
+    armor = openpgp.enarmor(KEYRING.read_bytes())
+    key = import_key('vendor', 'ascii', armor, reuse_path=False)
+
+    assert key.path == unprivileged / 'vendor-archive-keyring.gpg'
+
+@pytest.fixture
+def seeded(tmp_path):
+    """ A key cache seeded with two keyrings, one of them for a URL. """
+    seed_dir = tmp_path / 'seed'
+    seed_dir.mkdir()
+    shutil.copy(KEYRING, seed_dir / 'archive-keyring.gpg')
+    shutil.copy(DATA / 'expired-archive-keyring.gpg', seed_dir / 'old.gpg')
+    (seed_dir / 'urls.json').write_text(json.dumps({
+        'https://example.com/archive-keyring.gpg': 'archive-keyring.gpg',
+    }))
+    cache = KeyResponseCache(tmp_path / 'keys.json', seed_dir=seed_dir)
+    cache.load()
+    return cache
+
+def fingerprints_of(armor):
+    return armor and get_fingerprints(armor)
+
+def test_seeded_keys_by_fingerprint(seeded):
+    assert fingerprints_of(seeded.get('fingerprint', FINGERPRINT)) == [FINGERPRINT]
+    assert fingerprints_of(seeded.get('fingerprint', EXPIRED[-16:])) == [EXPIRED]
+    assert seeded.get('fingerprint', FINGERPRINT[-8:]) is None
+
+def test_seeded_keys_by_url(seeded):
+    url = 'https://example.com/archive-keyring.gpg'
+    assert fingerprints_of(seeded.get('url', url)) == [FINGERPRINT]
+    # The same file name from another vendor isn't the same key
+    assert seeded.get('url', 'https://other.example.com/archive-keyring.gpg') is None
+
+def test_url_import_with_expected_fingerprint(seeded):
+    url = 'https://other.example.com/archive-keyring.gpg'
+    assert fingerprints_of(seeded.get('url', url, fingerprint=EXPIRED)) == [EXPIRED]
+
+    mapped = 'https://example.com/archive-keyring.gpg'
+    assert fingerprints_of(seeded.get('url', mapped, fingerprint=EXPIRED)) == [EXPIRED]
+
+    armor = openpgp.enarmor(KEYRING.read_bytes())
+    with pytest.raises(ValueError):
+        seeded.put('url', url, armor, fingerprint=EXPIRED)
+    seeded.put('url', url, armor, fingerprint=FINGERPRINT)
+    assert seeded.get('url', url, fingerprint=FINGERPRINT) == armor
+    # Nothing could check a fetched key for an import which expects none
+    assert seeded.get('url', url) is None
+
+def planted_cache(tmp_path):
+    path = tmp_path / 'planted.json'
+    cache = KeyResponseCache(path, seed_dir='')
+    cache.put('fingerprint', FINGERPRINT, openpgp.enarmor(KEYRING.read_bytes()))
+    return path
+
+def test_cache_writable_by_others_is_ignored(tmp_path):
+    path = planted_cache(tmp_path)
+    assert KeyResponseCache(path, seed_dir='').get('fingerprint', FINGERPRINT)
+
+    path.chmod(0o666)
+    assert KeyResponseCache(path, seed_dir='').get('fingerprint', FINGERPRINT) is None
+
+@pytest.mark.skipif(os.getuid() != 0, reason='Changing owners needs root')
+def test_cache_owned_by_another_user_is_ignored(tmp_path):
+    path = planted_cache(tmp_path)
+    os.chown(path, 12345, -1)
+    assert KeyResponseCache(path, seed_dir='').get('fingerprint', FINGERPRINT) is None
@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+'''
+   Copyright 2020 Ian Santopietro (ian@system76.com)
+
+   This file is part of Repoman.
+
+    Repoman is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Repoman is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Repoman.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Loading sources, with and without the parse cache. These need repolib 2.
+
+from pathlib import Path
+import time
+
+import pytest
+
+repolib = pytest.importorskip('repolib')
+if not hasattr(repolib, 'SourceFile'):
+    pytest.skip('repolib 2 is required', allow_module_level=True)
+
+from repoman import loader
+from repoman.cache import ParseCache
+
+KEYRING = Path(__file__).parent / 'data' / 'example-archive-keyring.gpg'
+
+SOURCE = """X-Repolib-Name: Example {number}
+Enabled: yes
+Types: deb
+URIs: http://example.com/{number}
+Suites: jammy
+Components: main
+Signed-By: {keyring}
+"""
+
+@pytest.fixture
+def sources_dir(tmp_path, monkeypatch):
+    """ An empty sources directory with its own parse cache. """
+    directory = tmp_path / 'sources.list.d'
+    directory.mkdir()
+    monkeypatch.setattr(repolib.util, 'SOURCES_DIR', directory)
+    monkeypatch.setattr(
+        loader, 'parse_cache', ParseCache(tmp_path / 'sources.cache')
+    )
+    yield directory
+    repolib.util.sources.clear()
+    repolib.util.files.clear()
+    repolib.util.keys.clear()
+    repolib.util.errors.clear()
+    loader.source_index.clear()
+
+def write_sources(directory, count):
+    for number in range(count):
+        path = directory / f'example-{number}.sources'
+        path.write_text(SOURCE.format(number=number, keyring=KEYRING))
+
+def get_state():
+    """ Get what matters about the loaded sources, by ident. """
+    state = {}
+    for ident, source in repolib.util.sources.items():
+        key = getattr(source, 'key', None)
+        state[ident] = (
+            str(source.name),
+            list(source.uris),
+            list(source.suites),
+            list(source.components),
+            str(source.signed_by),
+            str(key.path) if key else None,
+            source.file.path.name,
+        )
+    return state
+
+def test_cached_load_matches_uncached(sources_dir):
+    write_sources(sources_dir, 5)
+
+    loader.load_all_sources()
+    uncached = get_state()
+    assert loader.parse_cache.misses == 5
+    assert all(item[5] == str(KEYRING) for item in uncached.values())
+
+    loader.parse_cache.load()
+    loader.load_all_sources()
+    assert loader.parse_cache.hits == 5
+    assert get_state() == uncached
+
+def test_changed_file_is_parsed_again(sources_dir):
+    write_sources(sources_dir, 2)
+    loader.load_all_sources()
+    path = sources_dir / 'example-1.sources'
+    path.write_text(path.read_text().replace('main', 'main universe'))
+
+    loader.load_all_sources()
+    components = [
+        list(source.components) for source in repolib.util.sources.values()
+        if source.file.path == path
+    ]
+    assert components == [['main', 'universe']]
+
+def test_keys_are_registered(sources_dir):
+    write_sources(sources_dir, 2)
+
+    for cached in (False, True):
+        loader.load_all_sources()
+        assert loader.parse_cache.hits == (2 if cached else 0)
+        assert list(repolib.util.keys) == [str(KEYRING)]
+        key = repolib.util.keys[str(KEYRING)]
+        assert any(
+            source.key is key for source in repolib.util.sources.values()
+        )
+
+def test_duplicate_idents_are_renamed(sources_dir):
+    (sources_dir / 'vendor.sources').write_text(
+        SOURCE.format(number=1, keyring=KEYRING)
+    )
+    (sources_dir / 'vendor.list').write_text(
+        'deb http://example.com/2 jammy main\n'
+    )
+
+    loader.load_all_sources()
+    files = sorted(
+        source.file.path.name for source in repolib.util.sources.values()
+    )
+    assert files == ['vendor.list', 'vendor.sources']
+    assert repolib.util.sources['vendor'].file.path.name == 'vendor.sources'
+
+    # Reloading the later file must not replace the earlier one's source
+    loader.reload_source_file(sources_dir / 'vendor.list')
+    files = sorted(
+        source.file.path.name for source in repolib.util.sources.values()
+    )
+    assert files == ['vendor.list', 'vendor.sources']
+    assert repolib.util.sources['vendor'].file.path.name == 'vendor.sources'
+
+def test_load_benchmark(sources_dir):
+    """ Load 1000 files cold, warm and sequentially, and compare the times.
+
+    The timings are printed (run with -s to see them). They vary too much
+    from run to run to assert on, so the assertions check the cache counters
+    instead: the cold load parses every file and the warm one none.
+    """
+    write_sources(sources_dir, 1000)
+
+    start = time.monotonic()
+    loader.load_all_sources(workers=1)
+    sequential = time.monotonic() - start
+
+    loader.parse_cache.clear()
+    hits, misses = loader.parse_cache.hits, loader.parse_cache.misses
+    start = time.monotonic()
+    loader.load_all_sources()
+    cold = time.monotonic() - start
+    assert loader.parse_cache.hits == hits
+    assert loader.parse_cache.misses - misses == 1000
+
+    hits, misses = loader.parse_cache.hits, loader.parse_cache.misses
+    start = time.monotonic()
+    loader.load_all_sources()
+    warm = time.monotonic() - start
+
+    print(
+        f'1000 files: sequential {sequential:.3f}s, '
+        f'parallel cold {cold:.3f}s, warm {warm:.3f}s'
+    )
+    assert len(repolib.util.sources) == 1000
+    assert loader.parse_cache.hits - hits == 1000
+    assert loader.parse_cache.misses == misses
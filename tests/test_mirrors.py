@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+'''
+   Copyright 2020 Ian Santopietro (ian@system76.com)
+
+   This file is part of Repoman.
+
+    Repoman is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Repoman is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Repoman.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+# Probing mirrors served by a local HTTP server.
+
+import functools
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+
+import pytest
+
+from repoman import mirrors
+
+RELEASE = """Origin: Ubuntu
+Suite: jammy
+Codename: jammy
+Date: {date}
+Valid-Until: {valid_until}
+Components: main
+"""
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def server(tmp_path):
+    """ An HTTP server for `tmp_path`, as a function making mirror URIs. """
+    handler = functools.partial(QuietHandler, directory=str(tmp_path))
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield lambda name: f'http://127.0.0.1:{httpd.server_port}/{name}'
+    httpd.shutdown()
+    httpd.server_close()
+
+def add_release(tmp_path, mirror, name='InRelease', suite='jammy',
+                date='Thu, 21 Apr 2022 17:16:08 UTC',
+                valid_until='Thu, 28 Apr 2022 17:16:08 UTC'):
+    directory = tmp_path / mirror / 'dists' / suite
+    directory.mkdir(parents=True, exist_ok=True)
+    (directory / name).write_text(
+        RELEASE.format(date=date, valid_until=valid_until)
+    )
+
+def test_probe_fetches_inrelease(tmp_path, server):
+    add_release(tmp_path, 'a')
+    result = mirrors.probe_mirror(server('a'), 'jammy')
+
+    assert result.ok
+    assert result.url == f'{server("a")}/dists/jammy/InRelease'
+    assert result.size == len(result.data) > 0
+    assert result.ttfb is not None and result.elapsed >= result.ttfb
+
+def test_probe_falls_back_to_release(tmp_path, server):
+    add_release(tmp_path, 'a', name='Release')
+    result = mirrors.probe_mirror(server('a'), 'jammy')
+
+    assert result.ok
+    assert result.url.endswith('/dists/jammy/Release')
+
+def test_probe_reports_missing_suite(tmp_path, server):
+    add_release(tmp_path, 'a')
+    result = mirrors.probe_mirror(server('a'), 'noble')
+
+    assert not result.ok
+    assert result.error == 'HTTP 404'
+
+def test_probe_without_release_urls_fails(monkeypatch):
+    monkeypatch.setattr(mirrors, 'get_release_urls', lambda uri, suite: [])
+    result = mirrors.probe_mirror('http://mirror.invalid/ubuntu', 'jammy')
+
+    assert not result.ok
+    assert result.url == ''
+
+def test_prober_reports_every_mirror(tmp_path, server):
+    add_release(tmp_path, 'a')
+    add_release(tmp_path, 'b', name='Release')
+    uris = [server('a'), server('b'), server('missing'), server('a')]
+    reported = []
+    done = threading.Event()
+    finished = {}
+
+    def on_done(results):
+        finished.update(results)
+        done.set()
+
+    prober = mirrors.MirrorProber(workers=2, timeout=5)
+    prober.probe(uris, 'jammy', on_result=reported.append, on_done=on_done)
+
+    assert done.wait(10)
+    assert sorted(result.uri for result in reported) == sorted(set(uris))
+    assert finished[server('a')].ok and finished[server('b')].ok
+    assert not finished[server('missing')].ok
+
+def probe_all(prober, uris):
+    run = prober.probe(uris, 'jammy')
+    return run.wait(10)
+
+def test_lagging_mirror_is_flagged(tmp_path, server):
+    add_release(tmp_path, 'fresh', date='Thu, 21 Apr 2022 17:16:08 UTC')
+    add_release(tmp_path, 'recent', date='Thu, 21 Apr 2022 15:16:08 UTC')
+    add_release(tmp_path, 'stale', date='Wed, 20 Apr 2022 17:16:08 UTC')
+    uris = [server('fresh'), server('recent'), server('stale')]
+    now = mirrors.parse_release_date('Fri, 22 Apr 2022 00:00:00 UTC')
+
+    results = probe_all(mirrors.MirrorProber(), uris)
+    report = mirrors.compare_freshness(results, now=now)
+
+    assert not report[server('fresh')].lagging
+    assert not report[server('recent')].lagging
+    assert report[server('recent')].lag == 2 * 60 * 60
+    assert report[server('stale')].lagging
+    assert report[server('stale')].lag == 24 * 60 * 60
+    assert mirrors.format_freshness(report[server('fresh')]) == 'Up to date'
+
+def test_expired_mirror_is_flagged(tmp_path, server):
+    add_release(tmp_path, 'a')
+    add_release(tmp_path, 'b')
+    now = mirrors.parse_release_date('Fri, 29 Apr 2022 00:00:00 UTC')
+
+    results = probe_all(mirrors.MirrorProber(), [server('a'), server('b')])
+    report = mirrors.compare_freshness(results, now=now)
+
+    assert all(item.expired and item.lagging for item in report.values())
+    assert mirrors.format_freshness(report[server('a')]) == 'Expired'
+
+def test_unreachable_mirror_is_unknown(tmp_path, server):
+    add_release(tmp_path, 'a')
+    results = probe_all(mirrors.MirrorProber(), [server('a'), server('gone')])
+    report = mirrors.compare_freshness(results)
+
+    assert not report[server('gone')].ok
+    assert report[server('gone')].lagging
+    assert mirrors.format_freshness(report[server('gone')]) == 'Unknown (HTTP 404)'
+
+def test_health_cache_drops_malformed_entries(tmp_path):
+    path = tmp_path / 'mirrors.json'
+    path.write_text(json.dumps({
+        'http://good.example.com': {
+            'checked': 1000, 'latency': 0.05, 'throughput': 2e6,
+            'last_success': 1000,
+        },
+        'http://old.example.com': {'checked': 1000, 'last_success': 1000},
+        'http://string.example.com': 'fast',
+        'http://typed.example.com': {'latency': 'quick'},
+    }))
+    cache = mirrors.MirrorHealthCache(path)
+
+    assert sorted(cache.entries) == ['http://good.example.com', 'http://old.example.com']
+    assert cache.get('http://string.example.com') is None
+    assert cache.describe('http://good.example.com', now=1060).startswith('50 ms')
+    assert cache.describe('http://old.example.com', now=1060).startswith('Not measured')
+    assert cache.is_healthy('http://old.example.com')
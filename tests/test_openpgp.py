@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+'''
+   Copyright 2020 Ian Santopietro (ian@system76.com)
+
+   This file is part of Repoman.
+
+    Repoman is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Repoman is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Repoman.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+
+# Parsing keyrings without gpg.
+
+from datetime import datetime, timezone
+from pathlib import Path
+import struct
+
+from repoman import openpgp
+
+DATA = Path(__file__).parent / 'data'
+
+def test_key_without_expiry():
+    [key] = openpgp.read_keyring(DATA / 'example-archive-keyring.gpg')
+
+    assert key.fingerprint == '16BEF60C289175F989457CC6A06ED19C4661FC30'
+    assert key.uids == ('Example Archive <archive@example.com>',)
+    assert key.expires is None
+    assert not key.revoked
+
+def test_third_party_certification_keeps_expiry():
+    # The key expired at the end of 2020, and was certified by another key
+    # (without a key expiry) after its self-signature was made
+    [key] = openpgp.read_keyring(DATA / 'expired-archive-keyring.gpg')
+
+    assert key.fingerprint == '8423EDCEDD11C7943FFBAC507BE5FA864830C465'
+    assert key.expires == datetime(2020, 12, 31, tzinfo=timezone.utc)
+    assert key.expires < datetime.now(timezone.utc)
+
+def test_armored_keyring():
+    data = (DATA / 'expired-archive-keyring.gpg').read_bytes()
+
+    assert openpgp.parse_keyring(openpgp.enarmor(data).encode('ascii')) == \
+        openpgp.parse_keyring(data)
+
+def subpacket(kind, data):
+    return bytes([len(data) + 1, kind]) + data
+
+def test_issuer_key_id_in_unhashed_area():
+    hashed = subpacket(openpgp.SUBPACKET_CREATED, struct.pack('>I', 1000))
+    unhashed = subpacket(openpgp.SUBPACKET_ISSUER, bytes.fromhex('7BE5FA864830C465'))
+    body = (
+        bytes([4, 0x13, 22, 8])
+        + struct.pack('>H', len(hashed)) + hashed
+        + struct.pack('>H', len(unhashed)) + unhashed
+    )
+
+    assert openpgp.parse_signature(body) == (0x13, 1000, None, '7BE5FA864830C465')
+    assert openpgp.is_issued_by(
+        '7BE5FA864830C465', '8423EDCEDD11C7943FFBAC507BE5FA864830C465'
+    )
+    assert not openpgp.is_issued_by('', '8423EDCEDD11C7943FFBAC507BE5FA864830C465')
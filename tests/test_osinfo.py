@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+'''
+   Copyright 2020 Ian Santopietro (ian@system76.com)
+
+   This file is part of Repoman.
+
+    Repoman is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Repoman is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Repoman.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from repoman import osinfo
+
+MINT = '''NAME="Linux Mint"
+VERSION="21.1 (Vera)"
+ID=linuxmint
+ID_LIKE="ubuntu debian"
+PRETTY_NAME="Linux Mint 21.1"
+VERSION_CODENAME=vera
+UBUNTU_CODENAME=jammy
+'''
+
+POP = '''NAME="Pop!_OS"
+ID=pop
+ID_LIKE="ubuntu debian"
+PRETTY_NAME="Pop!_OS 22.04 LTS"
+VERSION_CODENAME=jammy
+UBUNTU_CODENAME=jammy
+'''
+
+def identify(text):
+    return osinfo.make_identity(osinfo.parse_os_release(text))
+
+def test_derivative_suites_use_the_ubuntu_codename():
+    identity = identify(MINT)
+    assert identity.name == 'Linux Mint'
+    assert identity.version_codename == 'vera'
+    assert identity.codename == 'jammy'
+
+def test_ubuntu_codename():
+    identity = identify(POP)
+    assert identity.codename == 'jammy'
+    assert identity.id_like == ('ubuntu', 'debian')
+
+def test_falls_back_to_repolib_then_version_codename(monkeypatch):
+    monkeypatch.setattr(osinfo, '_fallback_codename', lambda: 'focal')
+    assert identify('VERSION_CODENAME=vera\n').codename == 'focal'
+    monkeypatch.setattr(osinfo, '_fallback_codename', lambda: '')
+    assert identify('VERSION_CODENAME=bookworm\n').codename == 'bookworm'
+
+def test_missing_name_falls_back():
+    assert identify('').name == osinfo.FALLBACK_NAME
+
+def test_provider_rereads_changed_file(tmp_path):
+    path = tmp_path / 'os-release'
+    path.write_text(POP)
+    provider = osinfo.OSIdentityProvider(path)
+    assert provider.get().name == 'Pop!_OS'
+    assert provider.get() is provider.get()
+    path.write_text(MINT.replace('Linux Mint', 'Linux Mint Edge'))
+    assert provider.get().name == 'Linux Mint Edge'
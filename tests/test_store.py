@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+'''
+   Copyright 2020 Ian Santopietro (ian@system76.com)
+
+   This file is part of Repoman.
+
+    Repoman is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Repoman is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Repoman.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# The SourceStore against real source files. These need repolib 2.
+
+import pytest
+
+repolib = pytest.importorskip('repolib')
+if not hasattr(repolib, 'SourceFile'):
+    pytest.skip('repolib 2 is required', allow_module_level=True)
+
+from repoman import loader
+from repoman.cache import ParseCache
+from repoman.store import SourceStore
+
+SYSTEM = """X-Repolib-Name: System Sources
+Enabled: yes
+Types: deb
+URIs: http://archive.example.com/ubuntu
+Suites: jammy jammy-updates
+Components: main
+"""
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """ A store over a sources directory holding a system source. """
+    directory = tmp_path / 'sources.list.d'
+    directory.mkdir()
+    (directory / 'system.sources').write_text(SYSTEM)
+    monkeypatch.setattr(repolib.util, 'SOURCES_DIR', directory)
+    monkeypatch.setattr(repolib.util, 'KEYS_DIR', tmp_path / 'keyrings')
+    monkeypatch.setattr(
+        loader, 'parse_cache', ParseCache(tmp_path / 'sources.cache')
+    )
+    store = SourceStore()
+    store.load()
+    yield store
+    repolib.util.sources.clear()
+    repolib.util.files.clear()
+    repolib.util.errors.clear()
+    loader.source_index.clear()
+
+def test_flush_wait_leaves_sources_loaded(store):
+    notified = []
+    store.subscribe(lambda paths, delta: notified.append(delta))
+    store.set_mirrors(['http://mirror.example.com/ubuntu'])
+
+    assert store.flush(wait=True) == []
+    assert store.system_source is not None
+    assert list(store.system_source.uris) == ['http://mirror.example.com/ubuntu']
+    assert notified and 'system' in notified[-1]
+    assert store.writer.writes == 1
+
+def test_unchanged_save_is_skipped(store):
+    # The first save may normalise the file's formatting
+    store.save_source(store.system_source)
+    store.flush(wait=True)
+    skipped = store.writes_skipped
+
+    store.save_source(store.system_source)
+    assert store.flush(wait=True) == []
+    assert store.writes_skipped == skipped + 1
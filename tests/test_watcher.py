@@ -0,0 +1,147 @@
+#!/usr/bin/python3
+'''
+   Copyright 2020 Ian Santopietro (ian@system76.com)
+
+   This file is part of Repoman.
+
+    Repoman is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Repoman is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Repoman.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# The SourcesWatcher debounce, driven with fake monitor events.
+
+import pytest
+
+pytest.importorskip('gi')
+pytest.importorskip('repolib')
+
+from repoman import watcher
+from repoman.watcher import Gio, SourcesWatcher
+
+class FakeStore:
+    """ Records the reloads asked of it. """
+
+    def __init__(self, own=()):
+        self.loaded = True
+        self.own = set(own)
+        self.reloaded = []
+
+    def is_own_write(self, path):
+        return path in self.own
+
+    def reload_paths(self, paths):
+        self.reloaded.append(set(paths))
+
+class FakeTimers:
+    """ Stands in for the GLib timeouts, which only fire when asked to. """
+
+    def __init__(self):
+        self.next_id = 0
+        self.active = {}
+
+    def timeout_add(self, delay, callback):
+        self.next_id += 1
+        self.active[self.next_id] = callback
+        return self.next_id
+
+    def source_remove(self, timeout_id):
+        del self.active[timeout_id]
+
+    def fire(self):
+        for timeout_id, callback in list(self.active.items()):
+            del self.active[timeout_id]
+            callback()
+
+@pytest.fixture
+def timers(monkeypatch):
+    timers = FakeTimers()
+    monkeypatch.setattr(watcher.GLib, 'timeout_add', timers.timeout_add)
+    monkeypatch.setattr(watcher.GLib, 'source_remove', timers.source_remove)
+    return timers
+
+def send(sources_watcher, path, *event_types):
+    file = Gio.File.new_for_path(str(path))
+    for event_type in event_types:
+        sources_watcher.on_changed(None, file, None, event_type)
+
+def test_burst_for_one_file_reloads_once(tmp_path, timers):
+    store = FakeStore()
+    sources_watcher = SourcesWatcher(store, path=tmp_path)
+    path = tmp_path / 'vendor.sources'
+    send(
+        sources_watcher, path,
+        Gio.FileMonitorEvent.CREATED,
+        Gio.FileMonitorEvent.CHANGED,
+        Gio.FileMonitorEvent.CHANGED,
+        Gio.FileMonitorEvent.CHANGES_DONE_HINT,
+    )
+
+    # Each event restarts the window rather than adding another
+    assert len(timers.active) == 1
+    assert store.reloaded == []
+    timers.fire()
+
+    assert store.reloaded == [{str(path)}]
+    assert sources_watcher.events == 4
+    assert sources_watcher.reloads == 1
+    assert sources_watcher.files_reloaded == 1
+    assert sources_watcher.suppressed == 0
+
+def test_changes_to_several_files_are_one_batch(tmp_path, timers):
+    store = FakeStore()
+    sources_watcher = SourcesWatcher(store, path=tmp_path)
+    for name in ('a.sources', 'b.sources'):
+        send(
+            sources_watcher, tmp_path / name,
+            Gio.FileMonitorEvent.CHANGES_DONE_HINT
+        )
+    timers.fire()
+
+    assert store.reloaded == [
+        {str(tmp_path / 'a.sources'), str(tmp_path / 'b.sources')}
+    ]
+    assert sources_watcher.reloads == 1
+    assert sources_watcher.files_reloaded == 2
+
+def test_own_writes_are_suppressed(tmp_path, timers):
+    own = tmp_path / 'own.sources'
+    other = tmp_path / 'other.sources'
+    store = FakeStore(own=[str(own)])
+    sources_watcher = SourcesWatcher(store, path=tmp_path)
+    send(sources_watcher, own, Gio.FileMonitorEvent.CHANGES_DONE_HINT)
+    timers.fire()
+
+    assert store.reloaded == []
+    assert sources_watcher.suppressed == 1
+    assert sources_watcher.reloads == 0
+
+    send(sources_watcher, own, Gio.FileMonitorEvent.CHANGES_DONE_HINT)
+    send(sources_watcher, other, Gio.FileMonitorEvent.CHANGES_DONE_HINT)
+    timers.fire()
+
+    assert store.reloaded == [{str(other)}]
+    assert sources_watcher.suppressed == 2
+    assert sources_watcher.reloads == 1
+    assert sources_watcher.files_reloaded == 1
+
+def test_plain_changes_alone_do_not_reload(tmp_path, timers):
+    store = FakeStore()
+    sources_watcher = SourcesWatcher(store, path=tmp_path)
+    send(
+        sources_watcher, tmp_path / 'vendor.sources',
+        Gio.FileMonitorEvent.CHANGED, Gio.FileMonitorEvent.CHANGED
+    )
+
+    assert timers.active == {}
+    assert sources_watcher.events == 2
+    assert sources_watcher.reloads == 0
@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+'''
+   Copyright 2020 Ian Santopietro (ian@system76.com)
+
+   This file is part of Repoman.
+
+    Repoman is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Repoman is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Repoman.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import queue
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from repoman import writer
+
+def make_file(path):
+    return SimpleNamespace(path=path)
+
+def slow_save(file):
+    time.sleep(0.05)
+
+def test_wait_runs_callbacks_on_the_calling_thread(tmp_path):
+    source_writer = writer.SourceWriter()
+    calls = []
+
+    def callback(file, err):
+        # Simulate a slow reload of the written file
+        time.sleep(0.05)
+        calls.append((file.path.name, err, threading.get_ident()))
+
+    for name in ('a', 'b', 'c'):
+        source_writer.submit(slow_save, make_file(tmp_path / name), callback)
+    assert source_writer.wait() == []
+    assert [name for name, err, thread in calls] == ['a', 'b', 'c']
+    assert {thread for name, err, thread in calls} == {threading.get_ident()}
+
+def test_wait_reports_failures_and_runs_their_callbacks(tmp_path):
+    source_writer = writer.SourceWriter()
+    calls = []
+
+    def fail(file):
+        raise PermissionError('denied')
+
+    file = make_file(tmp_path / 'a')
+    source_writer.submit(fail, file, lambda file, err: calls.append(err))
+    errors = source_writer.wait()
+    assert [(failed, type(err)) for failed, err in errors] == [(file, PermissionError)]
+    assert isinstance(calls[0], PermissionError)
+    assert source_writer.failures == 1
+
+def test_wait_covers_writes_queued_by_callbacks(tmp_path):
+    source_writer = writer.SourceWriter()
+    calls = []
+
+    def first_done(file, err):
+        source_writer.submit(
+            slow_save, make_file(tmp_path / 'b'),
+            lambda file, err: calls.append(file.path.name)
+        )
+
+    source_writer.submit(slow_save, make_file(tmp_path / 'a'), first_done)
+    source_writer.wait()
+    assert calls == ['b']
+
+def test_dispatched_callbacks_are_not_queued(tmp_path):
+    dispatched = []
+    source_writer = writer.SourceWriter(
+        dispatch=lambda callback, *args: dispatched.append(args)
+    )
+    source_writer.submit(slow_save, make_file(tmp_path / 'a'), lambda *args: None)
+    source_writer.wait()
+    assert len(dispatched) == 1
+    assert not source_writer.pending
+
+def test_when_idle_does_not_block(tmp_path):
+    # A queue stands in for the main loop the GUI dispatches onto
+    main_loop = queue.Queue()
+    source_writer = writer.SourceWriter(
+        dispatch=lambda callback, *args: main_loop.put((callback, args))
+    )
+    saved = []
+    done = []
+
+    def fail(file):
+        raise PermissionError('denied')
+
+    def first_done(file, err):
+        source_writer.submit(
+            slow_save, make_file(tmp_path / 'b'),
+            lambda file, err: saved.append(file.path.name)
+        )
+
+    source_writer.submit(slow_save, make_file(tmp_path / 'a'), first_done)
+    source_writer.submit(fail, make_file(tmp_path / 'c'))
+    source_writer.when_idle(done.append)
+    assert done == []
+
+    while not done:
+        callback, args = main_loop.get(timeout=5)
+        callback(*args)
+    assert saved == ['b']
+    assert [file.path.name for file, err in done[0]] == ['c']
+
+def test_atomic_write_replaces_and_keeps_mode(tmp_path):
+    path = tmp_path / 'example.sources'
+    path.write_text('old')
+    os.chmod(path, 0o600)
+    writer.atomic_write(path, b'new')
+    assert path.read_bytes() == b'new'
+    assert path.stat().st_mode & 0o777 == 0o600
+    assert [child.name for child in tmp_path.iterdir()] == ['example.sources']